@@ -1,17 +1,19 @@
 # ---------- ARCHIVE AGENT (ZIP / TAR / TAR.GZ) ----------
 import json
-import os, io, tarfile, zipfile, tempfile, mimetypes
-from typing import List, Optional
+import uuid
+import os, io, shutil, tarfile, zipfile, tempfile, mimetypes
+from typing import Dict, List, Optional, Tuple
 from starlette.datastructures import UploadFile as StarletteUploadFile
-import httpx
 import asyncio
 from html_agent import html_agent
 from pdf_agent import pdf_agent 
 from csv_tsv_xlsx_agent import csv_tsv_xlsx_agent #Using Powerdrill
 from image_agent import image_agent
-from io import BytesIO
 from helper_html import render_html_file, render_html_url
-from process_sql_parquet_json import process_sql_parquet_json
+from helper_scheduler import StageScheduler
+from helper_http import fetch_many
+from helper_metrics import timed
+from helper_jobs import mark_degraded
 from sql_parquet_json_agent import sql_parquet_json_agent, execute_llm_python
 from process_sql_parquet_json import process_sql_parquet_json
 ARCHIVE_EXTS = (".zip", ".tar", ".tgz", ".tar.gz")
@@ -25,6 +27,7 @@ SESSION_ROOT = os.getenv("SESSION_ROOT", "/data/_session_sql")
 MAX_UNPACK_BYTES = 200 * 1024 * 1024   # 200 MB cap (uncompressed)
 MAX_FILES        = 200                 # entries per archive
 MAX_PER_TYPE     = 50                  # cap per modality
+COPY_CHUNK_BYTES = 1024 * 1024
 
 def _safe_join(base, *paths):
     final_path = os.path.abspath(os.path.join(base, *paths))
@@ -32,20 +35,23 @@ def _safe_join(base, *paths):
         raise ValueError(f"Unsafe path traversal: {final_path}")
     return final_path
 
-def _upload_from_bytes(name: str, data: bytes) -> StarletteUploadFile:
-    return StarletteUploadFile(filename=name, file=io.BytesIO(data))
+def _upload_from_path(name: str, path: str) -> StarletteUploadFile:
+    return StarletteUploadFile(filename=name, file=open(path, "rb"))
 
-def _collect_archive_blobs_from_urls(urls: List[str]) -> List[tuple[str, bytes]]:
-    blobs = []
-    for u in (urls or []):
-        try:
-            r = httpx.get(u, timeout=30, follow_redirects=True)
-            print(f"[archive_agent] GET {u} -> {r.status_code}, ct={r.headers.get('content-type')}")
-            r.raise_for_status()
-            blobs.append((u, r.content))
-        except Exception as e:
-            print(f"[archive_agent] URL error {u}: {e}")
-    return blobs
+async def _spool_upload(uf: StarletteUploadFile, path: str) -> int:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    size = 0
+    with open(path, "wb") as f:
+        while True:
+            chunk = await uf.read(COPY_CHUNK_BYTES)
+            if not chunk:
+                break
+            f.write(chunk)
+            size += len(chunk)
+    return size
+
+async def _collect_archive_paths_from_urls(urls: List[str]) -> List[tuple[str, str]]:
+    return [(r.url, r.path) for r in await fetch_many(urls, label="archive_agent")]
 
 def _coerce_to_text(result) -> str:
     if result is None:
@@ -57,38 +63,23 @@ def _coerce_to_text(result) -> str:
         return result.get("answer", "") or str(result)
     return str(result)
 
+@timed("archive_agent")
 async def archive_agent(
     task: str,
     archive_files: Optional[List[StarletteUploadFile]] = None,
     archive_urls: Optional[List[str]] = None,
-) -> dict:
+) -> Tuple[dict, Dict[str, str]]:
     """
     Unpack archives and route to your existing agents.
     Returns strings you can pass directly to your master agent contexts:
       {"csv": str, "pdf": str, "image": str, "html": str}
+    and the file kinds whose agent failed or was cut off ({kind: "ErrorType: message"}; their string is "").
     """
     archive_files = archive_files or []
     archive_urls  = archive_urls  or []
 
     print(f"[archive_agent] START files={len(archive_files)} urls={len(archive_urls)}")
 
-    # 1) Gather archives (uploads + urls)
-    archive_blobs: List[tuple[str, bytes]] = []
-    for af in archive_files:
-        try:
-            data = await af.read()
-            print(f"[archive_agent] upload bytes: {af.filename} -> {len(data)}")
-            if data:
-                archive_blobs.append((af.filename, data))
-        except Exception as e:
-            print(f"[archive_agent] upload read error {getattr(af,'filename','<upload>')}: {e}")
-
-    archive_blobs += _collect_archive_blobs_from_urls(archive_urls)
-
-    if not archive_blobs:
-        print("[archive_agent] no archive payloads")
-        return {"csv": "", "pdf": "", "image": "", "html": "", "sql_parquet_json": ""}
-
     # 2) Extract safely, collect inner files by type
     all_csv:   List[StarletteUploadFile] = []
     all_pdf:   List[StarletteUploadFile] = []
@@ -99,15 +90,45 @@ async def archive_agent(
     total_unpacked = 0
     total_entries  = 0
 
+    def collect(out_path: str):
+        # inner files are handed to the agents as open file handles, not in-memory copies
+        ext  = os.path.splitext(out_path)[1].lower()
+        base = os.path.basename(out_path)
+        if ext in TABULAR_EXTS and len(all_csv) < MAX_PER_TYPE:
+            all_csv.append(_upload_from_path(base, out_path))
+        elif ext in PDF_EXTS and len(all_pdf) < MAX_PER_TYPE:
+            all_pdf.append(_upload_from_path(base, out_path))
+        elif ext in IMAGE_EXTS and len(all_image) < MAX_PER_TYPE:
+            all_image.append(_upload_from_path(base, out_path))
+        elif ext in HTML_EXTS and len(all_html) < MAX_PER_TYPE:
+            all_html.append(_upload_from_path(base, out_path))
+        elif ext in SQL_PARQUET_JSON_EXTS and len(all_sql_parquet_json) < MAX_PER_TYPE:
+            all_sql_parquet_json.append(_upload_from_path(base, out_path))
+
     with tempfile.TemporaryDirectory(prefix="arch_") as tdir:
         print(f"[archive_agent] tempdir={tdir}")
 
-        for name, blob in archive_blobs:
+        # 1) Gather archives as files on disk (uploads are spooled, URLs already are)
+        archive_paths: List[tuple[str, str]] = []
+        for af in archive_files:
+            try:
+                up_path = _safe_join(tdir, "_uploads", os.path.basename(af.filename) or "archive.bin")
+                size = await _spool_upload(af, up_path)
+                print(f"[archive_agent] upload bytes: {af.filename} -> {size}")
+                if size:
+                    archive_paths.append((af.filename, up_path))
+            except Exception as e:
+                print(f"[archive_agent] upload read error {getattr(af,'filename','<upload>')}: {e}")
+
+        archive_paths += await _collect_archive_paths_from_urls(archive_urls)
+
+        if not archive_paths:
+            print("[archive_agent] no archive payloads")
+            return {"csv": "", "pdf": "", "image": "", "html": "", "sql_parquet_json": ""}, {}
+
+        for name, arc_path in archive_paths:
             arc_lower = (name or "").lower()
-            arc_path = _safe_join(tdir, os.path.basename(name) or "archive.bin")
-            with open(arc_path, "wb") as f:
-                f.write(blob)
-            print(f"[archive_agent] wrote archive -> {arc_path} ({len(blob)} bytes)")
+            print(f"[archive_agent] archive -> {arc_path} ({os.path.getsize(arc_path)} bytes)")
 
             try:
                 if arc_lower.endswith(".zip"):
@@ -123,22 +144,9 @@ async def archive_agent(
                             out_path = _safe_join(tdir, zi.filename)
                             os.makedirs(os.path.dirname(out_path), exist_ok=True)
                             with zf.open(zi) as src, open(out_path, "wb") as dst:
-                                data = src.read()
-                                dst.write(data)
-                            total_unpacked += len(data)
-
-                            ext  = os.path.splitext(out_path)[1].lower()
-                            base = os.path.basename(out_path)
-                            if ext in TABULAR_EXTS and len(all_csv) < MAX_PER_TYPE:
-                                all_csv.append(_upload_from_bytes(base, data))
-                            elif ext in PDF_EXTS and len(all_pdf) < MAX_PER_TYPE:
-                                all_pdf.append(_upload_from_bytes(base, data))
-                            elif ext in IMAGE_EXTS and len(all_image) < MAX_PER_TYPE:
-                                all_image.append(_upload_from_bytes(base, data))
-                            elif ext in HTML_EXTS and len(all_html) < MAX_PER_TYPE:
-                                all_html.append(_upload_from_bytes(base, data))
-                            elif ext in SQL_PARQUET_JSON_EXTS and len(all_sql_parquet_json) < MAX_PER_TYPE:
-                                all_sql_parquet_json.append(_upload_from_bytes(base, data))
+                                shutil.copyfileobj(src, dst, COPY_CHUNK_BYTES)
+                                total_unpacked += dst.tell()
+                            collect(out_path)
 
                 elif arc_lower.endswith((".tar", ".tgz", ".tar.gz")):
                     mode = "r:gz" if arc_lower.endswith((".tgz", ".tar.gz")) else "r:"
@@ -151,23 +159,10 @@ async def archive_agent(
                                 continue
                             out_path = _safe_join(tdir, m.name)
                             os.makedirs(os.path.dirname(out_path), exist_ok=True)
-                            data = tf.extractfile(m).read()
-                            with open(out_path, "wb") as dst:
-                                dst.write(data)
-                            total_unpacked += len(data)
-
-                            ext  = os.path.splitext(out_path)[1].lower()
-                            base = os.path.basename(out_path)
-                            if ext in TABULAR_EXTS and len(all_csv) < MAX_PER_TYPE:
-                                all_csv.append(_upload_from_bytes(base, data))
-                            elif ext in PDF_EXTS and len(all_pdf) < MAX_PER_TYPE:
-                                all_pdf.append(_upload_from_bytes(base, data))
-                            elif ext in IMAGE_EXTS and len(all_image) < MAX_PER_TYPE:
-                                all_image.append(_upload_from_bytes(base, data))
-                            elif ext in HTML_EXTS and len(all_html) < MAX_PER_TYPE:
-                                all_html.append(_upload_from_bytes(base, data))
-                            elif ext in SQL_PARQUET_JSON_EXTS and len(all_sql_parquet_json) < MAX_PER_TYPE:
-                                all_sql_parquet_json.append(_upload_from_bytes(base, data))
+                            with tf.extractfile(m) as src, open(out_path, "wb") as dst:
+                                shutil.copyfileobj(src, dst, COPY_CHUNK_BYTES)
+                                total_unpacked += dst.tell()
+                            collect(out_path)
 
                 else:
                     print(f"[archive_agent] unsupported archive extension: {name}")
@@ -177,16 +172,15 @@ async def archive_agent(
         print(f"[archive_agent] extracted entries={total_entries}, bytes={total_unpacked}")
         print(f"[archive_agent] collected csv={len(all_csv)} pdf={len(all_pdf)} image={len(all_image)} html={len(all_html)} sql_parquet_json={len(all_sql_parquet_json)}")
 
-        # 3) Dispatch to existing agents, producing STRINGS ONLY
-        csv_text  = ""
-        pdf_text  = ""
-        image_text = ""
-        html_text = ""
-        sql_parquet_json_text = ""
+        # 3) Dispatch to existing agents concurrently, producing STRINGS ONLY
+        # inherit the request's task name so loop diagnostics attribute these stages to it
+        parent = asyncio.current_task()
+        parent_name = parent.get_name() if parent else ""
+        scheduler = StageScheduler(label=f"{parent_name}:archive" if parent_name.startswith("req:") else "archive_agent")
 
         # CSV/TSV/XLSX (Powerdrill path)
         if all_csv:
-            try:
+            async def csv():
                 csv_res = await csv_tsv_xlsx_agent(
                     task_description=task,
                     uploaded_files=all_csv,
@@ -194,30 +188,30 @@ async def archive_agent(
                 )
                 csv_text = _coerce_to_text(csv_res)
                 print(f"[archive_agent] CSV agent len={len(csv_text)}")
-            except Exception as e:
-                print(f"[archive_agent] CSV agent error: {e}")
+                return csv_text
+            scheduler.add("csv", csv)
 
         # PDFs (Claude path)
         if all_pdf:
-            try:
+            async def pdf():
                 pdf_res = await pdf_agent(pdf_files=all_pdf, pdf_urls=[], task=task)
                 pdf_text = _coerce_to_text(pdf_res)
                 print(f"[archive_agent] PDF agent len={len(pdf_text)}")
-            except Exception as e:
-                print(f"[archive_agent] PDF agent error: {e}")
+                return pdf_text
+            scheduler.add("pdf", pdf)
 
         # Images (Claude path)
         if all_image:
-            try:
+            async def image():
                 img_res = await image_agent(image_files=all_image, image_urls=[], task=task)
                 image_text = _coerce_to_text(img_res)
                 print(f"[archive_agent] IMAGE agent len={len(image_text)}")
-            except Exception as e:
-                print(f"[archive_agent] IMAGE agent error: {e}")
+                return image_text
+            scheduler.add("image", image)
 
         # HTML (your exact flow)
         if all_html:
-            try:
+            async def html():
                 print("[archive_agent] Processing HTML files (no URLs from archive)")
                 rendered_html_file = await render_html_file(all_html)
                 print("[archive_agent] Rendered HTML from files length:", len(rendered_html_file or ""))
@@ -225,18 +219,20 @@ async def archive_agent(
                 rendered_html_urls = ""  # archives won’t include URL links; keep for symmetry
                 full_html = (rendered_html_file or "") + (rendered_html_urls or "")
 
-                if full_html.strip():
-                    structured_html = await html_agent(full_html, task)
-                    html_text = _coerce_to_text(structured_html)
-                    print(f"[archive_agent] HTML agent len={len(html_text)}")
-            except Exception as e:
-                print(f"[archive_agent] HTML agent error: {e}")
+                if not full_html.strip():
+                    return ""
+                structured_html = await html_agent(full_html, task)
+                html_text = _coerce_to_text(structured_html)
+                print(f"[archive_agent] HTML agent len={len(html_text)}")
+                return html_text
+            scheduler.add("html", html)
+
         if all_sql_parquet_json:
-            persist_dir = os.path.join(SESSION_ROOT, req_id) 
-            db_files = [f for f in all_sql_parquet_json if f.filename.lower().endswith(".db", ".sqlite", ".sqlite3", ".duckdb")]
-            sql_files = [f for f in all_sql_parquet_json if f.filename.lower().endswith((".sql"))]
-            pj_files = [f for f in all_sql_parquet_json if f.filename.lower().endswith((".parquet", ".json"))]
-            try:
+            async def sql_parquet_json():
+                persist_dir = os.path.join(SESSION_ROOT, f"archive_{uuid.uuid4().hex}")
+                db_files = [f for f in all_sql_parquet_json if f.filename.lower().endswith((".db", ".sqlite", ".sqlite3", ".duckdb"))]
+                sql_files = [f for f in all_sql_parquet_json if f.filename.lower().endswith((".sql"))]
+                pj_files = [f for f in all_sql_parquet_json if f.filename.lower().endswith((".parquet", ".json"))]
                 ctx = await process_sql_parquet_json(
                 task="",                 # we pass it, but your agent will do the thinking later
                 db_files=db_files,
@@ -255,18 +251,28 @@ async def archive_agent(
                     session_db_path=ctx_json.get("session_db_path"),
                     sample_preview=ctx_json.get("tables")
                 )
-                exec_output = execute_llm_python(sql_query, session_db_path=ctx_json.get("session_db_path"))
+                exec_output = await execute_llm_python(sql_query, session_db_path=ctx_json.get("session_db_path"))
                 sql_parquet_json_text = _coerce_to_text(exec_output)
                 print(f"[archive_agent] SQL/Parquet/JSON agent len={len(sql_parquet_json_text)}")
-            except Exception as e:
-                print(f"[archive_agent] SQL/Parquet/JSON agent error: {e}")
+                return sql_parquet_json_text
+            scheduler.add("sql_parquet_json", sql_parquet_json)
+
+        try:
+            await scheduler.run()
+        finally:
+            for uf in all_csv + all_pdf + all_image + all_html + all_sql_parquet_json:
+                uf.file.close()
+        errors = {kind: f"{type(e).__name__}: {e}"[:300] for kind, e in scheduler.errors.items()}
+        if errors:
+            # the archive's answer is missing these kinds: return it, but do not cache it
+            mark_degraded("archive stages failed or cut off: " + ", ".join(sorted(errors)))
 
     # 4) Return strings ready for your contexts
     return {
-        "csv":   csv_text  or "",
-        "pdf":   pdf_text  or "",
-        "image": image_text or "",
-        "html":  html_text or "",
-        "sql_parquet_json": sql_parquet_json_text or ""
-    }
+        "csv":   scheduler.get("csv")  or "",
+        "pdf":   scheduler.get("pdf")  or "",
+        "image": scheduler.get("image") or "",
+        "html":  scheduler.get("html") or "",
+        "sql_parquet_json": scheduler.get("sql_parquet_json") or ""
+    }, errors
 
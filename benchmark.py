@@ -0,0 +1,599 @@
+"""
+End-to-end benchmark: replays the question*.txt workloads against the app.
+
+    python benchmark.py                                   # in-process, stub upstreams
+    python benchmark.py --concurrency 1,4,16 --requests 32 --upstream-latency-ms 300
+    python benchmark.py --target http://localhost:8000 --server-pid 1234
+    python benchmark.py --out bench.json --baseline bench_before.json
+
+Anthropic, OpenAI and Powerdrill are replaced by a local stand-in server with
+configurable latency, so runs measure our own pipeline. URLs in the questions are
+rewritten to synthetic fixtures served by the same stub, and files the questions
+name (PDF, XLSX, parquet, sqlite, zip, HTML, images) are generated and attached.
+
+For --target runs, start the server with the printed ANTHROPIC_BASE_URL /
+OPENAI_BASE_URL / POWERDRILL_BASE_URL pointing at the stub (--stub-only prints them
+and keeps the stub running).
+
+Upstream traffic goes through helper_cassette, so CASSETTE_MODE=record / replay
+(with a fixed --stub-port) also works here for fully offline, deterministic runs.
+"""
+import argparse
+import asyncio
+import datetime
+import glob
+import io
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# ---------- stand-in upstream servers ----------
+MASTER_CODE = """import json
+import pandas as pd
+df = pd.DataFrame({"x": range(50), "y": [v * 2 for v in range(50)]})
+print(json.dumps([str(len(df)), str(round(df["x"].corr(df["y"]), 3)), "stub answer"]))
+"""
+
+SQL_CODE = """import duckdb, json
+con = duckdb.connect(SESSION_DB_PATH, read_only=True)
+rows = con.execute("SELECT table_name FROM information_schema.tables ORDER BY 1 LIMIT 5").fetchall()
+print("| table |")
+print("|---|")
+for (t,) in rows:
+    print(f"| {t} |")
+"""
+
+
+def build_stub_app(latency_ms: float, jitter: float, fixtures_dir: str):
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import FileResponse, JSONResponse, Response
+    from starlette.routing import Route
+
+    async def delay():
+        if latency_ms > 0:
+            await asyncio.sleep(latency_ms / 1000.0 * random.uniform(1 - jitter, 1 + jitter))
+
+    async def anthropic_messages(request: Request):
+        body = await request.json()
+        await delay()
+        system = body.get("system") or ""
+        if not isinstance(system, str):
+            system = " ".join(b.get("text", "") for b in system if isinstance(b, dict))
+        text = MASTER_CODE if "Master Data Analyst" in system else "Stub specialist answer: the relevant values are 42 and 3.14."
+        return JSONResponse({
+            "id": "msg_stub", "type": "message", "role": "assistant", "model": body.get("model", "stub"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": len(json.dumps(body)) // 4, "output_tokens": len(text) // 4},
+        })
+
+    async def openai_chat(request: Request):
+        body = await request.json()
+        await delay()
+        return JSONResponse({
+            "id": "chatcmpl-stub", "object": "chat.completion", "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": SQL_CODE}}],
+            "usage": {"prompt_tokens": len(json.dumps(body)) // 4, "completion_tokens": len(SQL_CODE) // 4},
+        })
+
+    def pd_ok(data: dict) -> JSONResponse:
+        return JSONResponse({"code": 0, "data": data})
+
+    async def pd_upload(request: Request):
+        await request.body()
+        await delay()
+        return pd_ok({"file_object_key": f"obj_{random.getrandbits(32):x}"})
+
+    async def pd_dataset(request: Request):
+        await delay()
+        return pd_ok({"id": f"ds_{random.getrandbits(32):x}"})
+
+    async def pd_datasource(request: Request):
+        await delay()
+        return pd_ok({"id": f"src_{random.getrandbits(32):x}"})
+
+    async def pd_status(request: Request):
+        await delay()
+        return pd_ok({"syncedCount": 1, "invalidCount": 0, "synchingCount": 0})
+
+    async def pd_session(request: Request):
+        await delay()
+        return pd_ok({"id": f"sess_{random.getrandbits(32):x}"})
+
+    async def pd_job(request: Request):
+        await delay()
+        return pd_ok({"blocks": [{"type": "MESSAGE", "content": "Stub Powerdrill answer: total 1234.5"}]})
+
+    async def fixture(request: Request):
+        path = os.path.join(fixtures_dir, os.path.basename(request.path_params["name"]))
+        if not os.path.exists(path):
+            return Response(status_code=404)
+        return FileResponse(path)
+
+    return Starlette(routes=[
+        Route("/anthropic/v1/messages", anthropic_messages, methods=["POST"]),
+        Route("/openai/v1/chat/completions", openai_chat, methods=["POST"]),
+        Route("/powerdrill/v2/team/file/upload-datasource", pd_upload, methods=["POST"]),
+        Route("/powerdrill/v2/team/datasets", pd_dataset, methods=["POST"]),
+        Route("/powerdrill/v2/team/datasets/{id}/datasources", pd_datasource, methods=["POST"]),
+        Route("/powerdrill/v1/team/datasets/{id}/status", pd_status, methods=["GET"]),
+        Route("/powerdrill/v2/team/sessions", pd_session, methods=["POST"]),
+        Route("/powerdrill/v2/team/jobs", pd_job, methods=["POST"]),
+        Route("/fixtures/{name}", fixture, methods=["GET"]),
+    ])
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_stub_server(latency_ms: float, jitter: float, fixtures_dir: str, port: int = 0) -> str:
+    """Run the stand-in server on a background thread; returns its base URL."""
+    import uvicorn
+    port = port or _free_port()
+    config = uvicorn.Config(build_stub_app(latency_ms, jitter, fixtures_dir), host="127.0.0.1", port=port,
+                            log_level="warning", lifespan="off")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, name="bench-stub", daemon=True).start()
+    deadline = time.time() + 10
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("stub server did not start")
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def upstream_env(stub_url: str) -> Dict[str, str]:
+    return {
+        "ANTHROPIC_BASE_URL": f"{stub_url}/anthropic",
+        "ANTHROPIC_API_KEY": os.getenv("ANTHROPIC_API_KEY") or "bench",
+        "OPENAI_BASE_URL": f"{stub_url}/openai/v1",
+        "OPENAI_API_KEY_2": os.getenv("OPENAI_API_KEY_2") or "bench",
+        "POWERDRILL_BASE_URL": f"{stub_url}/powerdrill",
+        "POWERDRILL_KEY": os.getenv("POWERDRILL_KEY") or "bench",
+        "POWERDRILL_USER": os.getenv("POWERDRILL_USER") or "bench",
+    }
+
+
+# ---------- synthetic attachments ----------
+FIXED_TIME = datetime.datetime(2025, 1, 1)
+
+
+def build_fixtures(directory: str, rows: int = 2000) -> Dict[str, str]:
+    """
+    Generate one file per supported type; returns {kind: path}. Output is byte-for-byte
+    reproducible (no embedded timestamps) so recorded cassettes keep matching.
+    """
+    import sqlite3
+    import numpy as np
+    import pandas as pd
+    from PIL import Image, ImageDraw
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(7)
+    df = pd.DataFrame({
+        "sepal.length": rng.normal(5.8, 0.8, rows).round(1),
+        "sepal.width": rng.normal(3.0, 0.4, rows).round(1),
+        "petal.length": rng.normal(3.7, 1.7, rows).round(1),
+        "petal.width": rng.normal(1.2, 0.7, rows).round(1),
+        "variety": rng.choice(["Setosa", "Versicolor", "Virginica"], rows),
+    })
+    paths = {k: os.path.join(directory, n) for k, n in {
+        "csv": "iris.csv", "xlsx": "data.xlsx", "parquet": "iris.parquet", "json": "iris.json",
+        "db": "sakila.db", "html": "page.html", "png": "chart.png", "jpg": "photo.jpg",
+        "pdf": "report.pdf", "zip": "bundle.zip",
+    }.items()}
+
+    df.to_csv(paths["csv"], index=False)
+    with pd.ExcelWriter(paths["xlsx"]) as xw:
+        df.to_excel(xw, sheet_name="HELPER COST DATA", index=False)
+        df.describe().to_excel(xw, sheet_name="summary")
+    _pin_zip_timestamps(paths["xlsx"])
+    df.to_parquet(paths["parquet"], index=False)
+    df.head(500).to_json(paths["json"], orient="records")
+
+    if os.path.exists(paths["db"]):
+        os.remove(paths["db"])
+    with sqlite3.connect(paths["db"]) as cx:
+        for i, name in enumerate(("actor", "film", "rental")):
+            df.sample(frac=1 / (i + 1), random_state=i).to_sql(name, cx, index=False)
+
+    table_rows = "".join(f"<tr><td>{i + 1}</td><td>Film {i}</td><td>{2_000_000_000 - i * 7_000_000}</td><td>{1990 + i % 35}</td></tr>"
+                         for i in range(200))
+    with open(paths["html"], "w", encoding="utf-8") as f:
+        f.write("<html><head><title>Benchmark page</title></head><body><h1>Highest grossing</h1>"
+                f"<p>{'Synthetic paragraph text. ' * 50}</p>"
+                f"<table><tr><th>Rank</th><th>Title</th><th>Gross</th><th>Year</th></tr>{table_rows}</table></body></html>")
+
+    img = Image.new("RGB", (1600, 1000), "white")
+    draw = ImageDraw.Draw(img)
+    for i in range(12):
+        draw.rectangle([60 + i * 120, 900 - i * 60, 140 + i * 120, 900], fill=(30 + i * 18, 90, 200))
+        draw.text((60 + i * 120, 910), f"T{i}", fill="black")
+    img.save(paths["png"])
+    img.convert("RGB").save(paths["jpg"], quality=90)
+
+    import fitz  # PyMuPDF
+    doc = fitz.open()
+    for p in range(5):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Benchmark report page {p + 1}", fontsize=16)
+        y = 110
+        for line in df.head(40).to_string(index=False).splitlines():
+            page.insert_text((72, y), line, fontsize=8)
+            y += 11
+    doc.set_metadata({"creationDate": "D:20250101000000", "modDate": "D:20250101000000"})
+    doc.save(paths["pdf"], no_new_id=True)
+    doc.close()
+
+    with zipfile.ZipFile(paths["zip"], "w", zipfile.ZIP_DEFLATED) as zf:
+        for kind in ("jpg", "html", "pdf", "csv"):
+            zf.write(paths[kind], os.path.basename(paths[kind]))
+    _pin_zip_timestamps(paths["zip"])
+    return paths
+
+
+def _pin_zip_timestamps(path: str):
+    """Rewrite a zip (or OOXML) file with fixed entry dates and document timestamps."""
+    with zipfile.ZipFile(path) as zf:
+        entries = [(info.filename, zf.read(info)) for info in zf.infolist()]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in entries:
+            if name == "docProps/core.xml":
+                data = re.sub(rb"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ", FIXED_TIME.strftime("%Y-%m-%dT%H:%M:%SZ").encode(), data)
+            zf.writestr(zipfile.ZipInfo(name, FIXED_TIME.timetuple()[:6]), data, compress_type=zipfile.ZIP_DEFLATED)
+
+
+# ---------- workloads ----------
+ATTACH_EXTS = {
+    ".pdf": "pdf", ".xlsx": "xlsx", ".csv": "csv", ".parquet": "parquet", ".json": "json",
+    ".db": "db", ".sqlite": "db", ".zip": "zip", ".html": "html", ".png": "png", ".jpg": "jpg", ".jpeg": "jpg",
+}
+URL_RE = re.compile(r'https?://[^\s"\'>]+')
+FILENAME_RE = re.compile(r'([A-Za-z0-9_\-.]+\.(?:pdf|xlsx|csv|parquet|json|db|sqlite|zip|html|png|jpe?g))\b', re.I)
+
+
+def _fixture_for_url(url: str) -> str:
+    """Fixture kind served for an external URL: the file type it names (.db -> sakila.db, .zip -> bundle.zip), else a page."""
+    ext = os.path.splitext(url.split("?", 1)[0].rstrip(").,"))[1].lower()
+    return ATTACH_EXTS.get(ext, "html")
+
+
+def load_workloads(fixtures: Dict[str, str], stub_url: str, pattern: str) -> List[dict]:
+    """
+    Each question file becomes a workload: external URLs point at stub fixtures of the
+    same type, and every file name it mentions is attached as a synthetic file.
+    """
+    workloads = []
+    for qpath in sorted(glob.glob(os.path.join(REPO_DIR, pattern)), key=lambda p: int(re.sub(r"\D", "", os.path.basename(p)) or 0)):
+        with open(qpath, "r", encoding="utf-8") as f:
+            text = f.read()
+        text = URL_RE.sub(lambda m: f"{stub_url}/fixtures/{os.path.basename(fixtures[_fixture_for_url(m.group(0))])}", text)
+        without_urls = URL_RE.sub(" ", text)
+        attachments, seen = [], set()
+        for name in FILENAME_RE.findall(without_urls):
+            kind = ATTACH_EXTS.get(os.path.splitext(name)[1].lower())
+            if kind and name not in seen and name != "questions.txt":
+                seen.add(name)
+                attachments.append((name, fixtures[kind]))
+        workloads.append({"name": os.path.basename(qpath), "question": text, "attachments": attachments})
+    return workloads
+
+
+def _multipart(workload: dict) -> list:
+    files = [("questions.txt", ("questions.txt", workload["question"].encode("utf-8"), "text/plain"))]
+    for i, (name, path) in enumerate(workload["attachments"]):
+        with open(path, "rb") as f:
+            files.append((f"file{i}", (name, f.read(), "application/octet-stream")))
+    return files
+
+
+# ---------- resource sampling ----------
+def _children(pid: int) -> List[int]:
+    out = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                out.extend(int(c) for c in f.read().split())
+    except OSError:
+        pass
+    return out
+
+
+def _rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def tree_rss(pid: int) -> int:
+    """RSS of a process plus all its descendants (code workers, Chromium)."""
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        total += _rss_bytes(p)
+        stack.extend(_children(p))
+    return total
+
+
+class RssSampler:
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self.peak = tree_rss(self.pid)
+        self._thread = threading.Thread(target=self._run, name="bench-rss", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, tree_rss(self.pid))
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+# ---------- stats ----------
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    s = sorted(values)
+    k = (len(s) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+def _r(v: Optional[float], nd: int = 4) -> Optional[float]:
+    return None if v is None else round(v, nd)
+
+
+def parse_stage_sums(metrics_text: str) -> Dict[str, Tuple[float, int]]:
+    """{stage: (sum, count)} from a /metrics scrape."""
+    out: Dict[str, list] = {}
+    for line in metrics_text.splitlines():
+        m = re.match(r'pipeline_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)', line)
+        if m:
+            entry = out.setdefault(m.group(2), [0.0, 0])
+            entry[0 if m.group(1) == "sum" else 1] = float(m.group(3))
+    return {k: (v[0], int(v[1])) for k, v in out.items()}
+
+
+# ---------- driver ----------
+async def run_level(client: httpx.AsyncClient, workloads: List[dict], concurrency: int, total: int, timeout: float) -> dict:
+    sem = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def one(i: int):
+        wl = workloads[i % len(workloads)]
+        async with sem:
+            t0 = time.perf_counter()
+            ok, err = True, None
+            try:
+                # every iteration is a real run: no answer cache, no joining an identical in-flight request
+                r = await client.post("/api/", files=_multipart(wl), headers={"X-Force-Refresh": "1"}, timeout=timeout)
+                if r.status_code != 200:
+                    ok, err = False, f"HTTP {r.status_code}"
+                else:
+                    body = r.json()
+                    if isinstance(body, dict) and body.get("error"):
+                        ok, err = False, str(body["error"])
+            except Exception as e:
+                ok, err = False, f"{type(e).__name__}: {e}"
+            results.append({"workload": wl["name"], "seconds": time.perf_counter() - t0, "ok": ok, "error": err})
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    wall = time.perf_counter() - t0
+
+    lat = [r["seconds"] for r in results]
+    per_workload = {}
+    for r in results:
+        per_workload.setdefault(r["workload"], []).append(r["seconds"])
+    errors = [r for r in results if not r["ok"]]
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": len(errors),
+        "error_samples": sorted({f"{r['workload']}: {r['error']}"[:200] for r in errors})[:5],
+        "wall_seconds": _r(wall),
+        "throughput_rps": _r(total / wall if wall else 0.0),
+        "latency": {"p50": _r(percentile(lat, 0.5)), "p95": _r(percentile(lat, 0.95)),
+                    "p99": _r(percentile(lat, 0.99)), "max": _r(max(lat) if lat else None)},
+        "per_workload_p50": {k: _r(percentile(v, 0.5)) for k, v in sorted(per_workload.items())},
+    }
+
+
+def stage_stats_inprocess() -> Dict[str, dict]:
+    from helper_metrics import STAGE_SECONDS
+    out = {}
+    for (stage,), s in sorted(STAGE_SECONDS.snapshot().items()):
+        q = s["quantiles"]
+        out[stage] = {"count": s["count"], "mean": _r(s["sum"] / s["count"] if s["count"] else None),
+                      "p50": _r(q.get(0.5)), "p95": _r(q.get(0.95)), "p99": _r(q.get(0.99))}
+    return out
+
+
+def stage_stats_delta(before: Dict[str, Tuple[float, int]], after: Dict[str, Tuple[float, int]]) -> Dict[str, dict]:
+    out = {}
+    for stage, (s1, c1) in sorted(after.items()):
+        s0, c0 = before.get(stage, (0.0, 0))
+        if c1 > c0:
+            out[stage] = {"count": c1 - c0, "mean": _r((s1 - s0) / (c1 - c0))}
+    return out
+
+
+async def benchmark(args, workloads: List[dict]) -> List[dict]:
+    levels = []
+    if args.target:
+        pid = args.server_pid
+        client = httpx.AsyncClient(base_url=args.target.rstrip("/"))
+        app = None
+    else:
+        import main  # imported after the upstream env is set
+        from helper_metrics import STAGE_SECONDS
+        app = main.app
+        pid = os.getpid()
+        await app.router.startup()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+
+    try:
+        if args.warmup:
+            print(f"[bench] warmup: {args.warmup} request(s)")
+            await run_level(client, workloads, 1, args.warmup, args.timeout)
+        for c in args.concurrency:
+            total = args.requests or max(c * 2, len(workloads))
+            before = parse_stage_sums((await client.get("/metrics")).text) if args.target else None
+            if app is not None:
+                STAGE_SECONDS.reset()
+            sampler = RssSampler(pid) if pid else None
+            if sampler:
+                sampler.__enter__()
+            try:
+                level = await run_level(client, workloads, c, total, args.timeout)
+            finally:
+                if sampler:
+                    sampler.__exit__(None, None, None)
+            if app is not None:
+                level["stages"] = stage_stats_inprocess()
+            else:
+                level["stages"] = stage_stats_delta(before, parse_stage_sums((await client.get("/metrics")).text))
+            level["peak_rss_mb"] = round(sampler.peak / 2**20, 1) if sampler else None
+            levels.append(level)
+            lat = level["latency"]
+            print(f"[bench] c={c:<3} n={total:<4} rps={level['throughput_rps']:<8} p50={lat['p50']}s p99={lat['p99']}s "
+                  f"errors={level['errors']} peak_rss={level['peak_rss_mb']}MB")
+    finally:
+        await client.aclose()
+        if app is not None:
+            await app.router.shutdown()
+    return levels
+
+
+def compare(current: dict, baseline: dict):
+    base = {lv["concurrency"]: lv for lv in baseline.get("levels", [])}
+    print("\n[bench] vs baseline")
+    for lv in current["levels"]:
+        b = base.get(lv["concurrency"])
+        if not b:
+            continue
+        def pct(new, old):
+            return f"{(new - old) / old * 100:+.1f}%" if new is not None and old else "n/a"
+        print(f"  c={lv['concurrency']:<3} rps {pct(lv['throughput_rps'], b['throughput_rps'])}  "
+              f"p50 {pct(lv['latency']['p50'], b['latency']['p50'])}  p99 {pct(lv['latency']['p99'], b['latency']['p99'])}  "
+              f"rss {pct(lv['peak_rss_mb'], b.get('peak_rss_mb'))}")
+
+
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--target", help="benchmark a running server instead of the app in-process")
+    ap.add_argument("--server-pid", type=int, help="with --target: sample this process tree for peak RSS")
+    ap.add_argument("--concurrency", default="1,2,4,8", help="comma-separated concurrency levels")
+    ap.add_argument("--requests", type=int, default=0, help="requests per level (default: max(2*c, #workloads))")
+    ap.add_argument("--questions", default="question*.txt", help="glob of question files, relative to the repo")
+    ap.add_argument("--upstream-latency-ms", type=float, default=float(os.getenv("BENCH_UPSTREAM_LATENCY_MS", "250")))
+    ap.add_argument("--upstream-jitter", type=float, default=0.2, help="+/- fraction applied to the upstream latency")
+    ap.add_argument("--rows", type=int, default=2000, help="rows in the synthetic tabular fixtures")
+    ap.add_argument("--warmup", type=int, default=1)
+    ap.add_argument("--timeout", type=float, default=300)
+    ap.add_argument("--stub-port", type=int, default=0)
+    ap.add_argument("--stub-only", action="store_true", help="only run the stand-in upstreams (for --target servers)")
+    ap.add_argument("--out", help="write JSON results here")
+    ap.add_argument("--baseline", help="previous --out file to compare against")
+    args = ap.parse_args(argv)
+    args.concurrency = [int(c) for c in str(args.concurrency).split(",") if c.strip()]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(1)
+    fixtures_dir = tempfile.mkdtemp(prefix="bench_fixtures_")
+    fixtures = build_fixtures(fixtures_dir, rows=args.rows)
+    stub_url = start_stub_server(args.upstream_latency_ms, args.upstream_jitter, fixtures_dir, args.stub_port)
+    env = upstream_env(stub_url)
+
+    if args.stub_only:
+        for k, v in env.items():
+            print(f"export {k}={v}")
+        print(f"[bench] stub upstreams on {stub_url}; Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            return
+
+    if not args.target:
+        os.environ.update(env)
+        os.environ.setdefault("SESSION_ROOT", tempfile.mkdtemp(prefix="bench_session_"))
+        os.environ.setdefault("AGENT_CACHE_ENABLED", "0")  # measure the pipeline, not cache hits
+        os.environ.setdefault("HTTP_CACHE_ENABLED", "0")
+        os.environ.setdefault("ANSWER_CACHE_ENABLED", "0")
+        sys.path.insert(0, REPO_DIR)
+
+    workloads = load_workloads(fixtures, stub_url, args.questions)
+    if not workloads:
+        sys.exit(f"no question files match {args.questions}")
+    print(f"[bench] {len(workloads)} workloads, stub={stub_url}, upstream latency {args.upstream_latency_ms}ms, "
+          f"mode={'http ' + args.target if args.target else 'in-process'}")
+
+    levels = asyncio.run(benchmark(args, workloads))
+    result = {
+        "meta": {
+            "git_rev": _git_rev(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "mode": "http" if args.target else "in-process",
+            "target": args.target,
+            "python": sys.version.split()[0],
+            "cpu_count": os.cpu_count(),
+            "upstream_latency_ms": args.upstream_latency_ms,
+            "upstream_jitter": args.upstream_jitter,
+            "fixture_rows": args.rows,
+            "workloads": [{"name": w["name"], "attachments": [a for a, _ in w["attachments"]]} for w in workloads],
+        },
+        "levels": levels,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"[bench] wrote {args.out}")
+    else:
+        print(json.dumps(result, indent=2))
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
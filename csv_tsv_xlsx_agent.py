@@ -1,31 +1,38 @@
 import asyncio
 import os
-import requests
 from io import BytesIO
 from typing import List
 from fastapi import UploadFile
 from starlette.datastructures import UploadFile as StarletteUploadFile
 from dotenv import load_dotenv
 import time
+from helper_http import fetch_many
+from helper_cassette import upstream_client, UPSTREAM_TIMEOUT_SEC
+from helper_deadline import clamp
+from helper_cache import agent_cache, content_key, normalize_task
+from helper_metrics import span, timed
 
 load_dotenv()
 
 POWERDRILL_USERID = os.getenv("POWERDRILL_USER")
 POWERDRILL_KEY = os.getenv("POWERDRILL_KEY")
 
-BASE_URL = "https://ai.data.cloud/api/v2/team"
+# Override to point at a stand-in server (see benchmark.py)
+POWERDRILL_API_URL = os.getenv("POWERDRILL_BASE_URL", "https://ai.data.cloud/api").rstrip("/")
+
+BASE_URL = f"{POWERDRILL_API_URL}/v2/team"
 UPLOAD_URL = f"{BASE_URL}/file/upload-datasource"
 DATASET_URL = f"{BASE_URL}/datasets"
-SESSION_URL = "https://ai.data.cloud/api/v2/team/sessions"
+SESSION_URL = f"{BASE_URL}/sessions"
 JOB_URL = f"{BASE_URL}/jobs"
 
 
-def wait_for_dataset_synced(dataset_id: str, timeout_sec: int = 180, poll_every: float = 2.0) -> bool:
+async def wait_for_dataset_synced(dataset_id: str, timeout_sec: int = 180, poll_every: float = 2.0) -> bool:
     # PD exposes dataset status under v1
-    status_url = f"https://ai.data.cloud/api/v1/team/datasets/{dataset_id}/status"
+    status_url = f"{POWERDRILL_API_URL}/v1/team/datasets/{dataset_id}/status"
     start = time.time()
     while True:
-        r = requests.get(status_url, headers=headers)
+        r = await upstream_client().get(status_url, headers=headers, timeout=clamp(UPSTREAM_TIMEOUT_SEC))
         #print("Dataset status:", r.status_code, r.text)
         r.raise_for_status()
         js = r.json()
@@ -39,7 +46,8 @@ def wait_for_dataset_synced(dataset_id: str, timeout_sec: int = 180, poll_every:
         if time.time() - start > timeout_sec:
             #print("⏰ Timed out waiting for dataset sync.")
             return False
-        time.sleep(poll_every)
+        # stop polling once the request deadline is spent (clamp raises DeadlineExceeded)
+        await asyncio.sleep(clamp(poll_every))
 
 def extract_answer_and_sources(job_json: dict) -> dict:
     """
@@ -69,6 +77,7 @@ headers = {
     "x-pd-api-key": POWERDRILL_KEY,
 }
 
+@timed("csv_tsv_xlsx_agent")
 async def csv_tsv_xlsx_agent(
     task_description: str,
     uploaded_files: List[UploadFile] = [],
@@ -88,26 +97,31 @@ async def csv_tsv_xlsx_agent(
         content = await f.read()
         all_files.append((f.filename, content, f.content_type or "application/octet-stream"))
 
-    for url in file_urls:
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            filename = url.split("/")[-1]
-            content = response.content
-            all_files.append((filename, content, "application/octet-stream"))
-        except Exception as e:
-            print(f"Failed to download from {url}: {e}")
+    for r in await fetch_many(file_urls, label="csv_tsv_xlsx_agent"):
+        filename = r.url.split("/")[-1]
+        all_files.append((filename, r.read_bytes(), "application/octet-stream"))
 
     if not all_files:
         return "❌ No valid files provided."
 
+    # Same files + same task -> reuse the previous Powerdrill answer
+    cache_key = content_key(
+        "csv_tsv_xlsx_agent", normalize_task(task_description),
+        *[part for filename, content, _ in all_files for part in (filename, content)]
+    )
+    cached = await agent_cache.aget(cache_key)
+    if cached is not None:
+        print(f"[csv_tsv_xlsx_agent] cache hit {cache_key[-12:]}")
+        return cached
+
     # Step 2: Upload files and collect object keys
     for filename, content, content_type in all_files:
         #print(f"Uploading {filename} to Powerdrill...")
         try:
             payload = {"user_id": POWERDRILL_USERID}
             files = [('file', (filename, content, content_type))]
-            res = requests.post(UPLOAD_URL, headers=headers, data=payload, files=files)
+            with span("powerdrill:upload"):
+                res = await upstream_client().post(UPLOAD_URL, headers=headers, data=payload, files=files, timeout=clamp(UPSTREAM_TIMEOUT_SEC))
             #print("Upload Response:", res.status_code, res.text)
             res.raise_for_status()
             res_json = res.json()
@@ -127,7 +141,7 @@ async def csv_tsv_xlsx_agent(
             "name": dataset_name,
             "user_id": POWERDRILL_USERID
         }
-        dataset_res = requests.post(DATASET_URL, headers=headers, json=dataset_payload)
+        dataset_res = await upstream_client().post(DATASET_URL, headers=headers, json=dataset_payload, timeout=clamp(UPSTREAM_TIMEOUT_SEC))
         #print("Dataset creation response:", dataset_res.status_code, dataset_res.text)
         dataset_res.raise_for_status()
         dataset_id = dataset_res.json().get("data", {}).get("id")
@@ -144,14 +158,16 @@ async def csv_tsv_xlsx_agent(
                 "file_object_key": object_key
             }
             ds_url = f"{DATASET_URL}/{dataset_id}/datasources"
-            ds_res = requests.post(ds_url, headers=headers, json=source_payload)
+            ds_res = await upstream_client().post(ds_url, headers=headers, json=source_payload, timeout=clamp(UPSTREAM_TIMEOUT_SEC))
             #print(f"Data source creation for {filename}: {ds_res.status_code}, {ds_res.text}")
             ds_res.raise_for_status()
             datasource_id = ds_res.json().get("data", {}).get("id")
             datasource_ids.append(datasource_id)
         except Exception as e:
             print(f"❌ Data source creation failed for {filename}: {e}")
-    if not wait_for_dataset_synced(dataset_id):
+    with span("powerdrill:sync_wait"):
+        synced = await wait_for_dataset_synced(dataset_id)
+    if not synced:
         return "❌ Dataset did not finish syncing in time."
 
     if not datasource_ids:
@@ -168,7 +184,7 @@ async def csv_tsv_xlsx_agent(
             "user_id": POWERDRILL_USERID,
             "job_mode": "DATA_ANALYTICS"
         }
-        session_res = requests.post(SESSION_URL, headers=session_headers, json=session_payload)
+        session_res = await upstream_client().post(SESSION_URL, headers=session_headers, json=session_payload, timeout=clamp(UPSTREAM_TIMEOUT_SEC))
         #print("Session response:", session_res.status_code, session_res.text)
         session_res.raise_for_status()
         session_id = session_res.json().get("data", {}).get("id")
@@ -193,10 +209,13 @@ async def csv_tsv_xlsx_agent(
             "x-pd-api-key": POWERDRILL_KEY,
             "Content-Type": "application/json"
         }
-        job_res = requests.post(JOB_URL, headers=job_headers, json=job_payload)
+        with span("powerdrill:job"):
+            job_res = await upstream_client().post(JOB_URL, headers=job_headers, json=job_payload, timeout=clamp(300))
         #print("Job creation response:", job_res.status_code, job_res.text)
         job_res.raise_for_status()
         parsed = extract_answer_and_sources(job_res.json())
+        if parsed.get("answer"):
+            agent_cache.set(cache_key, parsed)
         return parsed
     except Exception as e:
         return f"❌ Job creation failed: {e}"
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Optional, Tuple
+from helper_metrics import Counter, Gauge, registry
+
+ADMISSION_CAPACITY     = int(os.getenv("ADMISSION_CAPACITY", "8"))         # cost units running at once
+ADMISSION_MAX_WAITING  = int(os.getenv("ADMISSION_MAX_WAITING", "16"))     # requests allowed to queue for capacity
+ADMISSION_MAX_WAIT_SEC = float(os.getenv("ADMISSION_MAX_WAIT_SEC", "30"))  # synchronous callers give up after this
+ADMISSION_DEFAULT_RETRY_SEC = float(os.getenv("ADMISSION_DEFAULT_RETRY_SEC", "10"))
+
+# Relative cost of one input of each kind (see main.classify_inputs); a bare question costs BASE_COST
+BASE_COST = 1
+INPUT_COSTS = {
+    "html_urls": 3,            # Chromium page + LLM
+    "html_files": 1,
+    "archive_files": 3,        # fans out into every other agent
+    "archive_urls": 3,
+    "pdf_files": 1, "pdf_urls": 1,
+    "csv_tsv_xlsx_files": 2,   # Powerdrill upload + sync polling
+    "csv_tsv_xlsx_urls": 2,
+    "image_files": 1, "image_urls": 1,
+    "db_files": 2, "db_urls": 2, "sql_files": 1, "sql_urls": 1,
+    "pj_files": 2, "pj_urls": 2,
+}
+
+ADMISSION_DECISIONS = registry.register(Counter(
+    "admission_decisions_total", "Admission outcomes", ("outcome",)))
+ADMISSION_IN_FLIGHT = registry.register(Gauge(
+    "admission_in_flight_cost", "Cost units currently admitted"))
+ADMISSION_WAITING = registry.register(Gauge(
+    "admission_waiting", "Requests waiting for capacity"))
+
+
+class Overloaded(Exception):
+    """Raised instead of admitting work; maps to a 429/503 with Retry-After."""
+    def __init__(self, status_code: int, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def estimate_cost(inputs: dict) -> int:
+    return BASE_COST + sum(INPUT_COSTS.get(k, 1) * len(v or []) for k, v in inputs.items())
+
+
+class AdmissionController:
+    """
+    Cost-weighted admission: at most `capacity` units run at once, at most `max_waiting`
+    requests queue (FIFO) for capacity, and waiters give up at their deadline. A request
+    larger than the whole capacity is admitted alone rather than starved.
+    """
+    def __init__(self, capacity: int = ADMISSION_CAPACITY, max_waiting: int = ADMISSION_MAX_WAITING):
+        self.capacity = max(1, capacity)
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self._sec_per_unit = ADMISSION_DEFAULT_RETRY_SEC  # EWMA of run time per cost unit
+        self.stats = {"admitted": 0, "rejected_queue_full": 0, "rejected_deadline": 0}
+
+    def _fits(self, cost: int) -> bool:
+        return self.in_flight == 0 or self.in_flight + cost <= self.capacity
+
+    def retry_after(self, extra_cost: int = 0) -> int:
+        backlog = self.in_flight + sum(c for c, _ in self._waiters) + extra_cost
+        est = self._sec_per_unit * backlog / self.capacity
+        return int(min(300, max(1, round(est))))
+
+    def precheck(self, cost: int, queued_elsewhere: int = 0):
+        """
+        Fail fast (429) when the wait queue is already full; call before accepting work.
+        `queued_elsewhere` counts requests accepted but not yet at this gate (e.g. the job queue).
+        """
+        waiting = len(self._waiters) + queued_elsewhere
+        if (not self._fits(cost) or waiting) and waiting >= self.max_waiting:
+            self.stats["rejected_queue_full"] += 1
+            ADMISSION_DECISIONS.inc(outcome="rejected_queue_full")
+            raise Overloaded(429, self.retry_after(cost), f"{waiting} requests already waiting")
+
+    async def acquire(self, cost: int, deadline: Optional[float] = None):
+        cost = min(max(1, cost), self.capacity)
+        if self._fits(cost) and not self._waiters:
+            self._admit(cost)
+            return cost
+        # no precheck here: callers run it when accepting the request, before any work is queued
+        fut = asyncio.get_running_loop().create_future()
+        entry = (cost, fut)
+        self._waiters.append(entry)
+        ADMISSION_WAITING.inc()
+        try:
+            timeout = None if deadline is None else max(0.0, deadline - time.time())
+            await asyncio.wait_for(asyncio.shield(fut), timeout)
+            return cost
+        except asyncio.TimeoutError:
+            if fut.done():
+                return cost  # admitted just as the deadline passed
+            self._waiters.remove(entry)
+            self._wake()
+            self.stats["rejected_deadline"] += 1
+            ADMISSION_DECISIONS.inc(outcome="rejected_deadline")
+            raise Overloaded(503, self.retry_after(cost), "timed out waiting for capacity")
+        except BaseException:
+            # cancelled while waiting: give back units we may have just been granted
+            if fut.done():
+                self.release(cost, 0.0)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                self._wake()
+            raise
+        finally:
+            ADMISSION_WAITING.dec()
+
+    def _admit(self, cost: int):
+        self.in_flight += cost
+        self.stats["admitted"] += 1
+        ADMISSION_DECISIONS.inc(outcome="admitted")
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+
+    def release(self, cost: int, run_sec: float):
+        self.in_flight = max(0, self.in_flight - cost)
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+        if run_sec > 0:
+            self._sec_per_unit = 0.8 * self._sec_per_unit + 0.2 * (run_sec / cost)
+        self._wake()
+
+    def _wake(self):
+        # strict FIFO: a large request at the head is not overtaken by small ones behind it
+        while self._waiters and self._fits(self._waiters[0][0]):
+            cost, fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self._admit(cost)
+            fut.set_result(True)
+
+    @asynccontextmanager
+    async def slot(self, cost: int, deadline: Optional[float] = None):
+        cost = await self.acquire(cost, deadline)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(cost, time.perf_counter() - t0)
+
+    def snapshot(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "in_flight_cost": self.in_flight,
+            "waiting": len(self._waiters),
+            "max_waiting": self.max_waiting,
+            "sec_per_cost_unit": round(self._sec_per_unit, 3),
+            "retry_after_sec": self.retry_after(),
+            **self.stats,
+        }
+
+
+admission = AdmissionController()
@@ -0,0 +1,122 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from playwright.async_api import async_playwright, Browser, BrowserContext
+
+BROWSER_POOL_SIZE       = int(os.getenv("BROWSER_POOL_SIZE", "2"))        # Chromium processes kept warm
+BROWSER_MAX_PAGES       = int(os.getenv("BROWSER_MAX_PAGES", "200"))      # recycle a browser after this many pages
+HTML_RENDER_CONCURRENCY = int(os.getenv("HTML_RENDER_CONCURRENCY", "4"))  # open pages across the whole process
+
+
+class _Slot:
+    def __init__(self, browser: Browser):
+        self.browser = browser
+        self.pages = 0        # pages opened over the browser's lifetime
+        self.active = 0       # contexts currently leased
+        self.retiring = False # no new leases; closed once active drops to 0
+
+
+class BrowserPool:
+    """
+    Process-lifetime pool of headless Chromium browsers.
+    - start() launches `size` browsers once (called at app startup, or lazily on first use)
+    - context() leases a fresh, isolated BrowserContext on the least busy browser
+    - page_slots caps concurrently open pages across all requests
+    - browsers are recycled after `max_pages` pages or when they disconnect (crash)
+    """
+    def __init__(self, size: int = BROWSER_POOL_SIZE, max_pages: int = BROWSER_MAX_PAGES,
+                 page_concurrency: int = HTML_RENDER_CONCURRENCY):
+        self.size = max(1, size)
+        self.max_pages = max(1, max_pages)
+        self.page_slots = asyncio.Semaphore(max(1, page_concurrency))
+        self._slots: List[_Slot] = []
+        self._pw = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._lock:
+            if self._pw is not None:
+                return
+            self._pw = await async_playwright().start()
+            for _ in range(self.size):
+                self._slots.append(await self._launch())
+            print(f"[browser_pool] started {self.size} browser(s), max_pages={self.max_pages}")
+
+    async def stop(self):
+        async with self._lock:
+            for slot in self._slots:
+                await self._close(slot)
+            self._slots = []
+            if self._pw is not None:
+                try:
+                    await self._pw.stop()
+                except Exception:
+                    pass
+                self._pw = None
+
+    async def _launch(self) -> _Slot:
+        browser = await self._pw.chromium.launch(headless=True)
+        slot = _Slot(browser)
+        browser.on("disconnected", lambda _b: self._mark_dead(slot))
+        return slot
+
+    def _mark_dead(self, slot: _Slot):
+        if not slot.retiring:
+            print(f"[browser_pool] browser disconnected after {slot.pages} pages; will be replaced")
+        slot.retiring = True
+
+    async def _close(self, slot: _Slot):
+        try:
+            await slot.browser.close()
+        except Exception:
+            pass
+
+    async def _acquire_slot(self) -> _Slot:
+        if self._pw is None:
+            await self.start()
+        async with self._lock:
+            # drop drained retiring browsers, then top the pool back up
+            for slot in [s for s in self._slots if s.retiring and s.active == 0]:
+                self._slots.remove(slot)
+                await self._close(slot)
+            healthy = [s for s in self._slots if not s.retiring and s.browser.is_connected()]
+            while len(healthy) < self.size:
+                slot = await self._launch()
+                self._slots.append(slot)
+                healthy.append(slot)
+            slot = min(healthy, key=lambda s: s.active)
+            slot.active += 1
+            return slot
+
+    async def _release_slot(self, slot: _Slot):
+        async with self._lock:
+            slot.active -= 1
+            if slot.retiring and slot.active == 0 and slot in self._slots:
+                self._slots.remove(slot)
+                await self._close(slot)
+
+    def _count_page(self, slot: _Slot):
+        slot.pages += 1
+        if slot.pages >= self.max_pages and not slot.retiring:
+            print(f"[browser_pool] recycling browser after {slot.pages} pages")
+            slot.retiring = True
+
+    @asynccontextmanager
+    async def context(self, **context_kwargs):
+        slot = await self._acquire_slot()
+        ctx: Optional[BrowserContext] = None
+        try:
+            ctx = await slot.browser.new_context(**context_kwargs)
+            ctx.on("page", lambda _p: self._count_page(slot))
+            yield ctx
+        finally:
+            if ctx is not None:
+                try:
+                    await ctx.close()
+                except Exception:
+                    pass
+            await self._release_slot(slot)
+
+
+browser_pool = BrowserPool()
@@ -0,0 +1,250 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+SESSION_ROOT = os.getenv("SESSION_ROOT", "/data/_session_sql")
+
+CACHE_ENABLED        = os.getenv("AGENT_CACHE_ENABLED", "1") != "0"
+CACHE_DIR            = os.getenv("AGENT_CACHE_DIR", os.path.join(SESSION_ROOT, "_agent_cache"))
+CACHE_TTL_SEC        = float(os.getenv("AGENT_CACHE_TTL_SEC", str(24 * 3600)))
+CACHE_MEM_ITEMS      = int(os.getenv("AGENT_CACHE_MEM_ITEMS", "256"))
+CACHE_DISK_MAX_BYTES = int(os.getenv("AGENT_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Whole answers keyed by request fingerprint (see helper_jobs.request_fingerprint)
+ANSWER_CACHE_ENABLED        = os.getenv("ANSWER_CACHE_ENABLED", "1") != "0"
+ANSWER_CACHE_DIR            = os.getenv("ANSWER_CACHE_DIR", os.path.join(SESSION_ROOT, "_answer_cache"))
+ANSWER_CACHE_TTL_SEC        = float(os.getenv("ANSWER_CACHE_TTL_SEC", "900"))
+ANSWER_CACHE_MEM_ITEMS      = int(os.getenv("ANSWER_CACHE_MEM_ITEMS", "128"))
+ANSWER_CACHE_DISK_MAX_BYTES = int(os.getenv("ANSWER_CACHE_DISK_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_MISSING = object()
+
+
+def normalize_task(task: str) -> str:
+    """Collapse whitespace so trivially re-formatted questions share a key."""
+    return re.sub(r"\s+", " ", (task or "")).strip()
+
+
+def content_key(namespace: str, *parts: Any) -> str:
+    """
+    SHA-256 over the namespace and every part in order.
+    bytes are hashed raw, str/others via UTF-8 (dicts/lists as sorted JSON).
+    """
+    h = hashlib.sha256(namespace.encode("utf-8"))
+    for p in parts:
+        if isinstance(p, (bytes, bytearray, memoryview)):
+            chunk = bytes(p)
+        elif isinstance(p, str):
+            chunk = p.encode("utf-8")
+        else:
+            chunk = json.dumps(p, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        h.update(len(chunk).to_bytes(8, "big"))
+        h.update(chunk)
+    return f"{namespace}-{h.hexdigest()}"
+
+
+class AgentCache:
+    """
+    Two-tier cache for specialist agent outputs (values must be JSON-serializable).
+    - memory: LRU bounded by item count
+    - disk:   one JSON file per key under `directory`, bounded by total bytes (oldest evicted first);
+              the tier's size is tracked incrementally (one directory scan per process)
+    Both tiers honour the same TTL. On the event loop use `aget` (disk reads run in a thread);
+    `set` stores in memory at once and writes the disk tier from a thread when a loop is running.
+    """
+    def __init__(self, directory: str, ttl_sec: float, mem_items: int, disk_max_bytes: int, enabled: bool = True):
+        self.directory = directory
+        self.ttl_sec = ttl_sec
+        self.mem_items = mem_items
+        self.disk_max_bytes = disk_max_bytes
+        self.enabled = enabled
+        self._mem: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._disk: "OrderedDict[str, int]" = OrderedDict()   # path -> size, least recently written first
+        self._disk_bytes = 0
+        self._disk_indexed = False
+        self._lock = threading.Lock()
+        self.stats = {"hits_mem": 0, "hits_disk": 0, "misses": 0, "sets": 0, "evictions_mem": 0, "evictions_disk": 0}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[-2:], f"{key}.json")
+
+    def _fresh(self, stored_at: float) -> bool:
+        return (time.time() - stored_at) <= self.ttl_sec
+
+    def _mem_get(self, key: str) -> Any:
+        with self._lock:
+            hit = self._mem.get(key, _MISSING)
+            if hit is not _MISSING:
+                stored_at, value = hit
+                if self._fresh(stored_at):
+                    self._mem.move_to_end(key)
+                    self.stats["hits_mem"] += 1
+                    return value
+                del self._mem[key]
+        return _MISSING
+
+    def _disk_get(self, key: str) -> Any:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                rec = json.load(f)
+            if self._fresh(rec["stored_at"]):
+                self._remember(key, rec["stored_at"], rec["value"])
+                with self._lock:
+                    self.stats["hits_disk"] += 1
+                return rec["value"]
+            os.remove(path)
+            self._forget(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[agent_cache] unreadable entry {key}: {e}")
+        with self._lock:
+            self.stats["misses"] += 1
+        return _MISSING
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Blocking lookup (disk read inline); use `aget` on the event loop."""
+        if not self.enabled:
+            return default
+        value = self._mem_get(key)
+        if value is _MISSING:
+            value = self._disk_get(key)
+        return default if value is _MISSING else value
+
+    async def aget(self, key: str, default: Any = None) -> Any:
+        if not self.enabled:
+            return default
+        value = self._mem_get(key)
+        if value is _MISSING:
+            value = await asyncio.to_thread(self._disk_get, key)
+        return default if value is _MISSING else value
+
+    async def get_routed(self, route, key: Callable[[str], str]) -> Tuple[Any, Dict[str, str]]:
+        """
+        Lookup for a routed LLM call (helper_model_router.Route). Answers are cached under the model
+        that produced them (routed_with_model), so the routed model's key is tried, then its
+        escalation's. Returns (cached value or None, {model: key}); store new answers under
+        keys[answered_by].
+        """
+        keys = {m: key(m) for m in route.models()}
+        for k in keys.values():
+            value = await self.aget(k)
+            if value is not None:
+                return value, keys
+        return None, keys
+
+    def set(self, key: str, value: Any) -> None:
+        if not self.enabled:
+            return
+        stored_at = time.time()
+        self._remember(key, stored_at, value)
+        with self._lock:
+            self.stats["sets"] += 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None:
+            self._write(key, stored_at, value)
+        else:
+            loop.run_in_executor(None, self._write, key, stored_at, value)
+
+    def _write(self, key: str, stored_at: float, value: Any) -> None:
+        path = self._path(key)
+        try:
+            self._index_disk()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"stored_at": stored_at, "value": value}, f, ensure_ascii=False)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+            with self._lock:
+                self._disk_bytes += size - self._disk.pop(path, 0)
+                self._disk[path] = size
+            self._evict_disk()
+        except Exception as e:
+            print(f"[agent_cache] disk write failed for {key}: {e}")
+
+    def _remember(self, key: str, stored_at: float, value: Any) -> None:
+        with self._lock:
+            self._mem[key] = (stored_at, value)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.mem_items:
+                self._mem.popitem(last=False)
+                self.stats["evictions_mem"] += 1
+
+    def _forget(self, path: str) -> None:
+        with self._lock:
+            self._disk_bytes -= self._disk.pop(path, 0)
+
+    def _index_disk(self) -> None:
+        """Size the disk tier once (entries left by earlier processes); later writes keep it current."""
+        if self._disk_indexed:
+            return
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for fn in files:
+                if fn.endswith(".json"):
+                    p = os.path.join(root, fn)
+                    try:
+                        st = os.stat(p)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        with self._lock:
+            if self._disk_indexed:
+                return
+            for _, size, p in entries:
+                if p not in self._disk:
+                    self._disk[p] = size
+                    self._disk_bytes += size
+                    self._disk.move_to_end(p, last=False)   # older than anything written meanwhile
+            self._disk_indexed = True
+
+    def _evict_disk(self) -> None:
+        while True:
+            with self._lock:
+                if self._disk_bytes <= self.disk_max_bytes or not self._disk:
+                    return
+                p, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self.stats["evictions_disk"] += 1
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            out = dict(self.stats)
+            out["mem_items"] = len(self._mem)
+            out["disk_bytes"] = self._disk_bytes
+        lookups = out["hits_mem"] + out["hits_disk"] + out["misses"]
+        out["hit_rate"] = round((out["hits_mem"] + out["hits_disk"]) / lookups, 4) if lookups else 0.0
+        return out
+
+
+agent_cache = AgentCache(
+    directory=CACHE_DIR,
+    ttl_sec=CACHE_TTL_SEC,
+    mem_items=CACHE_MEM_ITEMS,
+    disk_max_bytes=CACHE_DISK_MAX_BYTES,
+    enabled=CACHE_ENABLED,
+)
+
+answer_cache = AgentCache(
+    directory=ANSWER_CACHE_DIR,
+    ttl_sec=ANSWER_CACHE_TTL_SEC,
+    mem_items=ANSWER_CACHE_MEM_ITEMS,
+    disk_max_bytes=ANSWER_CACHE_DISK_MAX_BYTES,
+    enabled=ANSWER_CACHE_ENABLED,
+)
@@ -0,0 +1,190 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode
+import httpx
+from helper_metrics import Counter, registry
+
+SESSION_ROOT = os.getenv("SESSION_ROOT", "/data/_session_sql")
+
+# off/passthrough: straight to the network; record: network + save; replay: saved responses only
+CASSETTE_MODE       = os.getenv("CASSETTE_MODE", "off").lower()
+CASSETTE_DIR        = os.getenv("CASSETTE_DIR", os.path.join(SESSION_ROOT, "_cassettes"))
+CASSETTE_ON_MISS    = os.getenv("CASSETTE_ON_MISS", "error").lower()   # replay miss: "error" or "passthrough"
+CASSETTE_LATENCY_MS = os.getenv("CASSETTE_LATENCY_MS", "0")            # replay delay: ms, or "recorded"
+UPSTREAM_TIMEOUT_SEC = float(os.getenv("UPSTREAM_TIMEOUT_SEC", "120"))
+
+CASSETTE_EVENTS = registry.register(Counter(
+    "upstream_cassette_events_total", "Cassette lookups by outcome", ("mode", "event")))
+
+# Request headers that change between runs or carry secrets; never part of the key
+_VOLATILE_HEADERS = {"authorization", "x-api-key", "x-pd-api-key", "user-agent", "content-length",
+                     "x-stainless-retry-count", "x-stainless-read-timeout", "x-stainless-timeout"}
+# Per-request ids and paths (uuid4().hex session dirs, archive_<uuid>, ...) that leak into prompts
+_VOLATILE_RE = re.compile(r"[0-9a-f]{32}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+# Transient statuses (timeout, conflict, rate limit, server errors) are never recorded: replaying one
+# would turn a blip during recording into a permanent failure. Other 4xx are deterministic and kept.
+_TRANSIENT_STATUSES = {408, 409, 429}
+# Response headers that no longer apply once the body is stored decoded
+_DROP_RESPONSE_HEADERS = {"content-encoding", "transfer-encoding", "content-length", "connection", "date"}
+
+
+class CassetteMiss(Exception):
+    pass
+
+
+def _normalize_body(request: httpx.Request) -> bytes:
+    body = request.content or b""
+    ctype = request.headers.get("content-type", "")
+    if "json" in ctype:
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":")).encode("utf-8")
+        except ValueError:
+            pass
+    elif "multipart/form-data" in ctype:
+        m = re.search(r"boundary=([^;]+)", ctype)
+        if m:
+            body = body.replace(m.group(1).strip('"').encode("latin-1"), b"BOUNDARY")
+    text = body.decode("latin-1").replace(SESSION_ROOT, "<session_root>")
+    return _VOLATILE_RE.sub("<id>", text).encode("latin-1")
+
+
+def fingerprint(request: httpx.Request) -> str:
+    """Stable key for a request: method, URL (sorted query), relevant headers and normalized body."""
+    url = request.url
+    query = urlencode(sorted(parse_qsl(url.query.decode("ascii") if isinstance(url.query, bytes) else url.query)))
+    headers = sorted((k.lower(), v) for k, v in request.headers.items()
+                     if k.lower() not in _VOLATILE_HEADERS and not k.lower().startswith("x-stainless")
+                     and k.lower() != "content-type")
+    h = hashlib.sha256()
+    for part in (request.method, f"{url.scheme}://{url.host}{url.path}", query, json.dumps(headers)):
+        h.update(part.encode("utf-8") + b"\0")
+    h.update(_normalize_body(request))
+    return h.hexdigest()
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport that records upstream request/response pairs to disk and replays
+    them by fingerprint, so the pipeline can be profiled offline with deterministic,
+    zero-latency (or injected-latency) upstreams.
+    """
+    def __init__(self, inner: Optional[httpx.AsyncBaseTransport] = None, mode: str = CASSETTE_MODE,
+                 directory: str = CASSETTE_DIR, on_miss: str = CASSETTE_ON_MISS, latency_ms: str = CASSETTE_LATENCY_MS):
+        self.inner = inner or httpx.AsyncHTTPTransport(retries=0)
+        self.mode = mode
+        self.directory = directory
+        self.on_miss = on_miss
+        self.latency_ms = latency_ms
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self.mode not in ("record", "replay"):
+            return await self.inner.handle_async_request(request)
+
+        key = fingerprint(request)
+        if self.mode == "replay":
+            entry = self._load(key)
+            if entry is not None:
+                CASSETTE_EVENTS.inc(mode="replay", event="hit")
+                await self._delay(entry)
+                return self._response(entry, request)
+            CASSETTE_EVENTS.inc(mode="replay", event="miss")
+            if self.on_miss != "passthrough":
+                raise CassetteMiss(f"no cassette for {request.method} {request.url} (key {key[:12]})")
+            return await self.inner.handle_async_request(request)
+
+        t0 = time.perf_counter()
+        response = await self.inner.handle_async_request(request)
+        body = await response.aread()
+        await response.aclose()
+        entry = {
+            "request": {"method": request.method, "url": str(request.url.copy_with(query=None))},
+            "status": response.status_code,
+            "headers": [(k, v) for k, v in response.headers.items() if k.lower() not in _DROP_RESPONSE_HEADERS],
+            "body_b64": base64.b64encode(body).decode("ascii"),
+            "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1),
+            "recorded_at": int(time.time()),
+        }
+        if response.status_code < 500 and response.status_code not in _TRANSIENT_STATUSES:
+            self._save(key, entry)
+            CASSETTE_EVENTS.inc(mode="record", event="saved")
+        else:
+            CASSETTE_EVENTS.inc(mode="record", event="skipped_transient")
+        return self._response(entry, request)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+    def _load(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"[cassette] unreadable entry {key[:12]}: {e}")
+            return None
+
+    def _save(self, key: str, entry: dict):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"[cassette] write failed for {key[:12]}: {e}")
+
+    async def _delay(self, entry: dict):
+        if self.latency_ms == "recorded":
+            ms = float(entry.get("elapsed_ms") or 0)
+        else:
+            try:
+                ms = float(self.latency_ms)
+            except ValueError:
+                ms = 0.0
+        if ms > 0:
+            await asyncio.sleep(ms / 1000.0)
+
+    @staticmethod
+    def _response(entry: dict, request: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            status_code=entry["status"],
+            headers=entry["headers"],
+            content=base64.b64decode(entry["body_b64"]),
+            request=request,
+        )
+
+
+_upstream_client: Optional[httpx.AsyncClient] = None
+
+
+def upstream_client() -> httpx.AsyncClient:
+    """
+    Shared client for LLM and Powerdrill APIs; every upstream call goes through the
+    cassette transport (a plain pass-through unless CASSETTE_MODE is record/replay).
+    """
+    global _upstream_client
+    if _upstream_client is None or _upstream_client.is_closed:
+        _upstream_client = httpx.AsyncClient(
+            transport=CassetteTransport(),
+            timeout=UPSTREAM_TIMEOUT_SEC,
+            follow_redirects=True,
+        )
+    return _upstream_client
+
+
+async def close_upstream_client():
+    global _upstream_client
+    if _upstream_client is not None:
+        await _upstream_client.aclose()
+        _upstream_client = None
@@ -1,6 +1,5 @@
 import re
-import pandas as pd
-import json
+from helper_context_encoding import encode_context
 # === Code cleaning ===
 def clean_code(code: str) -> str:
     """
@@ -27,8 +26,6 @@ def clean_url(u: str) -> str:
 
 
 
-def ensure_str(data):
-    if isinstance(data, (dict, list)):
-        # Pretty JSON so it stays easily readable for the LLM
-        return json.dumps(data, ensure_ascii=False, indent=2)
-    return str(data)  # for markdown, plain text, etc.
\ No newline at end of file
+def ensure_str(data, kind: str = "generic"):
+    # Compact tables / key-value lines instead of pretty JSON: same content, fewer prompt tokens
+    return encode_context(data, kind)
\ No newline at end of file
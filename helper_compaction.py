@@ -0,0 +1,241 @@
+import math
+import os
+import re
+from collections import Counter as TermCounter
+from typing import Dict, List, Optional, Tuple
+from helper_metrics import Counter, Histogram, registry
+
+CONTEXT_COMPACTION_ENABLED = os.getenv("CONTEXT_COMPACTION_ENABLED", "1") != "0"
+# Specialist context (all agents together) above this many tokens is ranked and packed down to it
+CONTEXT_BUDGET_TOKENS = int(os.getenv("CONTEXT_BUDGET_TOKENS", "12000"))
+CONTEXT_CHUNK_CHARS   = int(os.getenv("CONTEXT_CHUNK_CHARS", "800"))
+CONTEXT_TABLE_ROWS    = int(os.getenv("CONTEXT_TABLE_ROWS", "25"))      # rows per table chunk (header repeated)
+CHARS_PER_TOKEN       = float(os.getenv("LLM_CHARS_PER_TOKEN", "4"))
+
+BM25_K1, BM25_B = 1.5, 0.75
+
+COMPACTIONS = registry.register(Counter(
+    "context_compactions_total", "Master-prompt context compaction runs (compacted, under_budget, disabled)", ("outcome",)))
+COMPACTION_KEPT = registry.register(Histogram(
+    "context_compaction_kept_ratio", "Fraction of specialist context chars kept by compaction", (),
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.9, 1.0)))
+
+_STOPWORDS = frozenset("""
+a an the and or of to in on at for from by with as is are was were be been being it its this that these those
+what which who whom whose when where why how do does did can could should would will shall may might must
+i you he she we they me him her us them my your our their there here than then so if not no yes all any each
+into over under about between per vs via give return answer question questions following json array object
+""".split())
+
+_WORD = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+_NUMBER = re.compile(r"(?<![\w.])[-+]?\$?\d[\d,]*(?:\.\d+)?%?")
+
+
+def _terms(text: str) -> List[str]:
+    out = []
+    for w in _WORD.findall(text.lower()):
+        if w in _STOPWORDS or len(w) < 2:
+            continue
+        if len(w) > 3 and w.endswith("s") and not w.endswith("ss") and not w[0].isdigit():
+            w = w[:-1]   # poor man's stemming: "sales" matches "sale"
+        out.append(w)
+    return out
+
+
+def sub_questions(question: str) -> List[str]:
+    """The question split into its numbered lines / sentences; the whole question when it has no parts."""
+    parts = [p.strip() for line in question.splitlines() for p in re.split(r"(?<=\?)\s+", line)]
+    parts = [p for p in parts if len(_terms(p)) >= 2]
+    return parts or [question]
+
+
+def _is_table(lines: List[str]) -> bool:
+    if len(lines) < 2:
+        return False
+    delimited = sum(1 for l in lines if l.count("|") >= 2 or "\t" in l or l.count(",") >= 2)
+    return delimited >= 0.6 * len(lines)
+
+
+class Chunk:
+    __slots__ = ("section", "index", "text", "table", "numeric", "terms")
+
+    def __init__(self, section: str, index: int, text: str, table: bool):
+        self.section = section
+        self.index = index
+        self.text = text
+        self.table = table
+        self.numeric = bool(_NUMBER.search(text))
+        self.terms = TermCounter(_terms(text))
+
+
+def chunk_text(section: str, text: str) -> List[Chunk]:
+    """Paragraph-sized prose chunks; tables split into row groups that each repeat the header row."""
+    chunks: List[Chunk] = []
+    for block in re.split(r"\n\s*\n", text):
+        lines = [l for l in block.splitlines() if l.strip()]
+        if not lines:
+            continue
+        if _is_table(lines):
+            header, rows = lines[0], lines[1:]
+            for i in range(0, len(rows), CONTEXT_TABLE_ROWS):
+                body = rows[i:i + CONTEXT_TABLE_ROWS]
+                chunks.append(Chunk(section, len(chunks), "\n".join([header] + body), True))
+            continue
+        buf = ""
+        for line in lines:
+            while len(line) > CONTEXT_CHUNK_CHARS:   # one huge line (minified text, JSON): hard split
+                if buf:
+                    chunks.append(Chunk(section, len(chunks), buf, False))
+                    buf = ""
+                chunks.append(Chunk(section, len(chunks), line[:CONTEXT_CHUNK_CHARS], False))
+                line = line[CONTEXT_CHUNK_CHARS:]
+            if buf and len(buf) + len(line) + 1 > CONTEXT_CHUNK_CHARS:
+                chunks.append(Chunk(section, len(chunks), buf, False))
+                buf = ""
+            buf = f"{buf}\n{line}" if buf else line
+        if buf:
+            chunks.append(Chunk(section, len(chunks), buf, False))
+    return chunks
+
+
+def _bm25(query: List[str], chunks: List[Chunk], df: Dict[str, int], avg_len: float) -> List[float]:
+    n = len(chunks)
+    idf = {t: math.log(1 + (n - df.get(t, 0) + 0.5) / (df.get(t, 0) + 0.5)) for t in set(query)}
+    scores = []
+    for c in chunks:
+        length = sum(c.terms.values()) or 1
+        s = 0.0
+        for t in idf:
+            f = c.terms.get(t, 0)
+            if f:
+                s += idf[t] * f * (BM25_K1 + 1) / (f + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_len))
+        scores.append(s)
+    return scores
+
+
+def _gap_markers(skipped: List[Chunk]) -> List[str]:
+    rows = sum(len(c.text.splitlines()) - 1 for c in skipped if c.table)
+    prose = sum(1 for c in skipped if not c.table)
+    out = []
+    if rows:
+        out.append(f"[... TABLE INCOMPLETE: {rows} row(s) omitted here; do not compute totals or counts from the rows shown ...]")
+    if prose:
+        out.append(f"[... {prose} less relevant part(s) omitted ...]")
+    return out
+
+
+def compact_sections(question: str, sections: Dict[str, str], budget_tokens: int = CONTEXT_BUDGET_TOKENS) -> Dict[str, str]:
+    """
+    Rank every section's chunks against the question's sub-questions (BM25) and keep the best
+    ones within `budget_tokens`, in original order with gaps marked. Each section keeps its first
+    chunk (source line / summary), and tables and numeric chunks sharing a term with the question
+    are kept even past the budget: only prose is trimmed to fit. Chunks matching no question term
+    are dropped; a gap left by dropped table rows is marked as an incomplete table. Sections
+    already within budget are returned unchanged.
+    """
+    total_chars = sum(len(t) for t in sections.values())
+    budget_chars = int(budget_tokens * CHARS_PER_TOKEN)
+    if not CONTEXT_COMPACTION_ENABLED or budget_tokens <= 0:
+        COMPACTIONS.inc(outcome="disabled")
+        return sections
+    if total_chars <= budget_chars:
+        COMPACTIONS.inc(outcome="under_budget")
+        return sections
+
+    chunks = [c for name, text in sections.items() for c in chunk_text(name, text)]
+    if not chunks:
+        return sections
+    df: Dict[str, int] = {}
+    for c in chunks:
+        for t in c.terms:
+            df[t] = df.get(t, 0) + 1
+    avg_len = sum(sum(c.terms.values()) for c in chunks) / len(chunks) or 1.0
+    question_terms = set(_terms(question))
+
+    # best rank of each chunk under any sub-question, so every sub-question gets its top chunks in
+    best_rank: Dict[int, int] = {}
+    best_score: Dict[int, float] = {}
+    for q in sub_questions(question):
+        scores = _bm25(_terms(q), chunks, df, avg_len)
+        top = max(scores) or 1.0
+        for rank, i in enumerate(sorted(range(len(chunks)), key=lambda i: -scores[i])):
+            if scores[i] <= 0:
+                break
+            best_rank[i] = min(best_rank.get(i, rank), rank)
+            best_score[i] = max(best_score.get(i, 0.0), scores[i] / top)
+
+    def priority(i: int) -> Tuple[int, int, float]:
+        c = chunks[i]
+        if c.index == 0:
+            tier = 0
+        elif (c.table or c.numeric) and question_terms & c.terms.keys():
+            tier = 1
+        else:
+            tier = 2
+        return tier, best_rank.get(i, len(chunks)), -best_score.get(i, 0.0)
+
+    # chunks that match nothing in the question are dropped even when there is room for them;
+    # tiers 0 and 1 are never dropped for space (a table cut short reads as the whole table)
+    keep = set()
+    used = 0
+    for i in sorted((i for i, c in enumerate(chunks) if c.index == 0 or i in best_rank), key=priority):
+        size = len(chunks[i].text) + 1
+        if priority(i)[0] == 2 and used + size > budget_chars:
+            continue
+        keep.add(i)
+        used += size
+
+    out: Dict[str, str] = {}
+    for name in sections:
+        parts: List[str] = []
+        skipped: List[Chunk] = []
+        for i, c in enumerate(chunks):
+            if c.section != name:
+                continue
+            if i in keep:
+                parts.extend(_gap_markers(skipped))
+                skipped = []
+                parts.append(c.text)
+            else:
+                skipped.append(c)
+        parts.extend(_gap_markers(skipped))
+        out[name] = "\n".join(parts)
+    kept_chars = sum(len(t) for t in out.values())
+    COMPACTIONS.inc(outcome="compacted")
+    COMPACTION_KEPT.observe(kept_chars / total_chars)
+    print(f"[compaction] {len(chunks)} chunks, kept {len(keep)}: {total_chars} -> {kept_chars} chars "
+          f"(budget {budget_chars})")
+    return out
+
+
+def compact_specialist_contexts(question: str, html_context=None, pdf_context=None, csv_tsv_xlsx_context=None,
+                                image_context=None, archive_context=None, sql_parquet_json_context=None,
+                                budget_tokens: Optional[int] = None) -> tuple:
+    """
+    compact_sections over the master agent's inputs ([{"source", "content"}] lists, and the archive
+    agent's {"html": ..., "pdf": ...} content), returning them in the same shapes and order.
+    """
+    contexts = [html_context, pdf_context, csv_tsv_xlsx_context, image_context, sql_parquet_json_context]
+    sections: Dict[str, str] = {}
+    for n, ctx in enumerate(contexts):
+        for i, item in enumerate(ctx or []):
+            if item.get("content"):
+                sections[f"{n}:{i}"] = str(item["content"])
+    archive = (archive_context[0].get("content") or {}) if archive_context else {}
+    if isinstance(archive, dict):
+        for key, value in archive.items():
+            if value:
+                sections[f"archive:{key}"] = str(value)
+    compacted = compact_sections(question, sections, CONTEXT_BUDGET_TOKENS if budget_tokens is None else budget_tokens)
+    if compacted is sections:
+        return html_context, pdf_context, csv_tsv_xlsx_context, image_context, archive_context, sql_parquet_json_context
+
+    out = []
+    for n, ctx in enumerate(contexts):
+        out.append([{**item, "content": compacted.get(f"{n}:{i}", item.get("content"))} for i, item in enumerate(ctx)]
+                   if ctx else ctx)
+    if archive_context and isinstance(archive, dict):
+        archive_context = [{**archive_context[0], "content": {k: compacted.get(f"archive:{k}", v) for k, v in archive.items()}},
+                           *archive_context[1:]]
+    html_context, pdf_context, csv_tsv_xlsx_context, image_context, sql_parquet_json_context = out
+    return html_context, pdf_context, csv_tsv_xlsx_context, image_context, archive_context, sql_parquet_json_context
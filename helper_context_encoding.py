@@ -0,0 +1,141 @@
+import json
+import os
+import re
+from typing import Any, Callable, List, Optional
+from helper_metrics import Counter, registry
+
+# "compact": tables / key-value lines; "json": the old pretty-printed JSON (indent=2)
+CONTEXT_ENCODING         = os.getenv("CONTEXT_ENCODING", "compact")
+# Kinds whose rows are a sample of a larger table: a value shared by every sampled row, or a column
+# empty in all of them, says nothing about the table, so columns are never folded or dropped
+SAMPLE_KINDS             = frozenset({"sql_preview"})
+# Also render the old encoding of every context and report the bytes / estimated tokens saved
+CONTEXT_ENCODING_MEASURE = os.getenv("CONTEXT_ENCODING_MEASURE", "0") == "1"
+CHARS_PER_TOKEN          = float(os.getenv("LLM_CHARS_PER_TOKEN", "4"))
+
+ENCODED_BYTES = registry.register(Counter(
+    "context_encoding_bytes_total", "Bytes of context handed to LLM prompts, by context type and encoding "
+    "(legacy is only rendered in measurement mode)", ("kind", "encoding")))
+ENCODED_TOKENS_SAVED = registry.register(Counter(
+    "context_encoding_tokens_saved_total", "Estimated input tokens saved by the compact encoding (measurement mode)",
+    ("kind",)))
+
+_EMPTY = (None, "", [], {})
+_BLANK_RUNS = re.compile(r"\n{3,}")
+_TRAILING_WS = re.compile(r"[ \t]+\n")
+
+
+def legacy_json(data: Any) -> str:
+    if isinstance(data, (dict, list)):
+        return json.dumps(data, ensure_ascii=False, indent=2, default=str)
+    return str(data)
+
+
+def _scalar(v: Any) -> str:
+    if isinstance(v, str):
+        return v
+    if isinstance(v, (dict, list)):
+        return json.dumps(v, ensure_ascii=False, separators=(",", ":"), default=str)
+    return "" if v is None else str(v)
+
+
+def _cell(v: Any) -> str:
+    s = _scalar(v)
+    return json.dumps(s, ensure_ascii=False) if ("|" in s or "\n" in s) else s
+
+
+def _tabular(items: List[Any], fold: bool = True) -> Optional[List[str]]:
+    """
+    Shared column order when `items` reads best as a table (flat dict rows, mostly the same keys).
+    With `fold`, columns empty in every row are left out.
+    """
+    if len(items) < 2 or not all(isinstance(r, dict) and r and _inline(r) for r in items):
+        return None
+    columns: List[str] = []
+    for r in items:
+        for k, v in r.items():
+            if k not in columns and (v not in _EMPTY or not fold):
+                columns.append(k)
+    avg = sum(len(r) for r in items) / len(items)
+    return columns if len(columns) <= 1.5 * avg else None
+
+
+def _table(rows: List[dict], columns: List[str], pad: str, fold: bool = True) -> List[str]:
+    # with `fold`, a column with the same value in every row is stated once above the table
+    constant = [c for c in columns if all(c in r for r in rows) and len({_scalar(r[c]) for r in rows}) == 1] \
+        if fold else []
+    varying = [c for c in columns if c not in constant]
+    if not varying:   # identical rows: keep them as they are
+        varying, constant = columns, []
+    out = [f"{pad}(all rows) " + ", ".join(f"{c}={_cell(rows[0][c])}" for c in constant)] if constant else []
+    out.append(pad + " | ".join(varying))
+    out.extend(pad + " | ".join(_cell(r.get(c)) for c in varying) for r in rows)
+    return out
+
+
+def _lines(data: Any, pad: str = "", fold: bool = True) -> List[str]:
+    if isinstance(data, dict):
+        out = []
+        for k, v in data.items():
+            if v in _EMPTY:
+                continue   # absent and empty keys say the same thing
+            if isinstance(v, (dict, list)) and not _inline(v):
+                out.append(f"{pad}{k}:")
+                out.extend(_lines(v, pad + " ", fold))
+            else:
+                out.append(f"{pad}{k}: {_scalar(v)}")
+        return out
+    if isinstance(data, list):
+        columns = _tabular(data, fold)
+        if columns:
+            return _table(data, columns, pad, fold)
+        if _inline(data):
+            return [pad + _scalar(data)]
+        if all(isinstance(r, list) and _inline(r) for r in data):   # rows of values
+            return [pad + " | ".join(_cell(v) for v in r) for r in data]
+        out = []
+        for item in data:
+            sub = _lines(item, pad + "  ", fold)
+            if sub:
+                out.append(pad + "- " + sub[0][len(pad) + 2:])
+                out.extend(sub[1:])
+        return out
+    return [pad + _scalar(data)]
+
+
+def _inline(v: Any) -> bool:
+    """Short flat lists / dicts stay on one line."""
+    if isinstance(v, list):
+        return all(not isinstance(x, (dict, list)) for x in v) and len(_scalar(v)) <= 200
+    if isinstance(v, dict):
+        return all(not isinstance(x, (dict, list)) for x in v.values()) and len(_scalar(v)) <= 400
+    return True
+
+
+def compact_text(text: str) -> str:
+    """Trailing whitespace and runs of blank lines removed; line content is left alone (markdown tables)."""
+    return _BLANK_RUNS.sub("\n\n", _TRAILING_WS.sub("\n", text)).strip()
+
+
+def encode_context(data: Any, kind: str = "generic", legacy: Callable[[Any], str] = legacy_json) -> str:
+    """
+    Render a specialist payload for a prompt with as few tokens as it takes: lists of records become
+    one header line plus delimited rows (constant columns stated once, except for SAMPLE_KINDS), dicts
+    become `key: value` lines with empty keys dropped, text loses redundant whitespace. `legacy` is the encoding this
+    replaces, rendered only in measurement mode to report the saving per context type.
+    """
+    if CONTEXT_ENCODING == "json":
+        encoded = legacy(data)
+    elif isinstance(data, (dict, list)):
+        encoded = "\n".join(_lines(data, fold=kind not in SAMPLE_KINDS))
+    else:
+        encoded = compact_text(str(data))
+    ENCODED_BYTES.inc(len(encoded.encode("utf-8")), kind=kind, encoding=CONTEXT_ENCODING)
+    if CONTEXT_ENCODING_MEASURE:
+        before = legacy(data)
+        saved = len(before) - len(encoded)
+        ENCODED_BYTES.inc(len(before.encode("utf-8")), kind=kind, encoding="legacy")
+        ENCODED_TOKENS_SAVED.inc(max(0, saved) / CHARS_PER_TOKEN, kind=kind)
+        print(f"[context_encoding] {kind}: {len(before)} -> {len(encoded)} chars "
+              f"(~{saved / CHARS_PER_TOKEN:.0f} tokens saved)")
+    return encoded
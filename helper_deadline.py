@@ -0,0 +1,105 @@
+import asyncio
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Optional, TypeVar
+
+REQUEST_DEADLINE_SEC     = float(os.getenv("REQUEST_DEADLINE_SEC", "180"))   # server default budget per request
+REQUEST_DEADLINE_MAX_SEC = float(os.getenv("REQUEST_DEADLINE_MAX_SEC", "900"))
+# Part of the budget kept back from the specialists for the master agent + code execution
+MASTER_RESERVE_SEC       = float(os.getenv("DEADLINE_MASTER_RESERVE_SEC", "45"))
+MASTER_RESERVE_FRACTION  = float(os.getenv("DEADLINE_MASTER_RESERVE_FRACTION", "0.3"))
+
+DEADLINE_HEADER = "x-request-deadline-sec"
+DEADLINE_FIELD = "deadline_sec"
+
+T = TypeVar("T")
+
+# Absolute wall-clock deadline (time.time()) of the request running in this context
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+def parse_budget(value) -> float:
+    """Client-supplied budget in seconds, clamped to (0, REQUEST_DEADLINE_MAX_SEC]; server default otherwise."""
+    try:
+        sec = float(value)
+    except (TypeError, ValueError):
+        return REQUEST_DEADLINE_SEC
+    return min(sec, REQUEST_DEADLINE_MAX_SEC) if sec > 0 else REQUEST_DEADLINE_SEC
+
+
+@contextmanager
+def deadline_scope(at: Optional[float]):
+    """Bind an absolute deadline to the current request (and every task it spawns)."""
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline() -> Optional[float]:
+    """Absolute deadline of the request running in this context (None: unbounded)."""
+    return _deadline.get()
+
+
+def detached_context(at: Optional[float]) -> contextvars.Context:
+    """
+    A copy of the current context whose deadline is `at` instead of the request's: for work
+    shared by several requests. Move it later with `move_deadline`.
+    """
+    ctx = contextvars.copy_context()
+    ctx.run(_deadline.set, at)
+    return ctx
+
+
+def move_deadline(ctx: contextvars.Context, at: Optional[float]):
+    """Replace the deadline of a context made by `detached_context` (seen by its task's next steps)."""
+    ctx.run(_deadline.set, at)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left for this request, or None when no deadline is set."""
+    at = _deadline.get()
+    return None if at is None else at - time.time()
+
+
+def clamp(timeout: Optional[float] = None) -> Optional[float]:
+    """A step's own timeout, shortened to what is left of the request; raises once the budget is gone."""
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded("request deadline exceeded")
+    return left if timeout is None else min(timeout, left)
+
+
+def specialist_budget() -> Optional[float]:
+    """Time the specialist agents may use, keeping a reserve for the master agent."""
+    left = remaining()
+    if left is None:
+        return None
+    reserve = min(MASTER_RESERVE_SEC, left * MASTER_RESERVE_FRACTION) if left > 0 else 0
+    return max(0.0, left - reserve)
+
+
+async def bounded(aw: Awaitable[T], timeout: Optional[float] = None) -> T:
+    """Await `aw` for at most min(timeout, time left); DeadlineExceeded if the request budget ran out."""
+    try:
+        limit = clamp(timeout)
+    except DeadlineExceeded:
+        if asyncio.iscoroutine(aw):
+            aw.close()
+        raise
+    try:
+        return await asyncio.wait_for(aw, limit)
+    except asyncio.TimeoutError as e:
+        left = remaining()
+        if left is not None and left <= 0.05:
+            raise DeadlineExceeded("request deadline exceeded") from e
+        raise
@@ -1,4 +1,21 @@
 import os, subprocess, tempfile, sys
+import asyncio, json, argparse, time, signal
+from typing import List, Optional, Set, Tuple
+from helper_metrics import timed
+from helper_deadline import clamp
+
+CODE_POOL_ENABLED    = os.getenv("CODE_POOL_ENABLED", "1") != "0"
+CODE_POOL_SIZE       = int(os.getenv("CODE_POOL_SIZE", "2"))
+CODE_POOL_MAX_JOBS   = int(os.getenv("CODE_POOL_MAX_JOBS", "50"))      # recycle a worker after N jobs
+CODE_POOL_MAX_RSS_MB = int(os.getenv("CODE_POOL_MAX_RSS_MB", "1024"))  # ...or once its peak RSS passes this
+CODE_POOL_START_TIMEOUT = float(os.getenv("CODE_POOL_START_TIMEOUT", "60"))
+
+# What the master agent's scripts import; loaded once per worker instead of once per answer
+MASTER_PRELOAD = (
+    "json", "io", "base64", "re", "math", "statistics", "datetime",
+    "numpy", "pandas", "matplotlib", "matplotlib.pyplot", "seaborn",
+    "scipy", "scipy.stats", "sklearn", "sklearn.linear_model", "networkx",
+)
 
 # === Execute safely ===
 def execute_code(code: str, timeout: int = 120):
@@ -14,4 +31,317 @@ def execute_code(code: str, timeout: int = 120):
     except subprocess.TimeoutExpired:
         return "", "Execution timed out"
     finally:
-        os.remove(tmp_path)
\ No newline at end of file
+        os.remove(tmp_path)
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+class _Worker:
+    """One pre-forked interpreter speaking line-delimited JSON over stdin/stdout."""
+    def __init__(self, proc: asyncio.subprocess.Process):
+        self.proc = proc
+        self.jobs = 0
+        self.rss_mb = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.returncode is None
+
+    async def _readline(self) -> dict:
+        line = await self.proc.stdout.readline()
+        if not line:
+            raise WorkerCrashed(f"worker exited with code {self.proc.returncode}")
+        return json.loads(line)
+
+    async def wait_ready(self, timeout: float):
+        msg = await asyncio.wait_for(self._readline(), timeout)
+        if not msg.get("ready"):
+            raise WorkerCrashed(f"unexpected handshake: {msg}")
+
+    async def run(self, job: dict) -> dict:
+        self.proc.stdin.write((json.dumps(job) + "\n").encode("utf-8"))
+        await self.proc.stdin.drain()
+        res = await self._readline()
+        self.jobs += 1
+        self.rss_mb = res.get("rss_mb", 0.0)
+        return res
+
+    async def kill(self):
+        if self.alive:
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass
+        try:
+            await self.proc.wait()
+        except Exception:
+            pass
+
+
+class CodeWorkerPool:
+    """
+    Async pool of warm Python workers for LLM-generated scripts.
+    - heavy libraries are imported once per worker, each job gets a fresh namespace
+    - stdout/stderr of the job are captured and returned
+    - a job over its timeout gets its worker killed and replaced
+    - workers are recycled after `max_jobs` jobs or once peak RSS passes `max_rss_mb`
+    - optional RLIMIT_AS cap for the worker (`rlimit_as_mb`); jobs may carry a `cpu_sec`
+      RLIMIT_CPU budget, a `max_output` char cap, extra `globals` and `inject_modules`
+    """
+    def __init__(self, name: str, preload: Tuple[str, ...], size: int = CODE_POOL_SIZE,
+                 max_jobs: int = CODE_POOL_MAX_JOBS, max_rss_mb: int = CODE_POOL_MAX_RSS_MB,
+                 rlimit_as_mb: int = 0):
+        self.name = name
+        self.preload = preload
+        self.size = max(1, size)
+        self.max_jobs = max(1, max_jobs)
+        self.max_rss_mb = max_rss_mb
+        self.rlimit_as_mb = rlimit_as_mb
+        self._idle: List[_Worker] = []
+        self._slots = asyncio.Semaphore(self.size)
+        self._closed = False
+        self._tasks: Set[asyncio.Task] = set()   # replacement warm-ups (the loop only keeps weak references)
+
+    def _worker_args(self) -> List[str]:
+        args = [os.path.abspath(__file__), "--worker", "--preload", ",".join(self.preload)]
+        if self.rlimit_as_mb:
+            args += ["--rlimit-as-mb", str(self.rlimit_as_mb)]
+        return args
+
+    async def _spawn(self) -> _Worker:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, *self._worker_args(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=64 * 1024 * 1024,  # results (e.g. base64 plots) travel as one JSON line
+        )
+        worker = _Worker(proc)
+        try:
+            await worker.wait_ready(CODE_POOL_START_TIMEOUT)
+        except BaseException:
+            await worker.kill()
+            raise
+        return worker
+
+    async def _warm_one(self):
+        try:
+            worker = await self._spawn()
+        except Exception as e:
+            print(f"[{self.name}] warm-up spawn failed: {e}")
+            return
+        if self._closed or len(self._idle) >= self.size:
+            await worker.kill()
+        else:
+            self._idle.append(worker)
+
+    async def start(self):
+        t0 = time.perf_counter()
+        await asyncio.gather(*(self._warm_one() for _ in range(self.size - len(self._idle))))
+        print(f"[{self.name}] {len(self._idle)} warm worker(s) ready in {time.perf_counter() - t0:.1f}s")
+
+    async def stop(self):
+        self._closed = True
+        pending, self._tasks = list(self._tasks), set()
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(w.kill() for w in idle))
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[{self.name}] {task.get_name()} failed: {task.exception()!r}")
+
+    async def _retire(self, worker: _Worker, reason: str):
+        print(f"[{self.name}] recycling worker pid={worker.proc.pid} ({reason})")
+        await worker.kill()
+        if not self._closed:
+            task = asyncio.create_task(self._warm_one(), name=f"{self.name}:warm")
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+
+    async def submit(self, job: dict, timeout: float) -> dict:
+        """
+        Run one job; returns the worker's result dict or {"timeout": True} / {"crashed": "..."}.
+        `timeout` also covers waiting for a free slot and spawning a cold worker.
+        """
+        t_end = time.monotonic() + timeout
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return {"timeout": True}
+        try:
+            worker = None
+            while self._idle and worker is None:
+                candidate = self._idle.pop()
+                worker = candidate if candidate.alive else None
+            if worker is None:
+                try:
+                    worker = await asyncio.wait_for(self._spawn(), max(0.0, t_end - time.monotonic()))
+                except asyncio.TimeoutError:
+                    return {"timeout": True}
+
+            try:
+                res = await asyncio.wait_for(worker.run(job), max(0.0, t_end - time.monotonic()))
+            except asyncio.TimeoutError:
+                await self._retire(worker, f"timed out after {timeout}s")
+                return {"timeout": True}
+            except (WorkerCrashed, ConnectionError, json.JSONDecodeError) as e:
+                await self._retire(worker, f"crashed: {e}")
+                if hasattr(signal, "SIGXCPU") and worker.proc.returncode == -signal.SIGXCPU:
+                    return {"crashed": "CPU time limit exceeded"}
+                return {"crashed": str(e)}
+            except BaseException:
+                # cancelled mid-job: the worker's state is unknown, never reuse it
+                await self._retire(worker, "job cancelled")
+                raise
+
+            if res.get("recycle"):
+                await self._retire(worker, "job hit a resource limit")
+            elif worker.jobs >= self.max_jobs:
+                await self._retire(worker, f"{worker.jobs} jobs served")
+            elif self.max_rss_mb and worker.rss_mb > self.max_rss_mb:
+                await self._retire(worker, f"rss {worker.rss_mb:.0f} MB")
+            elif self._closed:
+                await worker.kill()
+            else:
+                self._idle.append(worker)
+            return res
+        finally:
+            self._slots.release()
+
+
+code_pool = CodeWorkerPool("code_pool", MASTER_PRELOAD)
+
+
+@timed("code_exec")
+async def run_code(code: str, timeout: int = 120) -> Tuple[str, str]:
+    """Async counterpart of execute_code: runs on a warm worker, never blocks the event loop."""
+    timeout = clamp(timeout)
+    if not CODE_POOL_ENABLED:
+        return await asyncio.to_thread(execute_code, code, timeout)
+    res = await code_pool.submit({"code": code}, timeout)
+    if res.get("timeout"):
+        return "", "Execution timed out"
+    if res.get("crashed"):
+        return "", f"Execution worker crashed: {res['crashed']}"
+    return res.get("stdout", ""), res.get("stderr", "")
+
+
+# ========== WORKER SIDE ==========
+def _peak_rss_mb() -> float:
+    try:
+        import resource
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return kb / 1024.0 if sys.platform != "darwin" else kb / (1024.0 * 1024.0)
+    except Exception:
+        return 0.0
+
+
+def _set_rlimit(kind: str, soft: int):
+    try:
+        import resource
+        lim = getattr(resource, kind)
+        _, hard = resource.getrlimit(lim)
+        if hard != resource.RLIM_INFINITY and (soft == resource.RLIM_INFINITY or soft > hard):
+            soft = hard
+        resource.setrlimit(lim, (soft, hard))
+    except Exception as e:
+        print(f"[code_worker] setrlimit {kind} failed: {e}", file=sys.stderr)
+
+
+def _cpu_seconds_used() -> float:
+    try:
+        import resource
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        return ru.ru_utime + ru.ru_stime
+    except Exception:
+        return 0.0
+
+
+def _truncate(text: str, limit: Optional[int]) -> Tuple[str, bool]:
+    if limit and len(text) > limit:
+        return text[:limit] + f"\n... [truncated {len(text) - limit} chars]", True
+    return text, False
+
+
+def _worker_main(preload: List[str], rlimit_as_mb: int = 0):
+    import builtins, contextlib, io, importlib, math, traceback
+
+    # The protocol owns the real stdout; anything the job writes at fd level goes to stderr
+    proto = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    os.dup2(2, 1)
+    sys.stdout = sys.__stdout__ = io.TextIOWrapper(os.fdopen(1, "wb", closefd=False), encoding="utf-8")
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    for mod in preload:
+        if not mod:
+            continue
+        try:
+            importlib.import_module(mod)
+        except Exception as e:
+            print(f"[code_worker] preload {mod} failed: {e}", file=sys.stderr)
+
+    def reply(obj: dict):
+        proto.write(json.dumps(obj) + "\n")
+        proto.flush()
+
+    if rlimit_as_mb:
+        _set_rlimit("RLIMIT_AS", rlimit_as_mb * 1024 * 1024)
+
+    reply({"ready": True, "pid": os.getpid()})
+    start_cwd = os.getcwd()
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        out, err = io.StringIO(), io.StringIO()
+        namespace = {"__name__": "__main__", "__builtins__": builtins}
+        namespace.update(job.get("globals") or {})
+        error, recycle = None, False
+        real_stdin = sys.stdin
+        try:
+            for alias, mod in (job.get("inject_modules") or {}).items():
+                namespace[alias] = importlib.import_module(mod)
+            if job.get("cpu_sec"):
+                # RLIMIT_CPU is cumulative per process: allow this job `cpu_sec` more seconds (SIGXCPU kills it)
+                _set_rlimit("RLIMIT_CPU", int(math.ceil(_cpu_seconds_used() + job["cpu_sec"])))
+            sys.stdin = io.StringIO("")
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                try:
+                    exec(compile(job["code"], "<llm_code>", "exec"), namespace)
+                except SystemExit:
+                    pass
+                except BaseException as e:
+                    error = f"{type(e).__name__}: {e}" if isinstance(e, MemoryError) else str(e)
+                    recycle = isinstance(e, MemoryError)
+                    traceback.print_exc()
+        finally:
+            sys.stdin = real_stdin
+            if job.get("cpu_sec"):
+                import resource
+                _set_rlimit("RLIMIT_CPU", resource.RLIM_INFINITY)
+            os.chdir(start_cwd)
+            if "matplotlib.pyplot" in sys.modules:
+                try:
+                    sys.modules["matplotlib.pyplot"].close("all")
+                except Exception:
+                    pass
+        stdout, out_cut = _truncate(out.getvalue(), job.get("max_output"))
+        stderr, err_cut = _truncate(err.getvalue(), job.get("max_output"))
+        reply({
+            "stdout": stdout, "stderr": stderr, "error": error, "truncated": out_cut or err_cut,
+            "recycle": recycle, "rss_mb": _peak_rss_mb(),
+        })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--worker", action="store_true")
+    parser.add_argument("--preload", default="")
+    parser.add_argument("--rlimit-as-mb", type=int, default=0)
+    args = parser.parse_args()
+    if args.worker:
+        _worker_main(args.preload.split(","), rlimit_as_mb=args.rlimit_as_mb)
@@ -1,35 +1,103 @@
 from typing import List
 from bs4 import BeautifulSoup
 from fastapi import UploadFile
-from playwright.sync_api import sync_playwright
 from html import unescape
+import asyncio
+import os
 import re
+from urllib.parse import urlparse
 from bs4 import Tag
-from playwright.sync_api import sync_playwright
 import trafilatura
+from helper_browser_pool import browser_pool
+from helper_metrics import span
+from helper_deadline import bounded, clamp
 
-def render_html_url(html_urls: List[str]) -> str:
+HTML_READY_MODE        = os.getenv("HTML_READY_MODE", "adaptive")   # "adaptive" | "fixed" (legacy 3 s wait)
+HTML_NAV_TIMEOUT_MS    = int(os.getenv("HTML_NAV_TIMEOUT_MS", "60000"))
+HTML_READY_TIMEOUT_MS  = int(os.getenv("HTML_READY_TIMEOUT_MS", "3000"))  # ceiling for the readiness signals
+HTML_BLOCK_RESOURCES   = os.getenv("HTML_BLOCK_RESOURCES", "1") != "0"
+
+# Nothing trafilatura reads depends on these, so they are never downloaded
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+BLOCKED_HOST_MARKERS = (
+    "doubleclick.net", "googlesyndication.com", "google-analytics.com", "googletagmanager.com",
+    "googletagservices.com", "adservice.google", "facebook.net", "connect.facebook",
+    "scorecardresearch.com", "quantserve.com", "hotjar.com", "segment.io", "segment.com",
+    "amazon-adsystem.com", "taboola.com", "outbrain.com", "criteo.com", "adnxs.com",
+    "newrelic.com", "nr-data.net", "optimizely.com", "chartbeat.com", "mixpanel.com",
+)
+READY_SELECTOR = "table, main, article, #content, #mw-content-text"
+
+def _budget_ms(ms: int) -> int:
+    """A Playwright timeout shortened to the request's remaining budget."""
+    return int(clamp(ms / 1000.0) * 1000)
+
+async def _block_heavy_resources(route):
+    request = route.request
+    host = urlparse(request.url).hostname or ""
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(m in host for m in BLOCKED_HOST_MARKERS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def _wait_until_ready(page):
+    """Return as soon as the network goes idle or a table/main-content node is attached, capped by the ceiling."""
+    ready_ms = _budget_ms(HTML_READY_TIMEOUT_MS)
+    waiters = [
+        asyncio.ensure_future(page.wait_for_load_state("networkidle", timeout=ready_ms)),
+        asyncio.ensure_future(page.wait_for_selector(READY_SELECTOR, state="attached", timeout=ready_ms)),
+    ]
+    pending = set(waiters)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if any(not t.cancelled() and t.exception() is None for t in done):
+                return
+    finally:
+        for t in pending:
+            t.cancel()
+        # timeouts are expected here; mark them retrieved
+        for t in waiters:
+            if t.done() and not t.cancelled():
+                t.exception()
+
+def _extract_text(raw_html: str) -> str:
+    with span("trafilatura"):
+        return trafilatura.extract(raw_html, include_tables=True) or ""
+
+async def _render_one(ctx, html_url: str) -> str:
+    async with browser_pool.page_slots:
+        page = await ctx.new_page()
+        try:
+            with span("playwright_render"):
+                if HTML_READY_MODE == "fixed":
+                    await page.goto(html_url, timeout=_budget_ms(HTML_NAV_TIMEOUT_MS))
+                    await page.wait_for_timeout(_budget_ms(3000))
+                else:
+                    await page.goto(html_url, wait_until="domcontentloaded", timeout=_budget_ms(HTML_NAV_TIMEOUT_MS))
+                    await _wait_until_ready(page)
+                raw_html = await page.content()
+        finally:
+            await page.close()
+    # trafilatura is CPU-bound; keep it off the event loop
+    return await asyncio.to_thread(_extract_text, raw_html)
+
+async def render_html_url(html_urls: List[str]) -> str:
     """
-    Render HTML URLs with Playwright and extract clean text using Trafilatura.
+    Render HTML URLs with the shared Playwright pool (one isolated context per call,
+    one page per URL, rendered concurrently) and extract clean text using Trafilatura.
     """
+    async with browser_pool.context() as ctx:
+        if HTML_BLOCK_RESOURCES:
+            await ctx.route("**/*", _block_heavy_resources)
+        results = await asyncio.gather(*(bounded(_render_one(ctx, u)) for u in html_urls), return_exceptions=True)
     extracted_texts = []
-
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-
-        for html_url in html_urls:
-            try:
-                page.goto(html_url, timeout=60000)
-                page.wait_for_timeout(3000)
-                raw_html = page.content()
-                extracted = trafilatura.extract(raw_html, include_tables=True)
-                extracted_texts.append(extracted or "")
-            except Exception as e:
-                print(f"[Warning] Failed to render {html_url}: {e}")
-                extracted_texts.append("")  # maintain order
-        browser.close()
-
+    for html_url, res in zip(html_urls, results):
+        if isinstance(res, BaseException):
+            print(f"[Warning] Failed to render {html_url}: {res}")
+            extracted_texts.append("")  # maintain order
+        else:
+            extracted_texts.append(res)
     return "\n".join(extracted_texts)
 
 async def render_html_file(html_files: List[UploadFile]) -> str:
@@ -38,6 +106,6 @@ async def render_html_file(html_files: List[UploadFile]) -> str:
     for html_file in html_files:
         html_content = await html_file.read()
         decoded_html = html_content.decode("utf-8", errors="ignore")
-        extracted = trafilatura.extract(decoded_html, include_tables=True)
-        extracted_texts.append(extracted or "")
+        # as for URLs: a large file must not stall the loop
+        extracted_texts.append(await asyncio.to_thread(_extract_text, decoded_html))
     return "\n".join(extracted_texts)
\ No newline at end of file
@@ -0,0 +1,376 @@
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+import httpx
+from helper_metrics import timed
+from helper_deadline import bounded, clamp
+
+SESSION_ROOT = os.getenv("SESSION_ROOT", "/data/_session_sql")
+
+HTTP_TIMEOUT_SEC     = float(os.getenv("HTTP_TIMEOUT_SEC", "30"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "64"))
+HTTP_MAX_KEEPALIVE   = int(os.getenv("HTTP_MAX_KEEPALIVE", "32"))
+HTTP_PER_HOST_LIMIT  = int(os.getenv("HTTP_PER_HOST_LIMIT", "6"))
+HTTP_CACHE_ENABLED   = os.getenv("HTTP_CACHE_ENABLED", "1") != "0"
+HTTP_CACHE_DIR       = os.getenv("HTTP_CACHE_DIR", os.path.join(SESSION_ROOT, "_http_cache"))
+HTTP_CACHE_MAX_BYTES = int(os.getenv("HTTP_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+HTTP_CACHE_TTL_SEC   = float(os.getenv("HTTP_CACHE_TTL_SEC", str(7 * 24 * 3600)))   # unused entries older than this are dropped
+HTTP_SPOOL_DIR       = os.getenv("HTTP_SPOOL_DIR", os.path.join(SESSION_ROOT, "_downloads"))
+HTTP_CHUNK_BYTES     = int(os.getenv("HTTP_CHUNK_BYTES", str(256 * 1024)))
+HTTP_WRITE_BATCH_BYTES = int(os.getenv("HTTP_WRITE_BATCH_BYTES", str(4 * 1024 * 1024)))   # spool writes per thread hop
+HTTP_MAX_FILE_BYTES    = int(os.getenv("HTTP_MAX_FILE_BYTES", str(200 * 1024 * 1024)))
+HTTP_MAX_REQUEST_BYTES = int(os.getenv("HTTP_MAX_REQUEST_BYTES", str(500 * 1024 * 1024)))
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_client: Optional[httpx.AsyncClient] = None
+_host_limits: Dict[str, asyncio.Semaphore] = {}
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+class DownloadScope:
+    """
+    Per-request download state: a spool directory (removed on exit) and a byte budget
+    shared by every download made while the scope is active.
+    """
+    def __init__(self, max_file_bytes: int = HTTP_MAX_FILE_BYTES, max_request_bytes: int = HTTP_MAX_REQUEST_BYTES):
+        self.max_file_bytes = max_file_bytes
+        self.max_request_bytes = max_request_bytes
+        self.used_bytes = 0
+        self.dir = tempfile.mkdtemp(prefix="dl_", dir=_spool_root())
+
+    def consume(self, n: int, url: str):
+        self.used_bytes += n
+        if self.used_bytes > self.max_request_bytes:
+            raise DownloadTooLarge(f"request download budget of {self.max_request_bytes} bytes exceeded at {url}")
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class FetchResult:
+    """A completed download. The body lives on disk at `path`; nothing is held in memory."""
+    def __init__(self, url: str, status_code: int, headers: Dict[str, str], path: str, size: int, from_cache: bool = False):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.path = path
+        self.size = size
+        self.from_cache = from_cache
+
+    @property
+    def content_type(self) -> Optional[str]:
+        return self.headers.get("content-type")
+
+    def read_bytes(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def mmap(self) -> mmap.mmap:
+        """Read-only memory map of the body (callers close it)."""
+        with open(self.path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+_current_scope: contextvars.ContextVar[Optional[DownloadScope]] = contextvars.ContextVar("download_scope", default=None)
+_fallback_scope: Optional[DownloadScope] = None
+
+
+def _spool_root() -> str:
+    os.makedirs(HTTP_SPOOL_DIR, exist_ok=True)
+    return HTTP_SPOOL_DIR
+
+
+@contextmanager
+def download_scope(**kwargs):
+    """Bind a DownloadScope to the current request (and every task it spawns)."""
+    scope = DownloadScope(**kwargs)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+        scope.close()
+
+
+def _scope() -> DownloadScope:
+    # Scripts calling agents directly get one process-wide scope, cleaned at exit
+    global _fallback_scope
+    scope = _current_scope.get()
+    if scope is not None:
+        return scope
+    if _fallback_scope is None:
+        _fallback_scope = DownloadScope(max_request_bytes=sys.maxsize)
+        atexit.register(_fallback_scope.close)
+    return _fallback_scope
+
+
+def get_client() -> httpx.AsyncClient:
+    """The application-wide client: keep-alive pool, HTTP/2 when `h2` is installed."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            follow_redirects=True,
+            timeout=HTTP_TIMEOUT_SEC,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _host_limit(url: str) -> asyncio.Semaphore:
+    host = urlparse(url).netloc.lower()
+    sem = _host_limits.get(host)
+    if sem is None:
+        sem = _host_limits[host] = asyncio.Semaphore(HTTP_PER_HOST_LIMIT)
+    return sem
+
+
+# ---------- ETag / Last-Modified disk cache ----------
+# Bodies are bounded by HTTP_CACHE_MAX_BYTES (least recently used or revalidated evicted first) and
+# HTTP_CACHE_TTL_SEC. Callers never get a cache path: bodies are hard-linked (or copied) into their
+# DownloadScope, so a concurrent refresh or eviction of the entry cannot change a file in use.
+_cache_index: "OrderedDict[str, int]" = OrderedDict()   # body path -> size, least recently used first
+_cache_bytes = 0
+_cache_indexed = False
+_cache_lock = threading.Lock()
+
+
+def _cache_paths(url: str) -> Tuple[str, str]:
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    base = os.path.join(HTTP_CACHE_DIR, key[:2], key)
+    return base + ".json", base + ".body"
+
+
+def _cache_index_disk() -> None:
+    """Size the cache once per process (bodies left by earlier runs); commits keep it current."""
+    global _cache_bytes, _cache_indexed
+    if _cache_indexed:
+        return
+    entries = []
+    for root, _, files in os.walk(HTTP_CACHE_DIR):
+        for fn in files:
+            if fn.endswith(".body"):
+                p = os.path.join(root, fn)
+                try:
+                    st = os.stat(p)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+    entries.sort()
+    with _cache_lock:
+        if _cache_indexed:
+            return
+        for _, size, p in entries:
+            if p not in _cache_index:
+                _cache_index[p] = size
+                _cache_bytes += size
+                _cache_index.move_to_end(p, last=False)
+        _cache_indexed = True
+
+
+def _cache_drop(body_path: str) -> None:
+    global _cache_bytes
+    with _cache_lock:
+        _cache_bytes -= _cache_index.pop(body_path, 0)
+    for p in (body_path[:-len(".body")] + ".json", body_path):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+def _cache_evict() -> None:
+    while True:
+        with _cache_lock:
+            if _cache_bytes <= HTTP_CACHE_MAX_BYTES or not _cache_index:
+                return
+            oldest = next(iter(_cache_index))
+        _cache_drop(oldest)
+
+
+def _private_copy(src: str, scope: DownloadScope) -> str:
+    """A path for `src` inside the scope's spool directory: a hard link, or a copy across filesystems."""
+    fd, dst = tempfile.mkstemp(prefix="body_", dir=scope.dir)
+    os.close(fd)
+    os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    return dst
+
+
+def _cache_load(url: str, scope: DownloadScope) -> Optional[dict]:
+    """The cached entry for `url` with a private copy of its body (`local_path`) in the scope."""
+    meta_path, body_path = _cache_paths(url)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if time.time() - os.path.getmtime(body_path) > HTTP_CACHE_TTL_SEC:
+            _cache_drop(body_path)
+            return None
+        meta["body_path"] = body_path
+        meta["local_path"] = _private_copy(body_path, scope)
+        return meta
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"[http] cache meta unreadable for {url}: {e}")
+    return None
+
+
+def _cache_revalidated(cached: dict) -> None:
+    """A 304 for a cached entry: it counts as fresh and recently used again."""
+    body_path = cached["body_path"]
+    try:
+        os.utime(body_path)
+    except FileNotFoundError:
+        pass
+    with _cache_lock:
+        if body_path in _cache_index:
+            _cache_index.move_to_end(body_path)
+
+
+def _cacheable(r: httpx.Response) -> bool:
+    has_validator = "etag" in r.headers or "last-modified" in r.headers
+    return HTTP_CACHE_ENABLED and has_validator and "no-store" not in r.headers.get("cache-control", "").lower()
+
+
+def _cache_commit(url: str, r: httpx.Response, spooled_path: str) -> None:
+    """Add a finished download to the cache; the spooled file stays the caller's own copy."""
+    global _cache_bytes
+    meta_path, body_path = _cache_paths(url)
+    tmp = f"{body_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        _cache_index_disk()
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        try:
+            os.link(spooled_path, tmp)
+        except OSError:
+            shutil.copyfile(spooled_path, tmp)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, body_path)
+        meta = {"url": url, "headers": {k: v for k, v in r.headers.items() if k in ("content-type", "etag", "last-modified")}}
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+        with _cache_lock:
+            _cache_bytes += size - _cache_index.pop(body_path, 0)
+            _cache_index[body_path] = size
+        _cache_evict()
+    except Exception as e:
+        print(f"[http] cache write failed for {url}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+@timed("download")
+async def fetch(url: str, timeout: Optional[float] = None) -> FetchResult:
+    """
+    Stream `url` to a spooled file on the shared client, limited per host.
+    - aborts early when Content-Length (or the bytes received so far) exceed the
+      per-file budget or the remaining per-request budget
+    - responses carrying an ETag or Last-Modified are kept on disk and revalidated
+      with a conditional request next time
+    Raises httpx.HTTPStatusError on non-2xx, like `raise_for_status()`.
+    """
+    scope = _scope()
+    cached = await asyncio.to_thread(_cache_load, url, scope) if HTTP_CACHE_ENABLED else None
+    req_headers = {}
+    if cached:
+        if cached["headers"].get("etag"):
+            req_headers["If-None-Match"] = cached["headers"]["etag"]
+        if cached["headers"].get("last-modified"):
+            req_headers["If-Modified-Since"] = cached["headers"]["last-modified"]
+
+    async with _host_limit(url):
+        async with get_client().stream("GET", url, headers=req_headers, timeout=clamp(timeout or HTTP_TIMEOUT_SEC)) as r:
+            if cached and r.status_code == 304:
+                size = os.path.getsize(cached["local_path"])
+                scope.consume(size, url)
+                _cache_revalidated(cached)
+                return FetchResult(url, 200, dict(cached["headers"]), cached["local_path"], size, from_cache=True)
+            if cached:
+                os.remove(cached["local_path"])
+            r.raise_for_status()
+
+            declared = r.headers.get("content-length")
+            if declared and declared.isdigit():
+                declared = int(declared)
+                if declared > scope.max_file_bytes:
+                    raise DownloadTooLarge(f"{url} declares {declared} bytes, over the per-file budget of {scope.max_file_bytes}")
+                if scope.used_bytes + declared > scope.max_request_bytes:
+                    raise DownloadTooLarge(f"{url} declares {declared} bytes, over the remaining request budget")
+
+            fd, spooled_path = tempfile.mkstemp(prefix="body_", dir=scope.dir)
+            size = 0
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    # chunks are written to disk in batches from a worker thread, never on the loop
+                    batch, batched = [], 0
+                    async for chunk in r.aiter_bytes(HTTP_CHUNK_BYTES):
+                        size += len(chunk)
+                        if size > scope.max_file_bytes:
+                            raise DownloadTooLarge(f"{url} exceeded the per-file budget of {scope.max_file_bytes} bytes")
+                        scope.consume(len(chunk), url)
+                        batch.append(chunk)
+                        batched += len(chunk)
+                        if batched >= HTTP_WRITE_BATCH_BYTES:
+                            await asyncio.to_thread(out.write, b"".join(batch))
+                            batch, batched = [], 0
+                    if batch:
+                        await asyncio.to_thread(out.write, b"".join(batch))
+            except BaseException:
+                try:
+                    os.remove(spooled_path)
+                except OSError:
+                    pass
+                raise
+
+    if _cacheable(r):
+        await asyncio.to_thread(_cache_commit, url, r, spooled_path)
+    return FetchResult(url, r.status_code, dict(r.headers), spooled_path, size)
+
+
+async def fetch_many(urls: List[str], label: str = "http") -> List[FetchResult]:
+    """Fetch all URLs concurrently; failures are logged and skipped, order is preserved."""
+    # each download is also capped by the request deadline as a whole, not just per read
+    results = await asyncio.gather(*(bounded(fetch(u)) for u in (urls or [])), return_exceptions=True)
+    out = []
+    for u, res in zip(urls or [], results):
+        if isinstance(res, BaseException):
+            print(f"[{label}] URL error {u}: {res}")
+            continue
+        print(f"[{label}] GET {u} -> {res.status_code}{' (revalidated)' if res.from_cache else ''}, ct={res.content_type}, bytes={res.size}")
+        out.append(res)
+    return out
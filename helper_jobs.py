@@ -0,0 +1,463 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from helper_metrics import Counter, Gauge, registry
+from helper_admission import admission, Overloaded
+from helper_deadline import deadline_scope, REQUEST_DEADLINE_SEC
+from helper_cache import answer_cache, content_key, normalize_task
+from helper_ledger import ledger_scope, TokenLedger
+
+SESSION_ROOT = os.getenv("SESSION_ROOT", "/data/_session_sql")
+
+JOB_WORKERS       = int(os.getenv("JOB_WORKERS", "8"))        # upper bound; admission capacity decides what runs
+JOB_QUEUE_MAX     = int(os.getenv("JOB_QUEUE_MAX", "100"))    # queued (not yet running) jobs
+JOB_RETENTION_SEC = float(os.getenv("JOB_RETENTION_SEC", str(24 * 3600)))
+JOB_DIR           = os.getenv("JOB_DIR", os.path.join(SESSION_ROOT, "_jobs"))
+JOB_SWEEP_SEC     = float(os.getenv("JOB_SWEEP_SEC", "600"))
+JOB_MAX_EVENTS    = int(os.getenv("JOB_MAX_EVENTS", "500"))   # progress events kept per job for late subscribers
+
+FORCE_REFRESH_HEADER = "x-force-refresh"   # "1": skip the answer cache and request coalescing
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED, REJECTED = "queued", "running", "succeeded", "failed", "cancelled", "rejected"
+FINAL_STATES = (SUCCEEDED, FAILED, CANCELLED, REJECTED)
+
+JOBS_TOTAL = registry.register(Counter("pipeline_jobs_total", "Finished jobs by final status", ("status",)))
+JOBS_QUEUED = registry.register(Gauge("pipeline_jobs_queued", "Jobs waiting for a pipeline worker"))
+JOBS_RUNNING = registry.register(Gauge("pipeline_jobs_running", "Jobs currently running"))
+ANSWER_REQUESTS = registry.register(Counter(
+    "pipeline_answer_requests_total", "Submissions by how they were answered", ("outcome",)))
+
+# runner(question_text, files, job_id) -> answer (a dict with "error" marks a failed run);
+# a runner whose answer is incomplete (a stage failed or was cut off) reports it with mark_degraded()
+Runner = Callable[[str, List[StarletteUploadFile], str], Awaitable[Any]]
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def _digest(uf: StarletteUploadFile) -> str:
+    h = hashlib.sha256()
+    uf.file.seek(0)
+    for chunk in iter(lambda: uf.file.read(1024 * 1024), b""):
+        h.update(chunk)
+    uf.file.seek(0)
+    return h.hexdigest()
+
+
+async def request_fingerprint(question: str, files: List[StarletteUploadFile], token_budget: Optional[int] = None) -> str:
+    """
+    Identity of a submission: the normalized question (which carries any URLs it asks about)
+    plus every attachment's name and SHA-256, and the client's token budget when it set one
+    (a budget can change the answer). Identical submissions share a fingerprint.
+    """
+    attachments = await asyncio.to_thread(lambda: sorted((uf.filename or "", _digest(uf)) for uf in files))
+    if token_budget is None:
+        return content_key("answer", normalize_task(question), attachments)
+    return content_key("answer", normalize_task(question), attachments, {"token_budget": token_budget})
+
+
+# The job whose pipeline is running in the current task (set by the worker)
+_current_job: contextvars.ContextVar[Optional["Job"]] = contextvars.ContextVar("current_job", default=None)
+
+
+def emit(event: str, **data):
+    """Publish a progress event for the job running in this task; a no-op outside jobs."""
+    job = _current_job.get()
+    if job is not None:
+        job.publish(event, **data)
+
+
+def mark_degraded(reason: str):
+    """Flag the running job's answer as incomplete: it is still returned, but never cached."""
+    job = _current_job.get()
+    if job is not None:
+        job.degraded.append(reason)
+        job.publish("degraded", reason=reason)
+
+
+class Job:
+    def __init__(self, job_id: str, question: str, inputs: List[dict], created_at: Optional[float] = None,
+                 cost: int = 1, max_wait_sec: Optional[float] = None, deadline_sec: Optional[float] = None,
+                 token_budget: Optional[int] = None):
+        self.id = job_id
+        self.question = question
+        self.inputs = inputs                  # [{"field": ..., "filename": ..., "path": ..., "content_type": ...}]
+        self.cost = cost                      # admission cost units (helper_admission.estimate_cost)
+        self.max_wait_sec = max_wait_sec      # give up if not admitted within this long after submission
+        self.retry_after: Optional[float] = None
+        self.deadline_sec = deadline_sec      # client budget, counted from submission; None: server default from start
+        self.deadline_at: Optional[float] = None
+        self.fingerprint: Optional[str] = None  # request_fingerprint; identical submissions join this job
+        self.coalesced = 0                      # extra submissions answered by this run
+        self.cached = False                     # answered from the answer cache without running
+        self.degraded: List[str] = []           # why the answer is incomplete (mark_degraded); not cached if any
+        self.ledger = TokenLedger(token_budget)  # LLM calls billed to this run; budget None: server default
+        self.status = QUEUED
+        self.created_at = created_at or time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.done = asyncio.Event()
+        self.events: List[dict] = []
+        self._seq = 0
+        self._subscribers: List[asyncio.Queue] = []
+
+    def publish(self, event: str, **data):
+        self._seq += 1
+        ev = {"seq": self._seq, "event": event, "elapsed_sec": round(time.time() - self.created_at, 3), **data}
+        self.events.append(ev)
+        if len(self.events) > JOB_MAX_EVENTS:
+            del self.events[0]
+        for q in self._subscribers:
+            q.put_nowait(ev)
+
+    def to_dict(self, include_result: bool = True) -> dict:
+        out = {
+            "id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queued_sec": round((self.started_at or self.finished_at or time.time()) - self.created_at, 3),
+            "run_sec": round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else None,
+            "files": [i["filename"] for i in self.inputs],
+            "cost": self.cost,
+            "error": self.error,
+            "retry_after": self.retry_after,
+            "deadline_sec": self.deadline_sec,
+            "deadline_at": self.deadline_at,
+            "fingerprint": self.fingerprint,
+            "coalesced": self.coalesced,
+            "cached": self.cached,
+            "degraded": self.degraded,
+            "token_budget": self.ledger.budget,
+            "llm_usage": self.ledger.summary(),
+        }
+        if include_result:
+            out["result"] = self.result
+            out["llm_calls"] = self.ledger.calls
+            out["budget_actions"] = self.ledger.actions
+        return out
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Job":
+        job = cls(d["id"], d.get("question", ""), d.get("inputs", []), d.get("created_at"), cost=d.get("cost") or 1,
+                  deadline_sec=d.get("deadline_sec"))
+        job.ledger = TokenLedger(d.get("token_budget"), d.get("llm_calls"), d.get("budget_actions"))
+        for k in ("status", "started_at", "finished_at", "result", "error", "deadline_at", "fingerprint"):
+            setattr(job, k, d.get(k))
+        job.coalesced, job.cached = d.get("coalesced") or 0, bool(d.get("cached"))
+        job.degraded = list(d.get("degraded") or [])
+        if job.status in FINAL_STATES:
+            job.done.set()
+        return job
+
+
+class JobManager:
+    """
+    In-process job queue: submissions are spooled under JOB_DIR and picked up by a fixed
+    number of pipeline workers. Job state is persisted as JSON next to the inputs, so
+    status and results survive a restart until they age out of the retention window.
+    """
+    def __init__(self, runner: Optional[Runner] = None, workers: int = JOB_WORKERS, queue_max: int = JOB_QUEUE_MAX,
+                 directory: str = JOB_DIR, retention_sec: float = JOB_RETENTION_SEC):
+        self.runner = runner
+        self.workers = workers
+        self.queue_max = queue_max
+        self.directory = directory
+        self.retention_sec = retention_sec
+        self.jobs: Dict[str, Job] = {}
+        self._inflight: Dict[str, Job] = {}   # fingerprint -> queued/running job (singleflight)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._accepting = 0   # submissions still spooling their inputs (not yet in the queue)
+
+    # ---------- lifecycle ----------
+    async def start(self, runner: Optional[Runner] = None):
+        if self._tasks:
+            return
+        self.runner = runner or self.runner
+        self._queue = asyncio.Queue()
+        os.makedirs(self.directory, exist_ok=True)
+        await asyncio.to_thread(self._restore)
+        self._tasks = [asyncio.create_task(self._worker(i), name=f"job_worker_{i}") for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweeper(), name="job_sweeper"))
+        print(f"[jobs] {self.workers} pipeline worker(s), queue max {self.queue_max}, retention {self.retention_sec:.0f}s")
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _restore(self):
+        """Reload persisted jobs: queued ones are re-enqueued, interrupted ones marked failed."""
+        for job_id in os.listdir(self.directory):
+            try:
+                with open(os.path.join(self.directory, job_id, "job.json"), "r", encoding="utf-8") as f:
+                    job = Job.from_dict(json.load(f))
+            except Exception:
+                continue
+            if job.status == RUNNING:
+                job.status, job.error, job.finished_at = FAILED, "interrupted by a server restart", time.time()
+                job.done.set()
+                self._persist(job)
+            self.jobs[job.id] = job
+            if job.status == QUEUED:
+                self._queue.put_nowait(job)
+                JOBS_QUEUED.inc()
+                if job.fingerprint:
+                    self._inflight[job.fingerprint] = job
+
+    # ---------- API ----------
+    async def submit(self, question: str, files: List[StarletteUploadFile], cost: int = 1,
+                     max_wait_sec: Optional[float] = None, deadline_sec: Optional[float] = None,
+                     refresh: bool = False, token_budget: Optional[int] = None) -> Job:
+        """
+        Queue a pipeline run. An identical submission already queued or running is joined instead,
+        and a recent answer to it is served from the answer cache; `refresh` forces a new run.
+        Raises JobQueueFull, or helper_admission.Overloaded when saturated.
+        """
+        if self._queue is None:
+            raise RuntimeError("job manager not started")
+        fingerprint = await request_fingerprint(question, files, token_budget)
+        if not refresh:
+            job = self._inflight.get(fingerprint)
+            if job is not None and job.status not in FINAL_STATES:
+                job.coalesced += 1
+                ANSWER_REQUESTS.inc(outcome="coalesced")
+                job.publish("coalesced", requests=job.coalesced + 1)
+                return job
+            answer = await answer_cache.aget(fingerprint)
+            if answer is not None:
+                return self._from_cache(question, files, fingerprint, answer)
+        pending = self._queue.qsize() + self._accepting
+        if pending >= self.queue_max:
+            raise JobQueueFull(f"{pending} jobs already queued")
+        if max_wait_sec is not None:
+            admission.precheck(cost, queued_elsewhere=pending)
+        self._accepting += 1
+        try:
+            job = await self._accept(question, files, cost, max_wait_sec, deadline_sec, fingerprint, token_budget)
+        finally:
+            self._accepting -= 1
+        self._queue.put_nowait(job)
+        JOBS_QUEUED.inc()
+        ANSWER_REQUESTS.inc(outcome="refreshed" if refresh else "executed")
+        return job
+
+    async def _accept(self, question: str, files: List[StarletteUploadFile], cost: int,
+                      max_wait_sec: Optional[float], deadline_sec: Optional[float], fingerprint: str,
+                      token_budget: Optional[int] = None) -> Job:
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, question, [], cost=cost, max_wait_sec=max_wait_sec, deadline_sec=deadline_sec,
+                  token_budget=token_budget)
+        job.fingerprint = fingerprint
+        if deadline_sec is not None:
+            job.deadline_at = job.created_at + deadline_sec
+        # registered before the first await, so identical submissions arriving while this one spools join it
+        self.jobs[job_id] = job
+        self._inflight[fingerprint] = job
+        inputs_dir = os.path.join(self._job_dir(job_id), "inputs")
+        try:
+            os.makedirs(inputs_dir, exist_ok=True)
+            for i, uf in enumerate(files):
+                path = os.path.join(inputs_dir, f"{i:03d}_{os.path.basename(uf.filename or 'upload')}")
+                await uf.seek(0)
+                with open(path, "wb") as out:
+                    await asyncio.to_thread(shutil.copyfileobj, uf.file, out, 1024 * 1024)
+                job.inputs.append({"field": f"file{i}", "filename": uf.filename, "path": path,
+                                   "content_type": getattr(uf, "content_type", None)})
+        except BaseException as e:
+            self._finish(job, FAILED, error=f"could not spool inputs: {type(e).__name__}: {e}")
+            raise
+        job.publish("queued", job_id=job_id, files=[i["filename"] for i in job.inputs], position=self._queue.qsize() + 1)
+        self._persist(job)
+        return job
+
+    def _from_cache(self, question: str, files: List[StarletteUploadFile], fingerprint: str, answer: Any) -> Job:
+        """A job that is already finished with a cached answer; never queued or admitted."""
+        job = Job(uuid.uuid4().hex, question, [{"filename": uf.filename} for uf in files])
+        job.fingerprint, job.cached = fingerprint, True
+        self.jobs[job.id] = job
+        ANSWER_REQUESTS.inc(outcome="cache_hit")
+        job.publish("cache_hit", fingerprint=fingerprint[-12:])
+        self._finish(job, SUCCEEDED, result=answer)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is None or job.status in FINAL_STATES:
+            return job
+        if job.task is not None:
+            job.task.cancel()   # waiting for admission or running: the worker records the final state
+        else:
+            self._finish(job, CANCELLED, error="cancelled before it started")
+        return job
+
+    async def events(self, job_id: str, heartbeat_sec: float = 15.0) -> AsyncIterator[Optional[dict]]:
+        """
+        Past then live progress events for a job, ending with its "done" event.
+        Yields None every `heartbeat_sec` without news so streams can send a keep-alive.
+        """
+        job = self.jobs[job_id]
+        q: asyncio.Queue = asyncio.Queue()
+        job._subscribers.append(q)
+        try:
+            backlog = list(job.events)
+            if job.status in FINAL_STATES and not any(ev["event"] == "done" for ev in backlog):
+                # restored from disk: history is gone, report the outcome only
+                backlog.append({"seq": 0, "event": "done", "status": job.status, "error": job.error, "result": job.result})
+            last_seq = 0
+            for ev in backlog:
+                last_seq = max(last_seq, ev["seq"])
+                yield ev
+                if ev["event"] == "done":
+                    return
+            while True:
+                try:
+                    ev = await asyncio.wait_for(q.get(), heartbeat_sec)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if ev["seq"] <= last_seq:
+                    continue
+                yield ev
+                if ev["event"] == "done":
+                    return
+        finally:
+            job._subscribers.remove(q)
+
+    async def wait(self, job_id: str, timeout: Optional[float] = None) -> Job:
+        job = self.jobs[job_id]
+        await asyncio.wait_for(job.done.wait(), timeout)
+        return job
+
+    def stats(self) -> dict:
+        counts: Dict[str, int] = {}
+        for j in self.jobs.values():
+            counts[j.status] = counts.get(j.status, 0) + 1
+        return {"workers": self.workers, "queue_max": self.queue_max,
+                "queued": self._queue.qsize() if self._queue else 0, "by_status": counts,
+                "in_flight_fingerprints": len(self._inflight), "answer_cache": answer_cache.snapshot(),
+                "admission": admission.snapshot()}
+
+    # ---------- internals ----------
+    def _job_dir(self, job_id: str) -> str:
+        return os.path.join(self.directory, job_id)
+
+    def _persist(self, job: Job):
+        d = {**job.to_dict(), "question": job.question, "inputs": job.inputs}
+        path = os.path.join(self._job_dir(job.id), "job.json")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(d, f, default=str)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"[jobs] could not persist {job.id}: {e}")
+
+    def _finish(self, job: Job, status: str, result: Any = None, error: Optional[str] = None):
+        job.status, job.result, job.error = status, result, error
+        job.finished_at = time.time()
+        job.task = None
+        JOBS_TOTAL.inc(status=status)
+        if job.started_at:
+            job.ledger.close()
+        if job.fingerprint and self._inflight.get(job.fingerprint) is job:
+            del self._inflight[job.fingerprint]
+        # empty answers are the pipeline's parse fallback, degraded runs answered without some of
+        # their inputs, and budget-trimmed runs with cut contexts or smaller models; never serve those again
+        if status == SUCCEEDED and job.fingerprint and not job.cached and not job.degraded \
+                and not job.ledger.actions and result not in (None, {}, []):
+            answer_cache.set(job.fingerprint, result)
+        # inputs are only needed to run the job; keep the state file for the retention window
+        shutil.rmtree(os.path.join(self._job_dir(job.id), "inputs"), ignore_errors=True)
+        self._persist(job)
+        job.publish("done", status=status, error=error, result=result, llm_usage=job.ledger.summary())
+        job.done.set()
+
+    async def _run(self, job: Job, files: List[StarletteUploadFile], n: int):
+        deadline = job.created_at + job.max_wait_sec if job.max_wait_sec is not None else None
+        if job.deadline_at is not None:
+            deadline = job.deadline_at if deadline is None else min(deadline, job.deadline_at)
+        async with admission.slot(job.cost, deadline):
+            job.status, job.started_at = RUNNING, time.time()
+            if job.deadline_at is None:
+                job.deadline_at = job.started_at + REQUEST_DEADLINE_SEC
+            self._persist(job)
+            job.publish("started", worker=n, cost=job.cost, queued_sec=round(job.started_at - job.created_at, 3),
+                        deadline_in_sec=round(job.deadline_at - job.started_at, 3))
+            JOBS_RUNNING.inc()
+            try:
+                # every download, render, LLM call, poll and code run below clamps its timeout to this,
+                # and every LLM call is billed to the job's token ledger
+                with deadline_scope(job.deadline_at), ledger_scope(job.ledger):
+                    return await self.runner(job.question, files, job.id)
+            finally:
+                JOBS_RUNNING.dec()
+
+    async def _worker(self, n: int):
+        while True:
+            job = await self._queue.get()
+            JOBS_QUEUED.dec()
+            if job.status != QUEUED:
+                continue
+            files: List[StarletteUploadFile] = []
+            try:
+                # a spooled input gone or unreadable (e.g. after a restore) fails this job, not the worker
+                for i in job.inputs:
+                    files.append(StarletteUploadFile(open(i["path"], "rb"), filename=i["filename"]))
+                # The task copies the current context, so emit() inside the pipeline finds this job.
+                # Task name "req:<id>" lets the loop monitor and stage scheduler attribute work to it.
+                token = _current_job.set(job)
+                try:
+                    job.task = asyncio.create_task(self._run(job, files, n), name=f"req:{job.id[:8]}")
+                finally:
+                    _current_job.reset(token)
+                result = await job.task
+                if isinstance(result, dict) and result.get("error"):
+                    self._finish(job, FAILED, result=result, error=str(result["error"]))
+                else:
+                    self._finish(job, SUCCEEDED, result=result)
+            except Overloaded as e:
+                job.retry_after = e.retry_after
+                self._finish(job, REJECTED, error=f"not admitted: {e.reason}")
+            except asyncio.CancelledError:
+                if job.task is not None and job.task.cancelled():
+                    self._finish(job, CANCELLED, error="cancelled" + (" while running" if job.started_at else " before it started"))
+                else:
+                    self._finish(job, FAILED, error="job manager stopped")
+                    raise
+            except Exception as e:
+                self._finish(job, FAILED, error=f"{type(e).__name__}: {e}")
+            finally:
+                for uf in files:
+                    uf.file.close()
+
+    async def _sweeper(self):
+        while True:
+            await asyncio.sleep(JOB_SWEEP_SEC)
+            cutoff = time.time() - self.retention_sec
+            expired = [j for j in self.jobs.values() if j.status in FINAL_STATES and (j.finished_at or 0) < cutoff]
+            for job in expired:
+                self.jobs.pop(job.id, None)
+                await asyncio.to_thread(shutil.rmtree, self._job_dir(job.id), True)
+            if expired:
+                print(f"[jobs] expired {len(expired)} finished job(s)")
+
+
+job_manager = JobManager()
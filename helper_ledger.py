@@ -0,0 +1,146 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+from helper_metrics import Counter, Histogram, registry
+
+LLM_TOKEN_BUDGET     = int(os.getenv("LLM_REQUEST_TOKEN_BUDGET", "0"))          # tokens per request; 0: unlimited
+LLM_TOKEN_BUDGET_MAX = int(os.getenv("LLM_REQUEST_TOKEN_BUDGET_MAX", "2000000"))
+# Once less than this fraction of the budget is left, calls go to the fast model and are not escalated
+LLM_BUDGET_DOWNGRADE_FRACTION = float(os.getenv("LLM_BUDGET_DOWNGRADE_FRACTION", "0.5"))
+LLM_BUDGET_MIN_CONTEXT_CHARS  = int(os.getenv("LLM_BUDGET_MIN_CONTEXT_CHARS", "2000"))  # contexts never cut below this
+LLM_CHARS_PER_TOKEN           = float(os.getenv("LLM_CHARS_PER_TOKEN", "4"))           # pre-call size estimate
+
+TOKEN_BUDGET_HEADER = "x-token-budget"
+TOKEN_BUDGET_FIELD = "token_budget"
+USAGE_HEADER = "X-LLM-Usage"
+
+TOKEN_KINDS = ("input", "cache_read", "cache_write", "output")
+
+LLM_REQUEST_TOKENS = registry.register(Histogram(
+    "llm_request_tokens", "LLM tokens (all kinds) consumed per pipeline request", (),
+    buckets=(1e3, 5e3, 1e4, 2.5e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2e6)))
+LLM_REQUEST_CALLS = registry.register(Histogram(
+    "llm_request_calls", "LLM calls issued per pipeline request", (),
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34)))
+LLM_BUDGET_ACTIONS = registry.register(Counter(
+    "llm_budget_actions_total", "Token budget interventions (downgraded, truncated, escalation_skipped)",
+    ("caller", "action")))
+
+
+def parse_token_budget(value) -> Optional[int]:
+    """Client-supplied budget, clamped to LLM_REQUEST_TOKEN_BUDGET_MAX; None when absent or invalid."""
+    try:
+        n = int(float(value))
+    except (TypeError, ValueError):
+        return None
+    return min(n, LLM_TOKEN_BUDGET_MAX) if n > 0 else None
+
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text or "") / LLM_CHARS_PER_TOKEN) + 1
+
+
+class TokenLedger:
+    """
+    Every LLM call billed to one request: caller, model, tokens by kind and latency.
+    The budget is soft: calls are never refused, but contexts are cut and models
+    downgraded so that the request stays near it.
+    """
+    def __init__(self, budget: Optional[int] = None, calls: Optional[List[dict]] = None,
+                 actions: Optional[List[dict]] = None):
+        self.budget = budget if budget is not None else (LLM_TOKEN_BUDGET or None)
+        self.calls: List[dict] = list(calls or [])
+        self.actions: List[dict] = list(actions or [])   # budget interventions: the answer differs from an unbudgeted run
+        self._closed = False
+
+    def record(self, caller: str, provider: str, model: str, usage: Dict[str, int], seconds: float):
+        self.calls.append({"caller": caller, "provider": provider, "model": model,
+                           **{k: int(usage.get(k, 0) or 0) for k in TOKEN_KINDS},
+                           "seconds": round(seconds, 3), "at": round(time.time(), 3)})
+
+    def used(self) -> int:
+        return sum(c[k] for c in self.calls for k in TOKEN_KINDS)
+
+    def remaining(self) -> Optional[int]:
+        return None if self.budget is None else self.budget - self.used()
+
+    def tight(self) -> bool:
+        left = self.remaining()
+        return left is not None and left < self.budget * LLM_BUDGET_DOWNGRADE_FRACTION
+
+    def summary(self) -> dict:
+        totals = {k: sum(c[k] for c in self.calls) for k in TOKEN_KINDS}
+        by_caller: Dict[str, dict] = {}
+        for c in self.calls:
+            agg = by_caller.setdefault(c["caller"], {"calls": 0, "tokens": 0, "seconds": 0.0})
+            agg["calls"] += 1
+            agg["tokens"] += sum(c[k] for k in TOKEN_KINDS)
+            agg["seconds"] = round(agg["seconds"] + c["seconds"], 3)
+        return {"calls": len(self.calls), **totals, "total": sum(totals.values()),
+                "seconds": round(sum(c["seconds"] for c in self.calls), 3),
+                "budget": self.budget, "budget_actions": len(self.actions), "by_caller": by_caller}
+
+    def header(self) -> str:
+        s = self.summary()
+        parts = [f"{k}={s[k]}" for k in ("calls", *TOKEN_KINDS, "total", "seconds")]
+        if self.budget is not None:
+            parts.append(f"budget={self.budget}")
+        return "; ".join(parts)
+
+    def close(self):
+        """Report this request's totals to the per-request histograms (once)."""
+        if self._closed:
+            return
+        self._closed = True
+        LLM_REQUEST_TOKENS.observe(self.used())
+        LLM_REQUEST_CALLS.observe(len(self.calls))
+
+
+# The ledger of the request running in this context (set by the job worker)
+_ledger: contextvars.ContextVar[Optional[TokenLedger]] = contextvars.ContextVar("token_ledger", default=None)
+
+
+@contextmanager
+def ledger_scope(ledger: Optional[TokenLedger]):
+    """Bill every LLM call made in this context (and tasks it spawns) to `ledger`."""
+    token = _ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _ledger.reset(token)
+
+
+def current_ledger() -> Optional[TokenLedger]:
+    return _ledger.get()
+
+
+def budget_action(caller: str, action: str):
+    """Count a token budget intervention, on the metric and on the request's ledger."""
+    LLM_BUDGET_ACTIONS.inc(caller=caller, action=action)
+    ledger = _ledger.get()
+    if ledger is not None:
+        ledger.actions.append({"caller": caller, "action": action})
+
+
+def budget_tight() -> bool:
+    ledger = _ledger.get()
+    return ledger is not None and ledger.tight()
+
+
+def fit_context(caller: str, text: str, reserve_tokens: int = 0) -> str:
+    """
+    `text` cut (head kept) so that it plus `reserve_tokens` (fixed prompt and expected output)
+    fits what is left of the request's token budget; unchanged without a budget.
+    """
+    ledger = _ledger.get()
+    left = ledger.remaining() if ledger is not None else None
+    if left is None or not text:
+        return text
+    max_chars = max(LLM_BUDGET_MIN_CONTEXT_CHARS, int((left - reserve_tokens) * LLM_CHARS_PER_TOKEN))
+    if len(text) <= max_chars:
+        return text
+    budget_action(caller, "truncated")
+    print(f"[ledger] {caller}: context cut from {len(text)} to {max_chars} chars ({left} tokens left in budget)")
+    return text[:max_chars] + "\n...[truncated to fit the request token budget]"
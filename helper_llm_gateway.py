@@ -0,0 +1,368 @@
+import asyncio
+import email.utils
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+import httpx
+from anthropic import AsyncAnthropic, APIConnectionError, APIStatusError
+from dotenv import load_dotenv
+from helper_cache import content_key
+from helper_cassette import upstream_client, UPSTREAM_TIMEOUT_SEC
+from helper_deadline import bounded, clamp, current_deadline, detached_context, move_deadline, remaining
+from helper_ledger import current_ledger
+from helper_metrics import Counter, Gauge, Histogram, registry, span
+
+load_dotenv()
+ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+OPENAI_API_KEY    = os.getenv("OPENAI_API_KEY_2")
+OPENAI_BASE_URL   = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+
+
+def _parse_map(spec: str) -> Dict[str, str]:
+    """"a=x,b=y" -> {"a": "x", "b": "y"}"""
+    out = {}
+    for part in (spec or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            out[name.strip()] = value.strip()
+    return out
+
+
+def _parse_limits(spec: str) -> Dict[str, int]:
+    """"model=n,model2=n" -> {"model": n, ...}"""
+    return {k: int(v) for k, v in _parse_map(spec).items() if v.isdigit()}
+
+
+# Concurrent calls per provider, and per model within it (a model defaults to its provider's limit)
+LLM_PROVIDER_CONCURRENCY = {
+    "anthropic": int(os.getenv("LLM_MAX_CONCURRENCY_ANTHROPIC", "8")),
+    "openai":    int(os.getenv("LLM_MAX_CONCURRENCY_OPENAI", "8")),
+}
+LLM_MODEL_CONCURRENCY = _parse_limits(os.getenv("LLM_MODEL_CONCURRENCY", ""))
+LLM_MAX_RETRIES       = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE_SEC  = float(os.getenv("LLM_BACKOFF_BASE_SEC", "0.5"))
+LLM_BACKOFF_MAX_SEC   = float(os.getenv("LLM_BACKOFF_MAX_SEC", "30"))
+LLM_DEDUP_ENABLED     = os.getenv("LLM_DEDUP_ENABLED", "1") != "0"
+LLM_PROMPT_CACHE_ENABLED = os.getenv("LLM_PROMPT_CACHE_ENABLED", "1") != "0"
+
+# Hedging (opt-in): a call still pending after the recent p<LLM_HEDGE_PERCENTILE> attempt latency of its
+# model gets a duplicate (optionally on an alternate model); the first valid answer wins
+LLM_HEDGE_ENABLED           = os.getenv("LLM_HEDGE_ENABLED", "0") == "1"
+LLM_HEDGE_CALLERS           = {c.strip() for c in os.getenv("LLM_HEDGE_CALLERS", "").split(",") if c.strip()}  # empty: all
+LLM_HEDGE_PERCENTILE        = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+LLM_HEDGE_MIN_SAMPLES       = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_DEFAULT_DELAY_SEC = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_SEC", "20"))   # until enough samples
+LLM_HEDGE_MIN_DELAY_SEC     = float(os.getenv("LLM_HEDGE_MIN_DELAY_SEC", "1"))
+LLM_HEDGE_MAX_RATE          = float(os.getenv("LLM_HEDGE_MAX_RATE", "0.1"))   # hedges per hedge-eligible call
+LLM_HEDGE_WINDOW_SEC        = float(os.getenv("LLM_HEDGE_WINDOW_SEC", "300"))
+LLM_HEDGE_MODELS            = _parse_map(os.getenv("LLM_HEDGE_MODELS", ""))  # "model=alternate,..."
+
+# 529 is Anthropic's "overloaded"; 408/409 are documented as safe to retry
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+LLM_REQUESTS = registry.register(Counter(
+    "llm_requests_total", "LLM calls by caller and outcome", ("caller", "provider", "model", "outcome")))
+LLM_SECONDS = registry.register(Histogram(
+    "llm_request_duration_seconds", "LLM call latency as seen by the caller (queueing and retries included)",
+    ("caller", "provider")))
+LLM_TOKENS = registry.register(Counter(
+    "llm_tokens_total", "Tokens billed, attributed to the caller that issued the request "
+    "(kind: input = uncached input, cache_read, cache_write, output)",
+    ("caller", "provider", "model", "kind")))
+LLM_RETRIES = registry.register(Counter(
+    "llm_retries_total", "Retried upstream attempts", ("provider", "model", "reason")))
+LLM_IN_FLIGHT = registry.register(Gauge(
+    "llm_in_flight", "Upstream LLM requests currently being sent", ("provider",)))
+LLM_ATTEMPT_SECONDS = registry.register(Histogram(
+    "llm_attempt_duration_seconds", "Successful upstream attempts, wire time only (drives the hedge delay)",
+    ("provider", "model")))
+LLM_HEDGES = registry.register(Counter(
+    "llm_hedges_total", "Hedging decisions (fired, hedge_won, primary_won, rate_capped)",
+    ("caller", "provider", "model", "outcome")))
+
+
+def cacheable(text: str) -> dict:
+    """
+    A text block for a stable prompt prefix. On Anthropic it carries a cache breakpoint, so the
+    prefix up to and including it is served from the prompt cache on later calls. OpenAI caches
+    identical prefixes automatically; there, keeping static text first is all that is needed.
+    """
+    block = {"type": "text", "text": text}
+    if LLM_PROMPT_CACHE_ENABLED:
+        block["cache_control"] = {"type": "ephemeral"}
+    return block
+
+
+def message_text(msg) -> str:
+    """Concatenated text blocks of an Anthropic message."""
+    return "\n".join(getattr(b, "text", "") or "" for b in (getattr(msg, "content", None) or [])
+                     if getattr(b, "type", None) == "text").strip()
+
+
+def _retry_after(headers) -> Optional[float]:
+    """Seconds from retry-after-ms / retry-after (delta seconds or an HTTP date)."""
+    if headers is None:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _retryable(e: BaseException) -> Tuple[Optional[str], Optional[float]]:
+    """(reason, retry_after) when `e` is worth another attempt, (None, None) otherwise."""
+    if isinstance(e, APIStatusError):
+        if e.status_code in RETRY_STATUSES:
+            return str(e.status_code), _retry_after(e.response.headers)
+        return None, None
+    if isinstance(e, httpx.HTTPStatusError):
+        if e.response.status_code in RETRY_STATUSES:
+            return str(e.response.status_code), _retry_after(e.response.headers)
+        return None, None
+    if isinstance(e, (APIConnectionError, httpx.TransportError)):
+        return "connection", None
+    return None, None
+
+
+class LLMGateway:
+    """
+    Single entry point for every LLM call in the pipeline.
+    - one shared client per provider, on the pooled upstream httpx client (cassette-aware)
+    - per-provider and per-model concurrency limits; a slot is held only while a request is on the wire
+    - exponential backoff with jitter on 429/529/5xx/connection errors, honouring retry-after,
+      never sleeping past the request deadline
+    - identical requests in flight at the same time share one upstream call
+    - opt-in hedging of slow calls, capped to a fraction of eligible calls
+    - latency, outcome and token counters per caller, and a per-call entry in the request's token ledger
+    """
+    def __init__(self):
+        self._anthropic_client: Optional[AsyncAnthropic] = None
+        self._anthropic_http: Optional[httpx.AsyncClient] = None
+        self._provider_slots: Dict[str, asyncio.Semaphore] = {}
+        self._model_slots: Dict[Tuple[str, str], asyncio.Semaphore] = {}
+        self._inflight: Dict[str, List[Any]] = {}   # dedup key -> [task, waiters, context, deadline]
+        self._hedge_eligible: Deque[float] = deque()  # monotonic times of hedge-eligible calls / hedges fired,
+        self._hedges_fired: Deque[float] = deque()    # over the last LLM_HEDGE_WINDOW_SEC (rate cap)
+
+    # ---------- public API ----------
+    async def anthropic_messages(self, caller: str, dedup: bool = True, **params):
+        """messages.create(**params) through the gateway; returns the SDK Message."""
+        async def send(p: dict):
+            return await self._anthropic().messages.create(**p, timeout=clamp(UPSTREAM_TIMEOUT_SEC))
+
+        def valid(msg) -> bool:
+            return bool(message_text(msg))
+
+        def usage(msg) -> Dict[str, int]:
+            # input_tokens excludes the cached prefix, which is reported separately
+            u = getattr(msg, "usage", None)
+            return {"input": getattr(u, "input_tokens", 0) or 0,
+                    "cache_read": getattr(u, "cache_read_input_tokens", 0) or 0,
+                    "cache_write": getattr(u, "cache_creation_input_tokens", 0) or 0,
+                    "output": getattr(u, "output_tokens", 0) or 0}
+
+        return await self._call(caller, "anthropic", params, send, usage, valid, dedup)
+
+    async def openai_chat(self, caller: str, payload: dict, timeout: float = 90, dedup: bool = True) -> dict:
+        """POST /chat/completions through the gateway; returns the decoded JSON body."""
+        async def send(p: dict):
+            r = await upstream_client().post(
+                f"{OPENAI_BASE_URL}/chat/completions",
+                headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
+                json=p, timeout=clamp(timeout))
+            r.raise_for_status()
+            return r.json()
+
+        def valid(js) -> bool:
+            choices = (js or {}).get("choices") or []
+            return bool(choices and ((choices[0].get("message") or {}).get("content") or "").strip())
+
+        def usage(js) -> Dict[str, int]:
+            # prompt_tokens includes the cached prefix
+            u = (js or {}).get("usage") or {}
+            cached = ((u.get("prompt_tokens_details") or {}).get("cached_tokens")) or 0
+            return {"input": (u.get("prompt_tokens", 0) or 0) - cached, "cache_read": cached,
+                    "output": u.get("completion_tokens", 0) or 0}
+
+        return await self._call(caller, "openai", payload, send, usage, valid, dedup)
+
+    def snapshot(self) -> dict:
+        return {
+            "provider_limits": {p: LLM_PROVIDER_CONCURRENCY.get(p) for p in self._provider_slots},
+            "in_flight": {p: int(LLM_IN_FLIGHT.value(provider=p)) for p in self._provider_slots},
+            "shared_calls": len(self._inflight),
+        }
+
+    # ---------- internals ----------
+    def _anthropic(self) -> AsyncAnthropic:
+        # rebuilt if the shared upstream client was closed and replaced; retries are ours, not the SDK's
+        http = upstream_client()
+        if self._anthropic_client is None or self._anthropic_http is not http:
+            self._anthropic_client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=http, max_retries=0)
+            self._anthropic_http = http
+        return self._anthropic_client
+
+    @asynccontextmanager
+    async def _slot(self, provider: str, model: str):
+        limit = LLM_PROVIDER_CONCURRENCY.get(provider, 8)
+        provider_slot = self._provider_slots.setdefault(provider, asyncio.Semaphore(limit))
+        model_slot = self._model_slots.setdefault(
+            (provider, model), asyncio.Semaphore(LLM_MODEL_CONCURRENCY.get(model, limit)))
+        async with model_slot, provider_slot:
+            LLM_IN_FLIGHT.inc(provider=provider)
+            try:
+                yield
+            finally:
+                LLM_IN_FLIGHT.dec(provider=provider)
+
+    async def _call(self, caller: str, provider: str, params: dict, send: Callable[[dict], Awaitable[Any]],
+                    usage: Callable[[Any], Dict[str, int]], valid: Callable[[Any], bool], dedup: bool):
+        model = params.get("model", "")
+        t0 = time.perf_counter()
+        outcome = "error"
+        if LLM_HEDGE_ENABLED and (not LLM_HEDGE_CALLERS or caller in LLM_HEDGE_CALLERS):
+            run = lambda: self._hedged(caller, provider, params, send, usage, valid)
+        else:
+            run = lambda: self._execute(caller, provider, params, send, usage)
+        try:
+            with span(f"llm:{caller}"):
+                if dedup and LLM_DEDUP_ENABLED:
+                    result, shared = await self._shared(content_key("llm", provider, params), run)
+                else:
+                    result, shared = await bounded(run()), False
+            outcome = "shared" if shared else "ok"
+            return result
+        finally:
+            LLM_REQUESTS.inc(caller=caller, provider=provider, model=model, outcome=outcome)
+            LLM_SECONDS.observe(time.perf_counter() - t0, caller=caller, provider=provider)
+
+    async def _shared(self, key: str, make: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Join the identical call already in flight, or start it. Each caller waits under its own
+        deadline; the upstream call runs under the latest of its waiters' deadlines (not the first
+        caller's) and is cancelled only once nobody is waiting for it any more.
+        """
+        at = current_deadline()
+        entry = self._inflight.get(key)
+        shared = entry is not None
+        if entry is None:
+            ctx = detached_context(at)
+            entry = [asyncio.get_running_loop().create_task(make(), context=ctx), 0, ctx, at]
+            self._inflight[key] = entry
+            entry[0].add_done_callback(lambda _t: self._inflight.pop(key, None) if self._inflight.get(key) is entry else None)
+        elif entry[3] is not None and (at is None or at > entry[3]):
+            entry[3] = at   # a later (or unbounded) waiter extends the shared call
+            move_deadline(entry[2], at)
+        entry[1] += 1
+        try:
+            return await bounded(asyncio.shield(entry[0])), shared
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+
+    def _hedge_delay(self, provider: str, model: str) -> float:
+        observed = LLM_ATTEMPT_SECONDS.quantile(LLM_HEDGE_PERCENTILE, min_count=LLM_HEDGE_MIN_SAMPLES,
+                                                provider=provider, model=model)
+        return LLM_HEDGE_DEFAULT_DELAY_SEC if observed is None else max(LLM_HEDGE_MIN_DELAY_SEC, observed)
+
+    def _hedge_allowed(self) -> bool:
+        cutoff = time.monotonic() - LLM_HEDGE_WINDOW_SEC
+        for d in (self._hedge_eligible, self._hedges_fired):
+            while d and d[0] < cutoff:
+                d.popleft()
+        return len(self._hedges_fired) + 1 <= LLM_HEDGE_MAX_RATE * len(self._hedge_eligible)
+
+    async def _hedged(self, caller: str, provider: str, params: dict, send: Callable[[dict], Awaitable[Any]],
+                      usage: Callable[[Any], Dict[str, int]], valid: Callable[[Any], bool]):
+        """
+        Run the call; if it is still pending after the hedge delay (and the hedge-rate cap allows),
+        fire a duplicate, on LLM_HEDGE_MODELS[model] if configured. The first valid answer wins and
+        the other request is cancelled; if neither is valid the primary's outcome is returned.
+        """
+        model = params.get("model", "")
+        self._hedge_eligible.append(time.monotonic())
+        primary = asyncio.ensure_future(self._execute(caller, provider, params, send, usage))
+        lanes = {primary: "primary_won"}
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self._hedge_delay(provider, model))
+            if done:
+                return primary.result()
+            if not self._hedge_allowed():
+                LLM_HEDGES.inc(caller=caller, provider=provider, model=model, outcome="rate_capped")
+                return await primary
+
+            self._hedges_fired.append(time.monotonic())
+            alternate = LLM_HEDGE_MODELS.get(model, model)
+            LLM_HEDGES.inc(caller=caller, provider=provider, model=model, outcome="fired")
+            print(f"[llm_gateway] {caller}: {provider}/{model} slow, hedging on {alternate}")
+            hedge = asyncio.ensure_future(self._execute(caller, provider, {**params, "model": alternate}, send, usage))
+            lanes[hedge] = "hedge_won"
+            for t in lanes:
+                t.add_done_callback(lambda t: t.cancelled() or t.exception())  # the loser's error is not news
+            pending = set(lanes)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if not t.cancelled() and t.exception() is None and valid(t.result()):
+                        LLM_HEDGES.inc(caller=caller, provider=provider, model=model, outcome=lanes[t])
+                        return t.result()
+            return primary.result()
+        finally:
+            for t in lanes:
+                if not t.done():
+                    t.cancel()
+
+    async def _execute(self, caller: str, provider: str, params: dict,
+                       send: Callable[[dict], Awaitable[Any]], usage: Callable[[Any], Dict[str, int]]):
+        model = params.get("model", "")
+        started = time.perf_counter()
+        for n in range(LLM_MAX_RETRIES + 1):
+            async with self._slot(provider, model):
+                t0 = time.perf_counter()
+                try:
+                    result = await send(params)
+                    error = None
+                    LLM_ATTEMPT_SECONDS.observe(time.perf_counter() - t0, provider=provider, model=model)
+                except Exception as e:
+                    error = e
+            if error is None:
+                billed = usage(result)
+                for kind, tokens in billed.items():
+                    if tokens:
+                        LLM_TOKENS.inc(tokens, caller=caller, provider=provider, model=model, kind=kind)
+                # a shared call is billed once, to the request that started it
+                ledger = current_ledger()
+                if ledger is not None:
+                    ledger.record(caller, provider, model, billed, time.perf_counter() - started)
+                return result
+            reason, retry_after = _retryable(error)
+            if reason is None or n == LLM_MAX_RETRIES:
+                raise error
+            delay = retry_after if retry_after is not None else \
+                min(LLM_BACKOFF_MAX_SEC, LLM_BACKOFF_BASE_SEC * 2 ** n) * random.uniform(0.5, 1.0)
+            left = remaining()
+            if left is not None and delay >= left:
+                raise error   # the retry could not finish before the request deadline anyway
+            LLM_RETRIES.inc(provider=provider, model=model, reason=reason)
+            print(f"[llm_gateway] {caller}: {provider}/{model} {reason}, retry {n + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+llm_gateway = LLMGateway()
@@ -0,0 +1,154 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional
+
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR", "0") == "1"
+LOOP_STALL_MS        = float(os.getenv("LOOP_STALL_MS", "100"))   # a callback running longer than this is a stall
+LOOP_TICK_MS         = float(os.getenv("LOOP_TICK_MS", "20"))     # heartbeat period
+LOOP_MAX_OFFENDERS   = int(os.getenv("LOOP_MAX_OFFENDERS", "200"))
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def task_label(task: Optional[asyncio.Task]) -> tuple[str, str]:
+    """
+    Split a task name of the form "req:<id>:<stage>" (see StageScheduler / analyze)
+    into (request, stage). Anything else is reported as-is.
+    """
+    if task is None:
+        return "-", "(loop callback)"
+    name = task.get_name()
+    if name.startswith("req:"):
+        parts = name.split(":", 2)
+        return f"req:{parts[1]}", parts[2] if len(parts) > 2 else "(request)"
+    return "-", name
+
+
+class LoopMonitor:
+    """
+    Event-loop stall detector.
+    - a heartbeat coroutine measures scheduling lag every `tick_ms`
+    - a watchdog thread notices when the heartbeat is overdue by `stall_ms` and grabs the
+      loop thread's current stack plus the running task (-> request and pipeline stage)
+    - stalls are aggregated per offending call site and reported by report()
+    """
+    def __init__(self, stall_ms: float = LOOP_STALL_MS, tick_ms: float = LOOP_TICK_MS,
+                 max_offenders: int = LOOP_MAX_OFFENDERS):
+        self.stall_s = stall_ms / 1000.0
+        self.tick_s = tick_ms / 1000.0
+        self.max_offenders = max_offenders
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self._pending: Optional[dict] = None   # stack captured by the watchdog for the current stall
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.offenders: Dict[str, dict] = {}
+        self.stats = {"ticks": 0, "stalls": 0, "max_lag_ms": 0.0, "total_stall_ms": 0.0}
+
+    async def start(self):
+        if self._heartbeat_task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat(), name="loop_monitor")
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+        print(f"[loop_monitor] watching event loop: stall>{self.stall_s * 1000:.0f}ms tick={self.tick_s * 1000:.0f}ms")
+
+    async def stop(self):
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+
+    async def _heartbeat(self):
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self.tick_s)
+            now = time.monotonic()
+            lag = now - t0 - self.tick_s
+            with self._lock:
+                self._last_beat = now
+                self.stats["ticks"] += 1
+                self.stats["max_lag_ms"] = max(self.stats["max_lag_ms"], lag * 1000)
+                pending, self._pending = self._pending, None
+            if lag >= self.stall_s:
+                self._record(lag, pending)
+
+    def _watchdog(self):
+        while not self._stop.wait(self.tick_s / 2):
+            with self._lock:
+                overdue = time.monotonic() - self._last_beat - self.tick_s
+                if overdue < self.stall_s or self._pending is not None:
+                    continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            try:
+                task = asyncio.current_task(self._loop)
+            except Exception:
+                task = None
+            request, stage = task_label(task)
+            with self._lock:
+                self._pending = {"stack": stack, "request": request, "stage": stage}
+
+    def _record(self, lag: float, pending: Optional[dict]):
+        lag_ms = lag * 1000
+        if pending:
+            stack = pending["stack"]
+            ours = [f for f in stack if f.filename.startswith(REPO_DIR) and not f.filename.endswith(os.path.basename(__file__))]
+            site = ours[-1] if ours else stack[-1]
+            innermost = stack[-1]
+            key = f"{os.path.relpath(site.filename, REPO_DIR) if site.filename.startswith(REPO_DIR) else site.filename}:{site.lineno} {site.name}"
+            blocking_in = f"{innermost.filename}:{innermost.lineno} {innermost.name}"
+            request, stage = pending["request"], pending["stage"]
+            sample = "".join(traceback.format_list(stack[-12:]))
+        else:
+            key, blocking_in, request, stage, sample = "(unattributed)", "", "-", "-", ""
+
+        with self._lock:
+            self.stats["stalls"] += 1
+            self.stats["total_stall_ms"] += lag_ms
+            off = self.offenders.get(key)
+            if off is None:
+                if len(self.offenders) >= self.max_offenders:
+                    return
+                off = self.offenders[key] = {
+                    "site": key, "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                    "stages": {}, "last_request": None, "blocking_in": blocking_in, "sample_stack": sample,
+                }
+            off["count"] += 1
+            off["total_ms"] += lag_ms
+            off["stages"][stage] = off["stages"].get(stage, 0) + 1
+            off["last_request"] = request
+            if lag_ms >= off["max_ms"]:
+                off["max_ms"] = lag_ms
+                off["blocking_in"] = blocking_in
+                off["sample_stack"] = sample
+        print(f"[loop_monitor] loop stalled {lag_ms:.0f}ms at {key} (request={request} stage={stage})")
+
+    def report(self, limit: int = 50) -> dict:
+        with self._lock:
+            offenders = sorted(self.offenders.values(), key=lambda o: o["total_ms"], reverse=True)[:limit]
+            stats = dict(self.stats)
+        return {
+            "enabled": self._heartbeat_task is not None,
+            "stall_threshold_ms": self.stall_s * 1000,
+            "stats": {k: round(v, 1) if isinstance(v, float) else v for k, v in stats.items()},
+            "offenders": [
+                {**o, "total_ms": round(o["total_ms"], 1), "max_ms": round(o["max_ms"], 1),
+                 "avg_ms": round(o["total_ms"] / o["count"], 1)}
+                for o in offenders
+            ],
+        }
+
+
+loop_monitor = LoopMonitor()
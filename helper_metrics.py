@@ -0,0 +1,242 @@
+import contextvars
+import functools
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Seconds; spans range from a cached lookup to a multi-minute Powerdrill sync
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW = 1024  # recent observations kept per series for the quantile summary
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: Optional[Dict[str, str]] = None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+
+def _fmt_num(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_num(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Prometheus histogram plus a sliding-window quantile summary (`<name>_recent`)."""
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series: Dict[Tuple[str, ...], dict] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0, "window": deque(maxlen=WINDOW)}
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s["counts"][i] += 1
+                    break
+            s["sum"] += value
+            s["count"] += 1
+            s["window"].append(value)
+
+    def quantiles(self, **labels) -> Dict[float, float]:
+        with self._lock:
+            s = self._series.get(self._key(labels))
+            window = sorted(s["window"]) if s else []
+        return _quantiles(window)
+
+    def quantile(self, q: float, min_count: int = 1, **labels) -> Optional[float]:
+        """Any quantile of the recent window, or None with fewer than `min_count` observations."""
+        with self._lock:
+            s = self._series.get(self._key(labels))
+            window = sorted(s["window"]) if s else []
+        if len(window) < max(1, min_count):
+            return None
+        return window[min(len(window) - 1, max(0, int(math.ceil(q * len(window))) - 1))]
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def snapshot(self) -> Dict[Tuple[str, ...], dict]:
+        with self._lock:
+            return {k: {"count": s["count"], "sum": s["sum"], "quantiles": _quantiles(sorted(s["window"]))}
+                    for k, s in self._series.items()}
+
+    def render(self) -> List[str]:
+        lines = []
+        with self._lock:
+            series = [(k, list(s["counts"]), s["sum"], s["count"], sorted(s["window"])) for k, s in self._series.items()]
+        for key, counts, total, count, _ in series:
+            cumulative = 0
+            for b, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, {'le': _fmt_num(b)})} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_num(total)}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {count}")
+        # summary family with recent p50/p95/p99
+        lines.append(f"# HELP {self.name}_recent {self.help} (last {WINDOW} observations)")
+        lines.append(f"# TYPE {self.name}_recent summary")
+        for key, _, total, count, window in series:
+            for q, v in _quantiles(window).items():
+                lines.append(f"{self.name}_recent{_fmt_labels(self.labelnames, key, {'quantile': str(q)})} {_fmt_num(v)}")
+            lines.append(f"{self.name}_recent_sum{_fmt_labels(self.labelnames, key)} {_fmt_num(total)}")
+            lines.append(f"{self.name}_recent_count{_fmt_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def _quantiles(sorted_values: List[float]) -> Dict[float, float]:
+    if not sorted_values:
+        return {}
+    n = len(sorted_values)
+    return {q: sorted_values[min(n - 1, int(math.ceil(q * n)) - 1)] for q in QUANTILES}
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], List[str]]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, fn: Callable[[], List[str]]):
+        """fn returns ready-made exposition lines (HELP/TYPE included)."""
+        self._collectors.append(fn)
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m.render())
+        for fn in self._collectors:
+            try:
+                lines.extend(fn())
+            except Exception as e:
+                lines.append(f"# collector error: {e}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    "pipeline_stage_duration_seconds", "Wall time per pipeline stage", ("stage",)))
+STAGE_ERRORS = registry.register(Counter(
+    "pipeline_stage_errors_total", "Stages that raised", ("stage",)))
+STAGES_INFLIGHT = registry.register(Gauge(
+    "pipeline_stages_in_flight", "Stages currently running", ("stage",)))
+REQUEST_SECONDS = registry.register(Histogram(
+    "pipeline_request_duration_seconds", "End-to-end wall time per request", ("endpoint",)))
+REQUESTS_INFLIGHT = registry.register(Gauge(
+    "pipeline_requests_in_flight", "Requests currently being processed", ("endpoint",)))
+
+# Spans recorded during the current request, for the per-request timing log
+_request_spans: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("request_spans", default=None)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block as `stage`: histogram + in-flight gauge + the request's span list."""
+    STAGES_INFLIGHT.inc(stage=stage)
+    t0 = time.perf_counter()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        dt = time.perf_counter() - t0
+        STAGES_INFLIGHT.dec(stage=stage)
+        STAGE_SECONDS.observe(dt, stage=stage)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((stage, dt, ok))
+
+
+def timed(stage: str):
+    """Decorator form of span() for async functions."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+@contextmanager
+def request_timer(endpoint: str):
+    """Track one request: in-flight gauge, end-to-end histogram, and a span list for its log line."""
+    spans: list = []
+    token = _request_spans.set(spans)
+    REQUESTS_INFLIGHT.inc(endpoint=endpoint)
+    t0 = time.perf_counter()
+    try:
+        yield spans
+    finally:
+        dt = time.perf_counter() - t0
+        REQUESTS_INFLIGHT.dec(endpoint=endpoint)
+        REQUEST_SECONDS.observe(dt, endpoint=endpoint)
+        _request_spans.reset(token)
+        summary = ", ".join(f"{s}={d:.2f}s{'' if ok else '!'}" for s, d, ok in spans)
+        print(f"[metrics] {endpoint} {dt:.2f}s :: {summary}")
@@ -0,0 +1,125 @@
+import os
+import time
+from typing import Any, Awaitable, Callable, List, NamedTuple, Optional, Tuple
+from helper_deadline import DeadlineExceeded
+from helper_ledger import budget_action, budget_tight
+from helper_metrics import Counter, Histogram, registry
+
+ROUTER_ENABLED = os.getenv("MODEL_ROUTER_ENABLED", "1") != "0"   # off: every call on the large model
+
+ROUTER_LARGE_MODEL        = os.getenv("ROUTER_LARGE_MODEL", "claude-3-5-sonnet-20241022")
+ROUTER_FAST_MODEL         = os.getenv("ROUTER_FAST_MODEL", "claude-3-5-haiku-20241022")
+ROUTER_FAST_VISION_MODEL  = os.getenv("ROUTER_FAST_VISION_MODEL", ROUTER_FAST_MODEL)
+ROUTER_OPENAI_FAST_MODEL  = os.getenv("ROUTER_OPENAI_FAST_MODEL", "gpt-4o-mini")
+ROUTER_OPENAI_LARGE_MODEL = os.getenv("ROUTER_OPENAI_LARGE_MODEL", "gpt-4o")
+
+# Inputs at or under these sizes go to the fast model first
+ROUTER_HTML_FAST_MAX_CHARS   = int(os.getenv("ROUTER_HTML_FAST_MAX_CHARS", "20000"))
+ROUTER_PDF_FAST_MAX_BYTES    = int(os.getenv("ROUTER_PDF_FAST_MAX_BYTES", str(300 * 1024)))
+ROUTER_IMAGE_FAST_MAX_IMAGES = int(os.getenv("ROUTER_IMAGE_FAST_MAX_IMAGES", "2"))
+ROUTER_SQL_FAST_MAX_CHARS    = int(os.getenv("ROUTER_SQL_FAST_MAX_CHARS", "40000"))
+ROUTER_MIN_ANSWER_CHARS      = int(os.getenv("ROUTER_MIN_ANSWER_CHARS", "20"))
+
+ROUTE_SECONDS = registry.register(Histogram(
+    "llm_route_duration_seconds", "Routed LLM calls, end to end including escalation", ("caller", "route")))
+ROUTE_CALLS = registry.register(Counter(
+    "llm_route_calls_total", "Routed LLM calls by outcome (ok, escalated, invalid)", ("caller", "route", "model", "outcome")))
+
+_REFUSALS = ("i'm sorry", "i am sorry", "i cannot", "i can't", "i am unable", "i'm unable")
+
+
+class Route(NamedTuple):
+    name: str                     # "fast" / "large" / "downgraded"; the label the stats are kept under
+    model: str
+    escalate_to: Optional[str]    # retried here when the output fails validation
+
+    def models(self) -> List[str]:
+        """Every model that may produce this route's answer, first choice first (keys for cached answers)."""
+        return [self.model] + ([self.escalate_to] if self.escalate_to else [])
+
+
+def _pick(fast: bool, fast_model: str, large_model: str) -> Route:
+    if fast and ROUTER_ENABLED and fast_model != large_model:
+        return Route("fast", fast_model, large_model)
+    return Route("large", large_model, None)
+
+
+def choose(caller: str, input_chars: int = 0, input_bytes: int = 0, images: int = 0) -> Route:
+    """
+    Model for one call from who is asking and how big the input is. Extraction agents
+    start small inputs on the fast model; master code generation always gets the large one.
+    Once the request's token budget runs low, every caller gets its fast model, without escalation.
+    """
+    if ROUTER_ENABLED and budget_tight():
+        fast = ROUTER_OPENAI_FAST_MODEL if caller == "sql_parquet_json_agent" else \
+            ROUTER_FAST_VISION_MODEL if caller == "image_agent" else ROUTER_FAST_MODEL
+        budget_action(caller, "downgraded")
+        return Route("downgraded", fast, None)
+    if caller == "html_agent":
+        return _pick(input_chars <= ROUTER_HTML_FAST_MAX_CHARS, ROUTER_FAST_MODEL, ROUTER_LARGE_MODEL)
+    if caller == "pdf_agent":
+        return _pick(input_bytes <= ROUTER_PDF_FAST_MAX_BYTES, ROUTER_FAST_MODEL, ROUTER_LARGE_MODEL)
+    if caller == "image_agent":
+        return _pick(images <= ROUTER_IMAGE_FAST_MAX_IMAGES, ROUTER_FAST_VISION_MODEL, ROUTER_LARGE_MODEL)
+    if caller == "sql_parquet_json_agent":
+        return _pick(input_chars <= ROUTER_SQL_FAST_MAX_CHARS, ROUTER_OPENAI_FAST_MODEL, ROUTER_OPENAI_LARGE_MODEL)
+    return Route("large", ROUTER_LARGE_MODEL, None)
+
+
+def valid_answer(text: str) -> bool:
+    """An extraction answer worth passing on: long enough and not a refusal."""
+    t = (text or "").strip()
+    return len(t) >= ROUTER_MIN_ANSWER_CHARS and not t.lower().startswith(_REFUSALS)
+
+
+def valid_python(text: str) -> bool:
+    """Generated code that at least compiles, as-is (it is executed without any cleaning)."""
+    try:
+        compile(text or "", "<generated>", "exec")
+        return bool((text or "").strip())
+    except (SyntaxError, ValueError):
+        return False
+
+
+async def routed(caller: str, route: Route, invoke: Callable[[str], Awaitable[Any]], validate: Callable[[Any], bool]) -> Any:
+    """
+    invoke(route.model); when its output fails `validate` (or the call errors) and the route
+    has a larger model, invoke that instead. Outcomes and latency are recorded per route.
+    """
+    result, _ = await routed_with_model(caller, route, invoke, validate)
+    return result
+
+
+async def routed_with_model(caller: str, route: Route, invoke: Callable[[str], Awaitable[Any]],
+                            validate: Callable[[Any], bool]) -> Tuple[Any, str]:
+    """`routed`, also returning the model that produced the result (route.model or its escalation)."""
+    t0 = time.perf_counter()
+    try:
+        try:
+            result = await invoke(route.model)
+            error = None
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if not route.escalate_to:
+                raise
+            result, error = None, e
+        if error is None and validate(result):
+            ROUTE_CALLS.inc(caller=caller, route=route.name, model=route.model, outcome="ok")
+            return result, route.model
+        if not route.escalate_to or budget_tight():
+            if route.escalate_to:
+                budget_action(caller, "escalation_skipped")
+            ROUTE_CALLS.inc(caller=caller, route=route.name, model=route.model, outcome="invalid")
+            if error is not None:
+                raise error
+            return result, route.model
+        reason = f"{type(error).__name__}: {error}" if error else "output failed validation"
+        print(f"[model_router] {caller}: {route.model} -> {route.escalate_to} ({reason[:120]})")
+        ROUTE_CALLS.inc(caller=caller, route=route.name, model=route.model, outcome="escalated")
+        result = await invoke(route.escalate_to)
+        ROUTE_CALLS.inc(caller=caller, route=route.name, model=route.escalate_to,
+                        outcome="ok" if validate(result) else "invalid")
+        return result, route.escalate_to
+    finally:
+        ROUTE_SECONDS.observe(time.perf_counter() - t0, caller=caller, route=route.name)
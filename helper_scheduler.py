@@ -0,0 +1,119 @@
+import asyncio
+import time
+import traceback
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+
+class StageSkipped(Exception):
+    """Raised for a stage whose dependency failed or was skipped."""
+
+
+class StageScheduler:
+    """
+    Tiny dependency-aware scheduler for one request.
+    - add(name, fn, deps) registers an async stage; fn receives the results of its deps as kwargs
+    - run() starts every stage as soon as its deps are done and waits for all of them
+    - a failing stage never takes down its siblings; its dependents are skipped
+      (a stage cut off by the run timeout takes its waiting dependents down as cut off too)
+    Results: self.results[name] (only successful stages), self.errors[name] (exception).
+    on_stage_done(name, result, error, seconds) is called as each stage settles (progress reporting).
+    """
+    def __init__(self, label: str = "scheduler",
+                 on_stage_done: Optional[Callable[[str, Any, Optional[BaseException], float], None]] = None):
+        self.label = label
+        self.on_stage_done = on_stage_done
+        self._stages: Dict[str, tuple[Callable[..., Awaitable[Any]], tuple[str, ...]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.results: Dict[str, Any] = {}
+        self.errors: Dict[str, BaseException] = {}
+        self.durations: Dict[str, float] = {}
+
+    def add(self, name: str, fn: Callable[..., Awaitable[Any]], deps: Iterable[str] = ()) -> None:
+        if name in self._stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        self._stages[name] = (fn, tuple(deps))
+
+    async def _run_stage(self, name: str) -> Any:
+        fn, deps = self._stages[name]
+        dep_results = {}
+        for d in deps:
+            try:
+                dep_results[d] = await self._tasks[d]
+            except asyncio.CancelledError:
+                # this stage or its dependency was cut off by run(timeout): run() records it as a timeout
+                raise
+            except BaseException as e:
+                skipped = StageSkipped(f"{name}: dependency '{d}' did not complete ({type(e).__name__})")
+                self._notify(name, None, skipped)
+                raise skipped from e
+        t0 = time.perf_counter()
+        try:
+            result = await fn(**dep_results)
+        except Exception as e:
+            self.durations[name] = time.perf_counter() - t0
+            self._notify(name, None, e)
+            raise
+        self.durations[name] = time.perf_counter() - t0
+        self._notify(name, result, None)
+        return result
+
+    def _notify(self, name: str, result: Any, error: Optional[BaseException]) -> None:
+        if self.on_stage_done is None:
+            return
+        try:
+            self.on_stage_done(name, result, error, self.durations.get(name, 0.0))
+        except Exception as e:
+            print(f"[{self.label}] on_stage_done hook failed for '{name}': {e}")
+
+    async def run(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Run all stages. With `timeout`, stages still running when it expires are cancelled
+        and recorded as asyncio.TimeoutError; whatever finished is kept.
+        """
+        for d in (d for _, deps in self._stages.values() for d in deps):
+            if d not in self._stages:
+                raise ValueError(f"Unknown dependency: {d}")
+        t0 = time.perf_counter()
+        for name in self._stages:
+            self._tasks[name] = asyncio.create_task(self._run_stage(name), name=f"{self.label}:{name}")
+
+        names = list(self._tasks)
+        if self._tasks:
+            try:
+                _, pending = await asyncio.wait(self._tasks.values(), timeout=timeout)
+            except asyncio.CancelledError:
+                # the request itself was cancelled: take every stage down with it
+                for t in self._tasks.values():
+                    t.cancel()
+                raise
+            for t in pending:
+                t.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        outcomes = []
+        for name in names:
+            task = self._tasks[name]
+            if task.cancelled():
+                err = asyncio.TimeoutError(f"stage '{name}' cut off after {time.perf_counter() - t0:.1f}s")
+                self.durations.setdefault(name, time.perf_counter() - t0)
+                self._notify(name, None, err)
+                outcomes.append(err)
+            else:
+                outcomes.append(task.exception() or task.result())
+        for name, out in zip(names, outcomes):
+            if isinstance(out, BaseException):
+                self.errors[name] = out
+                if isinstance(out, asyncio.TimeoutError) and self._tasks[name].cancelled():
+                    print(f"[{self.label}] stage '{name}' cut off at the deadline")
+                elif isinstance(out, StageSkipped):
+                    print(f"[{self.label}] stage '{name}' skipped: {out}")
+                else:
+                    print(f"[{self.label}] stage '{name}' failed after {self.durations.get(name, 0):.2f}s:")
+                    print("".join(traceback.format_exception(type(out), out, out.__traceback__)))
+            else:
+                self.results[name] = out
+                print(f"[{self.label}] stage '{name}' done in {self.durations.get(name, 0):.2f}s")
+        return self.results
+
+    def get(self, name: str, default: Optional[Any] = None) -> Any:
+        return self.results.get(name, default)
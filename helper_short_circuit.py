@@ -0,0 +1,287 @@
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple, Union
+from helper_metrics import Counter, registry
+
+SHORT_CIRCUIT_ENABLED = os.getenv("SHORT_CIRCUIT_ENABLED", "1") != "0"
+
+SHORT_CIRCUITS = registry.register(Counter(
+    "pipeline_short_circuit_total", "Master-agent short-circuit decisions (fired: a specialist's output was "
+    "returned directly, saving the master LLM call and the code run)", ("outcome", "source")))
+
+# Answers that need rendering work (plots, encoded images) always go through the master agent
+_RENDER_TERMS = re.compile(r"base-?64|data uri|\bplot|\bchart|scatterplot|\bdraw\b|\bpng\b|histogram", re.I)
+_LOCATIONS = re.compile(r"https?://\S+|\S+\.[A-Za-z0-9]{2,5}\b")
+_NUMBERED = re.compile(r"^\s*(?:q\s*)?\d+[.):]\s+\S", re.I | re.M)
+_KEY_LINE = re.compile(r"^\s*[-*]\s*[`\"']([\w .-]+)[`\"']\s*:\s*(\w+)", re.M)
+_FENCE = re.compile(r"^```[a-zA-Z]*\s*|\s*```\s*$")
+_PLACEHOLDER_NUM = re.compile(r"num|int|float|number|count|total|sum|mean|avg|pct|percent|corr", re.I)
+
+# Shape tree: ("list", [children], variadic) | ("object", [keys] or None) | "number" | "string" | "any"
+Shape = Union[str, Tuple]
+
+
+def _opens_string(text: str, pos: int) -> bool:
+    """A quote starting a string token: always for ", for ' only at a token start (not "What's")."""
+    if text[pos] == '"':
+        return True
+    if text[pos] != "'":
+        return False
+    i = pos - 1
+    while i >= 0 and text[i].isspace():
+        i -= 1
+    return i < 0 or text[i] in "{[,:"
+
+
+def _string_end(text: str, pos: int) -> int:
+    """Index just past the quoted string starting at `pos` (backslash escapes honoured)."""
+    quote, i = text[pos], pos + 1
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+            continue
+        if text[i] == quote:
+            return i + 1
+        i += 1
+    return len(text)
+
+
+def _object_keys(body: str) -> List[str]:
+    """Quoted keys (a string followed by ":") at the top level of an object body (the text after its "{")."""
+    keys, depth, pos = [], 0, 0
+    while pos < len(body):
+        if _opens_string(body, pos):
+            end = _string_end(body, pos)
+            if depth == 0 and body[end:].lstrip().startswith(":"):
+                keys.append(body[pos + 1:end - 1])
+            pos = end
+            continue
+        depth += {"{": 1, "[": 1, "}": -1, "]": -1}.get(body[pos], 0)
+        pos += 1
+    return keys
+
+
+def _leaf(token: str) -> Optional[Shape]:
+    t = token.strip().strip(",")
+    if not t:
+        return None
+    if re.search(r"\.\s*\.\s*\.|…", t):
+        return "..."   # "a, b, ..." / "[. . . text . . .]": any number of elements
+    inner = t.strip("<>\"' ")
+    if t.startswith(("\"", "'")) and t.endswith(("\"", "'")):
+        return "string"
+    if t.startswith("<") and t.endswith(">"):
+        if re.search(r"\bstr|string|text|name|method", inner, re.I):
+            return "string"
+        if _PLACEHOLDER_NUM.search(inner):
+            return "number"
+    return "any"
+
+
+def _template_shape(template: str) -> Optional[Shape]:
+    """Parse a bracket template like `[<num>, [<str>, ...], "<name>"]` into a shape tree."""
+    stack: List[list] = [[]]
+    variadic: List[bool] = [False]
+    buf = ""
+    pos = 0
+    while pos < len(template):
+        if _opens_string(template, pos):   # brackets and commas inside a string are text
+            end = _string_end(template, pos)
+            buf += template[pos:end]
+            pos = end
+            continue
+        ch = template[pos]
+        pos += 1
+        if ch in "[{":
+            if ch == "{":
+                depth, start = 1, pos
+                while pos < len(template) and depth:
+                    if _opens_string(template, pos):
+                        pos = _string_end(template, pos)
+                        continue
+                    depth += {"{": 1, "}": -1}.get(template[pos], 0)
+                    pos += 1
+                keys = _object_keys(template[start:pos])
+                # literal key names are only trusted when they are not themselves placeholders
+                concrete = [k for k in keys if not re.fullmatch(r"name|key|<.*>|\w+_\d+", k)]
+                stack[-1].append(("object", concrete if concrete and len(concrete) == len(keys) else None))
+                buf = ""
+                continue
+            stack.append([])
+            variadic.append(False)
+            buf = ""
+        elif ch in "],\n":
+            leaf = _leaf(buf)
+            buf = ""
+            if leaf == "...":
+                variadic[-1] = True
+            elif leaf is not None:
+                stack[-1].append(leaf)
+            if ch == "]" and len(stack) > 1:
+                children, var = stack.pop(), variadic.pop()
+                stack[-1].append(("list", children, var))
+        else:
+            buf += ch
+    top = stack[0]
+    return top[0] if len(top) == 1 and isinstance(top[0], tuple) else None
+
+
+def _template_text(question: str) -> Optional[str]:
+    """The last bracketed answer template in the question: a fenced block, or lines starting with [ / {."""
+    fences = re.findall(r"```\s*(?:json)?\s*\n?([\s\S]*?)(?:```|$)", question, re.I)
+    for body in reversed(fences):
+        body = body.strip()
+        if body.startswith(("[", "{")):
+            return body
+    starts = [m.start(1) for m in re.finditer(r"^\s*([\[{])", question, re.M)]
+    if not starts:
+        return None
+    start = starts[0]
+    # the template is the last top-level bracket group in the question
+    depth, begin, i = 0, None, start
+    while i < len(question):
+        if depth and _opens_string(question, i):
+            i = _string_end(question, i)
+            continue
+        ch = question[i]
+        i += 1
+        if ch in "[{":
+            if depth == 0:
+                begin = i - 1
+            depth += 1
+        elif ch in "]}" and depth:
+            depth -= 1
+    return question[begin:] if begin is not None else None
+
+
+def parse_output_shape(question: str) -> Optional[Shape]:
+    """
+    The answer shape questions.txt asks for, when it is strict enough to check an answer against:
+    an explicit bracket template, a "JSON array (of strings)" over numbered questions, or an object
+    with its keys listed as "- `key`: type". None for anything looser, or for answers that need a plot.
+    """
+    if _RENDER_TERMS.search(_LOCATIONS.sub(" ", question)):   # "chart.png" as an input is not a plot request
+        return None
+    template = _template_text(question)
+    if template:
+        shape = _template_shape(template)
+        if shape and shape[0] == "list" and not shape[2] and shape[1]:
+            return shape
+        if shape and shape[0] == "object" and shape[1]:
+            return shape
+    keys = _KEY_LINE.findall(question)
+    if keys and re.search(r"json object", question, re.I):
+        return ("object", [k for k, _ in keys], {k: t.lower() for k, t in keys})
+    m = re.search(r"json array(?: of (strings|numbers))?", question, re.I)
+    n = len(_NUMBERED.findall(question))
+    if m and n:
+        leaf = {"strings": "string", "numbers": "number"}.get((m.group(1) or "").lower(), "any")
+        return ("list", [leaf] * n, False)
+    return None
+
+
+def _is_number(v: Any) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def matches(shape: Shape, value: Any) -> bool:
+    if shape == "number":
+        return _is_number(value)
+    if shape == "string":
+        return isinstance(value, str) and bool(value.strip())
+    if shape == "any":
+        return value is not None and value != "" and value != [] and value != {}
+    kind = shape[0]
+    if kind == "list":
+        _, children, variadic = shape
+        if not isinstance(value, list) or not value:
+            return False
+        if variadic:
+            return all(v is not None for v in value)
+        return len(value) == len(children) and all(matches(c, v) for c, v in zip(children, value))
+    if kind == "object":
+        if not isinstance(value, dict) or not value:
+            return False
+        keys = shape[1]
+        if keys is None:
+            return all(v is not None for v in value.values())
+        types = shape[2] if len(shape) > 2 else {}
+        if set(value) != set(keys):
+            return False
+        for k in keys:
+            t = types.get(k, "")
+            if value[k] is None or (t in ("number", "integer", "float", "int") and not _is_number(value[k])) \
+                    or (t in ("string", "str") and not isinstance(value[k], str)):
+                return False
+        return True
+    return False
+
+
+def _parse_json(text: str) -> Optional[Any]:
+    """The JSON answer in a specialist's output: the whole text, its last line, or a trailing JSON block."""
+    text = _FENCE.sub("", (text or "").strip())
+    if not text:
+        return None
+    lines = [ln for ln in text.splitlines() if ln.strip()]
+    m = re.search(r"(\{[\s\S]*\}|\[[\s\S]*\])\s*$", text)
+    for candidate in (text, lines[-1] if lines else "", m.group(1) if m else ""):
+        if candidate and candidate.lstrip()[:1] in ("[", "{"):
+            try:
+                return json.loads(candidate)
+            except ValueError:
+                continue
+    return None
+
+
+def _sources(contexts: Dict[str, Any]) -> Dict[str, str]:
+    """Non-empty specialist outputs by source; the archive agent contributes one per file kind."""
+    out: Dict[str, str] = {}
+    for name, ctx in contexts.items():
+        for item in ctx or []:
+            if not isinstance(item, dict):
+                continue
+            # "stdout": the raw output of code a specialist ran, when its content is a summary of it
+            content = item.get("stdout") if "stdout" in item else item.get("content")
+            if isinstance(content, dict):
+                out.update({f"{name}:{k}": str(v) for k, v in content.items() if v})
+            elif content:
+                out[name] = str(content)
+    return out
+
+
+def short_circuit(question: str, contexts: Dict[str, Any],
+                  errors: Optional[Dict[str, BaseException]] = None) -> Optional[Tuple[str, Any]]:
+    """
+    (source, answer) when the only specialist that produced anything already returned JSON in exactly
+    the shape the question asks for; None when the master agent has to run. With several sources
+    the master combines them, so the fast path only applies to single-source requests, and never
+    when a stage failed or was cut off (`errors`, StageScheduler.errors, or the "errors" a context
+    item reports, like the archive agent's failed file kinds): the "only" source may just be the
+    only one that finished.
+    """
+    if not SHORT_CIRCUIT_ENABLED:
+        return None
+    failed = dict(errors or {})
+    for name, ctx in contexts.items():
+        for item in ctx or []:
+            if isinstance(item, dict) and item.get("errors"):
+                failed.update({f"{name}:{k}": e for k, e in item["errors"].items()})
+    if failed:
+        SHORT_CIRCUITS.inc(outcome="stage_errors", source="")
+        return None
+    shape = parse_output_shape(question)
+    if shape is None:
+        SHORT_CIRCUITS.inc(outcome="no_shape", source="")
+        return None
+    sources = _sources(contexts)
+    if len(sources) != 1:
+        SHORT_CIRCUITS.inc(outcome="multiple_sources" if sources else "no_output", source="")
+        return None
+    (source, text), = sources.items()
+    answer = _parse_json(text)
+    if answer is None or not matches(shape, answer):
+        SHORT_CIRCUITS.inc(outcome="no_match", source=source)
+        return None
+    SHORT_CIRCUITS.inc(outcome="fired", source=source)
+    return source, answer
@@ -1,13 +1,11 @@
 import os
-import asyncio
-from dotenv import load_dotenv
-from anthropic import AsyncAnthropic
-
-load_dotenv()
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-
-anthropic_client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+from helper_cache import agent_cache, content_key, normalize_task
+from helper_metrics import timed
+from helper_llm_gateway import llm_gateway, message_text
+from helper_model_router import choose, routed_with_model, valid_answer
+from helper_ledger import estimate_tokens, fit_context
 
+@timed("html_agent")
 async def html_agent(rendered_html: str, task_description: str = "") -> str:
     """
     Uses Claude 3.5 to extract relevant structured content from rendered HTML.
@@ -23,17 +21,29 @@ Do not bother about other files mentioned in the task. Your job is to:
 - Do not Hallucinate and do not fabricate data.
 - Provide clean, parseable output for full data ingestion. """
 
+    rendered_html = fit_context("html_agent", rendered_html,
+                                reserve_tokens=estimate_tokens(system_prompt + (task_description or "")) + 1500)
     user_prompt = f"Task: {task_description}\n\nHTML:\n{rendered_html}"
+    route = choose("html_agent", input_chars=len(rendered_html or ""))
+
+    cached, cache_keys = await agent_cache.get_routed(
+        route, lambda m: content_key("html_agent", m, normalize_task(task_description), rendered_html))
+    if cached is not None:
+        print("[html_agent] cache hit")
+        return cached
 
-    response = await anthropic_client.messages.create(
-        model="claude-3-5-sonnet-20241022",
+    response, answered_by = await routed_with_model("html_agent", route, lambda m: llm_gateway.anthropic_messages(
+        "html_agent",
+        model=m,
         max_tokens=1500,
         temperature=0.3,
         system=system_prompt,
         messages=[{"role": "user", "content": user_prompt}]
-    )
+    ), lambda r: valid_answer(message_text(r)))
 
     try:
-        return response.content[0].text.strip()
+        answer = response.content[0].text.strip()
+        agent_cache.set(cache_keys[answered_by], answer)
+        return answer
     except Exception as e:
         return f"Error parsing Anthropic response: {e}"
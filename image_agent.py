@@ -1,20 +1,21 @@
 import os
 import asyncio
 from dotenv import load_dotenv
-from anthropic import AsyncAnthropic
 from PIL import Image
 from io import BytesIO
 import base64
-import httpx
 from typing import List, Optional
 from fastapi import UploadFile
 import mimetypes
 import asyncio
 from io import BytesIO
 from starlette.datastructures import UploadFile as StarletteUploadFile
+from helper_http import fetch_many
+from helper_cache import agent_cache, content_key, normalize_task
+from helper_metrics import timed
+from helper_llm_gateway import llm_gateway, message_text
+from helper_model_router import Route, choose, routed_with_model, valid_answer
 load_dotenv()
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-anthropic_client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
 
 def _downscale_image_bytes(data: bytes, max_side: int = 1400, jpeg_quality: int = 85) -> bytes:
     """Downscale to reduce tokens. If Pillow missing or fails, return original."""
@@ -32,6 +33,7 @@ def _downscale_image_bytes(data: bytes, max_side: int = 1400, jpeg_quality: int
         print(f"[image_agent] downscale failed, sending original. err={e}")
         return data
 
+@timed("image_agent")
 async def image_agent(
     image_files: Optional[List[UploadFile]] = None,
     image_urls: Optional[List[str]] = None,
@@ -39,7 +41,7 @@ async def image_agent(
     *,
     max_side: int = 1400,
     jpeg_quality: int = 85,
-    model: str = "claude-3-5-sonnet-20241022",
+    model: Optional[str] = None,
 ) -> str:
     image_files = image_files or []
     image_urls = image_urls or []
@@ -48,20 +50,13 @@ async def image_agent(
 
     bytes_items: List[tuple[str, bytes, str]] = []
 
-    # URLs → bytes
-    for url in image_urls:
-        try:
-            r = httpx.get(url, timeout=30, follow_redirects=True)
-            print(f"[image_agent] GET {url} -> {r.status_code}  ct={r.headers.get('content-type')}")
-            r.raise_for_status()
-            content = r.content
-            if not content:
-                print(f"[image_agent] EMPTY content from {url}")
-                continue
-            mime = r.headers.get("content-type") or mimetypes.guess_type(url)[0] or "image/jpeg"
-            bytes_items.append((url, content, mime))
-        except Exception as e:
-            print(f"[image_agent] URL ERROR {url}: {e}")
+    # URLs → bytes (fetched concurrently on the shared client)
+    for r in await fetch_many(image_urls, label="image_agent"):
+        if not r.size:
+            print(f"[image_agent] EMPTY content from {r.url}")
+            continue
+        mime = r.content_type or mimetypes.guess_type(r.url)[0] or "image/jpeg"
+        bytes_items.append((r.url, r.read_bytes(), mime))
 
     # Uploaded files
     for uf in image_files:
@@ -79,6 +74,18 @@ async def image_agent(
     if not bytes_items:
         return "No image content available to analyze."
 
+    # An explicit model is used as-is; otherwise the router picks one from the image count
+    route = Route("pinned", model, None) if model else choose("image_agent", images=len(bytes_items))
+
+    # Same images + same task -> skip downscaling and the Anthropic round trip
+    cached, cache_keys = await agent_cache.get_routed(route, lambda m: content_key(
+        "image_agent", m, normalize_task(task), max_side, jpeg_quality,
+        *[part for _, data, mime in bytes_items for part in (data, mime)]
+    ))
+    if cached is not None:
+        print("[image_agent] cache hit")
+        return cached
+
     # Downscale images
     processed: List[tuple[str, bytes, str]] = []
     for label, data, mime in bytes_items:
@@ -116,12 +123,13 @@ async def image_agent(
     print(f"[image_agent] BLOCKS images={len(processed)} total_blocks={len(content_blocks)}")
 
     # Call Anthropic
-    resp = await anthropic_client.messages.create(
-        model=model,
+    resp, answered_by = await routed_with_model("image_agent", route, lambda m: llm_gateway.anthropic_messages(
+        "image_agent",
+        model=m,
         max_tokens=1200,
         temperature=0.2,
         messages=[{"role": "user", "content": content_blocks}]
-    )
+    ), lambda r: valid_answer(message_text(r)))
 
     # Extract answer text
     pieces = []
@@ -133,6 +141,8 @@ async def image_agent(
     answer = "\n".join(p for p in pieces if p).strip()
 
     print(f"[image_agent] DONE answer_len={len(answer)}")
+    if answer:
+        agent_cache.set(cache_keys[answered_by], answer)
     return answer or "[No image answer returned]"
 
 async def main():
@@ -1,17 +1,18 @@
 import base64
 from dotenv import load_dotenv
-import httpx
 from typing import List, Optional
 from fastapi import UploadFile
-from anthropic import AsyncAnthropic
+from helper_http import fetch_many
+from helper_cache import agent_cache, content_key, normalize_task
+from helper_metrics import timed
+from helper_llm_gateway import llm_gateway, message_text
+from helper_model_router import choose, routed_with_model, valid_answer
 import os
 
 load_dotenv()
 
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-anthropic_client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
-
 
+@timed("pdf_agent")
 async def pdf_agent(
     pdf_files: Optional[List[UploadFile]] = None,
     pdf_urls: Optional[List[str]] = None,
@@ -23,19 +24,13 @@ async def pdf_agent(
     # ---- collect PDFs as base64 (urls -> download -> base64, files -> read -> base64) ----
     b64_docs: List[str] = []
 
-    # URLs -> base64
-    for url in pdf_urls:
-        try:
-            r = httpx.get(url, timeout=30, follow_redirects=True)
-            r.raise_for_status()
-            content = r.content
-            if not content:
-                print(f"[pdf_agent2] Empty response: {url}")
-                continue
-            b64_docs.append(base64.b64encode(content).decode("utf-8"))
-            print(f"[pdf_agent2] URL ok: {url}, bytes={len(content)}")
-        except Exception as e:
-            print(f"[pdf_agent2] URL error {url}: {e}")
+    # URLs -> base64 (fetched concurrently on the shared client)
+    for r in await fetch_many(pdf_urls, label="pdf_agent2"):
+        if not r.size:
+            print(f"[pdf_agent2] Empty response: {r.url}")
+            continue
+        b64_docs.append(base64.b64encode(r.read_bytes()).decode("utf-8"))
+        print(f"[pdf_agent2] URL ok: {r.url}, bytes={r.size}")
 
     # Uploads -> base64
     for pf in pdf_files:
@@ -52,6 +47,13 @@ async def pdf_agent(
     if not b64_docs:
         return "No PDF content available to analyze."
 
+    route = choose("pdf_agent", input_bytes=sum(len(b) * 3 // 4 for b in b64_docs))
+    cached, cache_keys = await agent_cache.get_routed(
+        route, lambda m: content_key("pdf_agent", m, normalize_task(task), *b64_docs))
+    if cached is not None:
+        print("[pdf_agent2] cache hit")
+        return cached
+
     # ---- build a single Anthropic request: text + document blocks (all base64) ----
     content_blocks = [
         {
@@ -75,12 +77,13 @@ async def pdf_agent(
         for b64 in b64_docs
     ]
 
-    resp = await anthropic_client.messages.create(
-        model="claude-3-5-sonnet-20241022",  # keep your pinned model
+    resp, answered_by = await routed_with_model("pdf_agent", route, lambda m: llm_gateway.anthropic_messages(
+        "pdf_agent",
+        model=m,
         max_tokens=2000,
         temperature=0.2,
         messages=[{"role": "user", "content": content_blocks}],
-    )
+    ), lambda r: valid_answer(message_text(r)))
 
     # ---- pull only text parts ----
     pieces = []
@@ -90,4 +93,7 @@ async def pdf_agent(
         elif isinstance(part, dict) and part.get("type") == "text":
             pieces.append(part.get("text", "") or "")
 
-    return "\n".join(p for p in pieces if p).strip() or "[No extractable text returned]"
+    answer = "\n".join(p for p in pieces if p).strip()
+    if answer:
+        agent_cache.set(cache_keys[answered_by], answer)
+    return answer or "[No extractable text returned]"
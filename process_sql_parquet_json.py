@@ -8,6 +8,8 @@ import pandas as pd
 import asyncio
 from starlette.datastructures import UploadFile
 from typing import Literal, Union, Dict, Any, Tuple
+from helper_http import fetch_many
+from helper_metrics import span, timed
 SQLITE_EXTS = (".db", ".sqlite", ".sqlite3")
 DUCKDB_EXTS = (".duckdb",)
 SQL_EXTS    = (".sql",)
@@ -22,22 +24,23 @@ def _block(sql_text: str):
 def _ext(name: str) -> str:
     return os.path.splitext(name.lower())[1]
 
-async def _dl(urls: List[str]) -> List[Tuple[str, bytes]]:
-    out = []
-    for u in urls or []:
-        try:
-            r = httpx.get(u, timeout=30, follow_redirects=True)
-            r.raise_for_status()
-            out.append((u, r.content))
-            print(f"[sql_agent] GET {u} -> {r.status_code}, ct={r.headers.get('content-type')}")
-        except Exception as e:
-            print(f"[sql_agent] URL error {u}: {e}")
-    return out
+async def _dl(urls: List[str]) -> List[Tuple[str, str]]:
+    """Download URLs to spooled files; returns (url, local_path) pairs."""
+    return [(r.url, r.path) for r in await fetch_many(urls, label="sql_agent")]
+
+def _safe_copy(path: str, src_path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    shutil.copyfile(src_path, path)
 
-def _safe_write(path: str, data: bytes):
+async def _spool_upload(uf: UploadFile, path: str, chunk_size: int = 1024 * 1024):
+    """Copy an upload to disk in chunks instead of reading it into memory."""
     os.makedirs(os.path.dirname(path), exist_ok=True)
     with open(path, "wb") as f:
-        f.write(data)
+        while True:
+            chunk = await uf.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
 
 class SQLContextBuilder:
     """
@@ -180,8 +183,8 @@ class SQLContextBuilder:
 
         print(f"[sql_agent] attached duckdb '{os.path.basename(abs_path)}' as {dbname} -> {len(tables)} tables exposed (via views)")
 
-    def register_tabular_file(self, path: str, table: Optional[str] = None):
-        ext = _ext(path)
+    def register_tabular_file(self, path: str, table: Optional[str] = None, ext: Optional[str] = None):
+        ext = ext or _ext(path)
         table = table or re.sub(r"[^A-Za-z0-9_]", "_", os.path.splitext(os.path.basename(path))[0])
         if ext == ".parquet":
             self.con.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM read_parquet('{path}')")
@@ -391,6 +394,7 @@ class SQLContextBuilder:
         return out
 
 # --- PROCESSING FUNCTION ----------
+@timed("sql_ingest")
 async def process_sql_parquet_json(
     task: str = "",
     # uploads
@@ -417,9 +421,8 @@ async def process_sql_parquet_json(
 
     print(f"[sql_agent] START db_files={len(db_files)} sql_files={len(sql_files)} pj_files={len(parquet_json_files)} db_urls={len(db_urls)} sql_urls={len(sql_urls)} pj_urls={len(parquet_json_urls)} external_uris={len(external_uris)}")
 
-    # Download things that need local bytes (DBs & .sql)
-    url_db_bytes  = await _dl(db_urls)
-    url_sql_bytes = await _dl(sql_urls)
+    # Download URLs to spooled files (streamed, size-bounded)
+    url_db_paths, url_sql_paths, url_pj_paths = await asyncio.gather(_dl(db_urls), _dl(sql_urls), _dl(parquet_json_urls))
 
     base_dir = persist_dir or os.path.join(os.getcwd(), "_session_sql")
     os.makedirs(base_dir, exist_ok=True)
@@ -432,10 +435,8 @@ async def process_sql_parquet_json(
 
     try:
         # 1) Handle DB uploads/URLs
-        def handle_db_blob(name: str, data: bytes):
+        def handle_db_file(name: str, path: str):
             e = _ext(name)
-            path = os.path.join(work_dir, os.path.basename(name))
-            _safe_write(path, data)
             if e in SQLITE_EXTS:
                 alias = re.sub(r"[^A-Za-z0-9_]", "_", os.path.splitext(os.path.basename(name))[0])
                 builder.register_sqlite_db(path, alias=alias)
@@ -445,10 +446,15 @@ async def process_sql_parquet_json(
                 print(f"[sql_agent] skipped DB blob {name} (ext {e})")
 
         for uf in db_files:
-            data = await uf.read()
-            handle_db_blob(getattr(uf, "filename", "upload.db"), data)
-        for name, data in url_db_bytes:
-            handle_db_blob(name, data)
+            name = getattr(uf, "filename", "upload.db")
+            path = os.path.join(work_dir, os.path.basename(name))
+            await _spool_upload(uf, path)
+            handle_db_file(name, path)
+        for name, src_path in url_db_paths:
+            # private copy: attached databases must not touch the shared download cache
+            path = os.path.join(work_dir, os.path.basename(name.split("?", 1)[0]))
+            _safe_copy(path, src_path)
+            handle_db_file(name, path)
 
         # 2) Handle parquet/json uploads
         for f in parquet_json_files:
@@ -456,18 +462,25 @@ async def process_sql_parquet_json(
             e  = _ext(fn)
             if e in TABULAR_EXTS:
                 path = os.path.join(work_dir, os.path.basename(fn))
-                _safe_write(path, await f.read())
+                await _spool_upload(f, path)
                 builder.register_tabular_file(path)
 
-        # 2b) parquet/json URLs (stream via httpfs)
+        # 2b) parquet/json URLs: read the downloaded file in place; httpfs only if the download failed
+        downloaded = dict(url_pj_paths)
         for u in parquet_json_urls:
-            builder.register_tabular_url(u)
+            if u in downloaded:
+                clean = u.split("?", 1)[0]
+                table = re.sub(r"[^A-Za-z0-9_]", "_", os.path.basename(clean))
+                builder.register_tabular_file(downloaded[u], table=table, ext=_ext(clean))
+            else:
+                builder.register_tabular_url(u)
 
         # 3) Apply user SQL scripts
         for sf in sql_files:
             builder.apply_user_sql(getattr(sf, "filename", "<upload.sql>"), await sf.read())
-        for name, data in url_sql_bytes:
-            builder.apply_user_sql(name, data)
+        for name, src_path in url_sql_paths:
+            with open(src_path, "rb") as fh:
+                builder.apply_user_sql(name, fh.read())
 
         # 4) External URIs (optional; introspect + sample import)
         if external_uris:
@@ -500,12 +513,13 @@ async def process_sql_parquet_json(
                 print(f"[sql_agent] sqlalchemy not available or failed: {e}")
 
         # 5) Summarize for Master
-        if return_format == "text":
-            return builder.summarize(task_hint=task)          # existing behavior
-        elif return_format == "json":
-            return builder.summarize_json(task_hint=task)     # for SQL agent
-        else:  # "both"
-            return builder.summarize_json(task_hint=task), builder.summarize(task_hint=task)
+        with span("duckdb_summarize"):
+            if return_format == "text":
+                return builder.summarize(task_hint=task)          # existing behavior
+            elif return_format == "json":
+                return builder.summarize_json(task_hint=task)     # for SQL agent
+            else:  # "both"
+                return builder.summarize_json(task_hint=task), builder.summarize(task_hint=task)
 
     finally:
         builder.close()
@@ -1,4 +1,4 @@
-import os, httpx
+import os
 from dotenv import load_dotenv
 import io, contextlib, duckdb, pandas as pd, numpy as np
 from process_sql_parquet_json import process_sql_parquet_json
@@ -7,29 +7,29 @@ import json
 from starlette.datastructures import UploadFile as StarletteUploadFile
 from typing import List, Optional
 from fastapi import UploadFile
+from helper_cache import agent_cache, content_key, normalize_task
+from helper_execute_code import CodeWorkerPool
+from helper_metrics import timed
+from helper_deadline import clamp
+from helper_llm_gateway import llm_gateway
+from helper_model_router import choose, routed_with_model, valid_python
+from helper_ledger import estimate_tokens, fit_context
+from helper_context_encoding import encode_context
 
 load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY_2")
 
-async def sql_parquet_json_agent(task_description: str, engine: str, session_db_path: str, sample_preview):
-    """
-    Returns a single Python script (as a string). You will execute it locally.
-    """
-    url = "https://api.openai.com/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    tables_list = sample_preview.get("tables", sample_preview) if isinstance(sample_preview, dict) else sample_preview
-    allowed_tables = [t["name"] for t in tables_list]
-
-    system_prompt = f"""
+SQL_EXEC_POOL_SIZE         = int(os.getenv("SQL_EXEC_POOL_SIZE", "2"))
+SQL_EXEC_TIMEOUT_SEC       = float(os.getenv("SQL_EXEC_TIMEOUT_SEC", "60"))
+SQL_EXEC_CPU_SEC           = int(os.getenv("SQL_EXEC_CPU_SEC", "60"))
+SQL_EXEC_MEMORY_MB         = int(os.getenv("SQL_EXEC_MEMORY_MB", "4096"))
+SQL_EXEC_MAX_OUTPUT_CHARS  = int(os.getenv("SQL_EXEC_MAX_OUTPUT_CHARS", "200000"))
+SQL_EXEC_PRELOAD = ("duckdb", "pandas", "numpy", "json", "sklearn", "sklearn.linear_model", "tabulate")
+_SESSION_PATH_PLACEHOLDER = "__SESSION_DB_PATH__"
+
+# Static rules first, identical on every call, so the provider can serve them from its prompt cache;
+# the per-request context (engine, session path, tables, preview) follows in a separate message.
+SQL_SYSTEM_PROMPT = """
 You are a agent that deals with SQL-PARQUET-JSON files and writes ONLY Python code (no prose, no backticks).
-Context:
-- ENGINE: {engine}
-- SESSION_DB_PATH: {session_db_path}
-- ALLOWED_TABLES: {allowed_tables}\n"
-- SAMPLE_PREVIEW_DATA: {sample_preview}
 
 Rules:
 - Output a complete, executable Python script ONLY.
@@ -50,41 +50,93 @@ Rules:
 - No GUI plotting. If you must plot, skip showing/saving and instead print key numeric results.
 """
 
+def _choice_text(resp: dict) -> str:
+    choices = (resp or {}).get("choices") or []
+    return ((choices[0].get("message") or {}).get("content") or "") if choices else ""
+
+@timed("sql_parquet_json_agent")
+async def sql_parquet_json_agent(task_description: str, engine: str, session_db_path: str, sample_preview):
+    """
+    Returns a single Python script (as a string). You will execute it locally.
+    """
+    tables_list = sample_preview.get("tables", sample_preview) if isinstance(sample_preview, dict) else sample_preview
+    allowed_tables = [t["name"] for t in tables_list]
+
+    # engine and path are stated once above the preview, not repeated inside it
+    preview = {k: v for k, v in sample_preview.items() if k not in ("engine", "session_db_path")} \
+        if isinstance(sample_preview, dict) else sample_preview
+    context_prompt = f"""Context:
+- ENGINE: {engine}
+- SESSION_DB_PATH: {session_db_path}
+- ALLOWED_TABLES: {", ".join(allowed_tables)}
+- SAMPLE_PREVIEW_DATA:
+{encode_context(preview, "sql_preview", legacy=lambda _: str(sample_preview))}
+"""
+    context_prompt = fit_context("sql_parquet_json_agent", context_prompt,
+                                 reserve_tokens=estimate_tokens(SQL_SYSTEM_PROMPT + (task_description or "")) + 2000)
+
     messages = [
-        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": SQL_SYSTEM_PROMPT},
+        {"role": "system", "content": context_prompt},
         {"role": "user", "content": f"Task: {task_description}\nReturn ONLY Python code."}
     ]
 
+    route = choose("sql_parquet_json_agent", input_chars=len(context_prompt) + len(task_description or ""))
+    model = route.model
+    # The session path changes per request, so it is left out of the key and
+    # swapped for a placeholder in the cached script.
+    cached, cache_keys = await agent_cache.get_routed(
+        route, lambda m: content_key("sql_parquet_json_agent", m, engine, normalize_task(task_description), sample_preview))
+    if cached is not None:
+        print("[sql_agent] cache hit")
+        return cached.replace(_SESSION_PATH_PLACEHOLDER, session_db_path or "")
+
     payload = {
-        "model": "gpt-4o-mini",     # or keep "gpt-3.5-turbo" if you must
+        "model": model,
         "messages": messages,
         "temperature": 0.2,
         "max_tokens": 2000
     }
 
-    async with httpx.AsyncClient(timeout=90) as client:
-        resp = await client.post(url, headers=headers, json=payload)
-        resp.raise_for_status()
-        return resp.json()["choices"][0]["message"]["content"].strip()
+    resp, answered_by = await routed_with_model("sql_parquet_json_agent", route,
+                        lambda m: llm_gateway.openai_chat("sql_parquet_json_agent", {**payload, "model": m}, timeout=90),
+                        lambda r: valid_python(_choice_text(r).strip()))
+    code = _choice_text(resp).strip()
+    if code:
+        agent_cache.set(cache_keys[answered_by], code.replace(session_db_path, _SESSION_PATH_PLACEHOLDER) if session_db_path else code)
+    return code
 
 
 
-def execute_llm_python(code_str: str, session_db_path: str):
+sql_exec_pool = CodeWorkerPool(
+    "sql_exec_pool", SQL_EXEC_PRELOAD,
+    size=SQL_EXEC_POOL_SIZE, rlimit_as_mb=SQL_EXEC_MEMORY_MB,
+)
+
+@timed("sql_exec")
+async def execute_llm_python(code_str: str, session_db_path: str, timeout: float = SQL_EXEC_TIMEOUT_SEC):
+    """
+    Run the generated script in a separate worker process (never on the event loop),
+    under a wall-clock timeout, RLIMIT_AS/RLIMIT_CPU caps and an output size cap.
+    """
     # Inject safe globals; give the script SESSION_DB_PATH + common libs
-    globs = {
-        "duckdb": duckdb,
-        "pd": pd,
-        "np": np,
-        "SESSION_DB_PATH": session_db_path,
+    job = {
+        "code": code_str,
+        "globals": {"SESSION_DB_PATH": session_db_path},
+        "inject_modules": {"duckdb": "duckdb", "pd": "pandas", "np": "numpy"},
+        "cpu_sec": SQL_EXEC_CPU_SEC,
+        "max_output": SQL_EXEC_MAX_OUTPUT_CHARS,
     }
-    buf = io.StringIO()
-    try:
-        with contextlib.redirect_stdout(buf):
-            exec(code_str, globs, {})
-        out = buf.getvalue().strip()
-        return {"ok": True, "stdout": out}
-    except Exception as e:
-        return {"ok": False, "error": str(e), "stdout": buf.getvalue().strip()}
+    timeout = clamp(timeout)
+    res = await sql_exec_pool.submit(job, timeout)
+    if res.get("timeout"):
+        return {"ok": False, "error": f"Execution timed out after {timeout}s", "stdout": ""}
+    if res.get("crashed"):
+        return {"ok": False, "error": f"Execution worker died: {res['crashed']}", "stdout": ""}
+    out = (res.get("stdout") or "").strip()
+    if res.get("error"):
+        return {"ok": False, "error": res["error"], "stdout": out, "truncated": res.get("truncated", False)}
+    return {"ok": True, "stdout": out, "truncated": res.get("truncated", False)}
 
 async def main():
     # 0) read the single task once
@@ -124,7 +176,8 @@ async def main():
 
     # 3) execute ONCE and print the output
     print("\n================ EXECUTION OUTPUT ================\n")
-    result = execute_llm_python(code, session_db_path=session_db_path)
+    result = await execute_llm_python(code, session_db_path=session_db_path)
+    await sql_exec_pool.stop()
     if result["ok"]:
         print(result["stdout"])
     else:
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from helper_short_circuit import matches, parse_output_shape, short_circuit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def question(n: int) -> str:
+    with open(os.path.join(REPO_DIR, f"question{n}.txt"), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def ctx(content, **extra):
+    return [{"source": "test", "content": content, **extra}]
+
+
+@pytest.mark.parametrize("n, expected", [
+    (1, None),    # asks for a scatterplot
+    (2, ("list", ["string"] * 4, False)),
+    (3, None),    # asks for a bar chart
+    (4, None),    # unnumbered questions: no count to check against
+    (5, ("list", [("list", [], True), ("list", ["any", "any"], True), "number", "number", "string"], False)),
+    (6, ("list", ["number"] * 4, False)),
+    (7, ("list", [("list", ["string"] * 3, False), ("list", ["number"] * 3, False)], False)),
+    (8, ("list", ["any"] * 4, False)),
+    (9, ("list", [("list", ["number", "number", "string"], False)], False)),
+    (10, ("list", ["any"] * 3, False)),
+    (11, None),   # free-form EDA report
+    (12, None),   # placeholder keys ("name": "row_count") are not real key names
+])
+def test_question_shapes(n, expected):
+    assert parse_output_shape(question(n)) == expected
+
+
+def test_object_keys_with_apostrophes_and_brackets():
+    shape = parse_output_shape('Return a JSON object:\n'
+                               '{"What\'s the regression slope of x, y?": <number>, "Which court [has] most cases?": "<name>"}')
+    assert shape == ("object", ["What's the regression slope of x, y?", "Which court [has] most cases?"])
+    assert matches(shape, {"What's the regression slope of x, y?": 0.5, "Which court [has] most cases?": "33_10"})
+    assert not matches(shape, {"What's the regression slope of x, y?": 0.5})
+
+
+def test_list_template_with_commas_inside_strings():
+    shape = parse_output_shape('Answer with:\n["<name, as written>", <count>]')
+    assert shape == ("list", ["string", "number"], False)
+
+
+def test_fires_for_single_source_in_shape():
+    answer = ["a", "b", "c", "d"]
+    assert short_circuit(question(2), {"csv_tsv_xlsx": ctx(json.dumps(answer)), "html": None}) == ("csv_tsv_xlsx", answer)
+
+
+def test_uses_raw_stdout_over_summary():
+    answer = [1, 2.5, 3, 4]
+    got = short_circuit(question(6), {"sql_parquet_json": ctx("a summary of the run", stdout="log\n" + json.dumps(answer))})
+    assert got == ("sql_parquet_json", answer)
+
+
+def test_nested_template():
+    answer = [["x", "y", "z"], [1, 2, 3]]
+    assert short_circuit(question(7), {"html": ctx(f"```json\n{json.dumps(answer)}\n```")}) == ("html", answer)
+
+
+def test_skipped_when_a_stage_failed_or_was_cut_off():
+    contexts = {"csv_tsv_xlsx": ctx(json.dumps(["a", "b", "c", "d"]))}
+    assert short_circuit(question(2), contexts, errors={"pdf": asyncio.TimeoutError()}) is None
+    assert short_circuit(question(2), contexts, errors={"html": RuntimeError("boom")}) is None
+
+
+def test_skipped_with_several_sources():
+    contexts = {"csv_tsv_xlsx": ctx(json.dumps(["a", "b", "c", "d"])), "pdf": ctx("some extracted text")}
+    assert short_circuit(question(2), contexts) is None
+
+
+@pytest.mark.parametrize("n, output", [
+    (2, ["a", "b", "c"]),              # one answer short
+    (6, ["1", "2", "3", "4"]),         # strings where numbers are asked for
+    (8, ["a", None, "c", "d"]),        # a missing answer
+    (9, "not json at all"),
+])
+def test_not_fired_when_output_does_not_match(n, output):
+    text = output if isinstance(output, str) else json.dumps(output)
+    assert short_circuit(question(n), {"html": ctx(text)}) is None
+
+
+def test_never_fires_for_plot_questions():
+    assert short_circuit(question(1), {"html": ctx(json.dumps(["1", "Titanic", "0.48", "data:image/png;base64,x"]))}) is None
+
+
+def test_skipped_when_an_archive_file_kind_failed():
+    # the archive's csv agent failed and left "" behind: its pdf output is the only source, but partial
+    contexts = {"archive": [{"source": {}, "content": {"csv": "", "pdf": json.dumps(["a", "b", "c", "d"])},
+                             "errors": {"csv": "RuntimeError: boom"}}]}
+    assert short_circuit(question(2), contexts) is None
+    del contexts["archive"][0]["errors"]
+    assert short_circuit(question(2), contexts) == ("archive:pdf", ["a", "b", "c", "d"])